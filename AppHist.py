@@ -1,11 +1,19 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory, jsonify, g, Response, stream_with_context
 from flask_session import Session
 import os, json, threading, uuid, subprocess
 import jinja2
 from main import *  # Importation des modules personnalisés (chat, analyse d'image, etc.)
 from gtts import gTTS
 import pyttsx3
-from tagging import handle_image_tagging
+from tagging import handle_image_tagging, retag_all_images
+from user_cache import user_cache
+import unit_of_work
+from storage import get_storage, canonical_username, load_image_cards
+from user_locks import user_lock, user_transaction, LockTimeout
+from jobs import JobQueue
+from tag_index import get_tag_index, search_images
+from preparer_service import enqueue_user, notify_activity
+from history_store import add_append_listener
 from PIL import Image
 import sys
 import textwrap
@@ -17,6 +25,9 @@ from langdetect import detect, DetectorFactory
 DetectorFactory.seed = 0
 
 
+# Chaque ajout de messages est signalé au service de préparation (résumé déclenché par l'activité)
+add_append_listener(notify_activity)
+
 app = Flask(__name__)
 app.secret_key = 'votre_clé_secrète'
 app.jinja_loader = jinja2.DictLoader(templates)
@@ -27,6 +38,38 @@ app.config["SESSION_FILE_DIR"] = os.path.join(app.root_path, "flask_session")
 app.config["SESSION_PERMANENT"] = False
 Session(app)
 
+@app.before_request
+def begin_unit_of_work():
+    """
+    Ouvre l'unité de travail de la requête : les écritures sont regroupées.
+    Le verrou de l'utilisateur n'est pas tenu pour toute la requête : chaque
+    lecture-modification-écriture est encadrée par user_transaction() (verrou exclusif,
+    écriture des modifications avant de le rendre), et les appels au modèle, le flux
+    /chat_stream et la transcription se font sans verrou.
+    """
+    unit_of_work.begin()
+
+@app.errorhandler(LockTimeout)
+def lock_timeout(e):
+    print(f"[ERROR] {e}")
+    return "Les données de l'utilisateur sont en cours de mise à jour, veuillez réessayer.", 503
+
+@app.teardown_request
+def end_unit_of_work(exc):
+    """Écrit les modifications restantes (ou abandonne tout en cas d'erreur)."""
+    if exc is None:
+        uow = unit_of_work.current()
+        username = session.get("username")
+        if username and uow is not None and (uow.documents or uow.appends):
+            # Écritures faites hors d'une transaction : elles sont tout de même faites sous le verrou
+            with user_transaction(username):
+                pass
+        unit_of_work.end(commit=True)
+    else:
+        print(f"[ERROR] Requête interrompue, écritures abandonnées : {exc}")
+        for path in unit_of_work.end(commit=False):
+            user_cache.invalidate(path)
+
 # IMPORTANT : Pour TTS, nous utilisons subprocess afin d'éviter les conflits avec la boucle d'événements
 def generate_speech(text):
     """Génère la synthèse vocale en détectant la langue du texte de façon robuste."""
@@ -66,9 +109,13 @@ questions_base = [
     "What is your dream or goal in life?"
 ]
 
-def get_user_info(username):
-    """Récupère ou crée le fichier JSON de l'utilisateur avec la structure de base."""
-    user_info_path = f"users/{username}.json"
+def get_user_info(username, sections=None):
+    """
+    Récupère ou crée le fichier JSON de l'utilisateur avec la structure de base.
+    La fiche est lue via le backend de stockage configuré (voir storage.py). Seules les
+    sections demandées ("images", "history", "summaries" ; toutes par défaut) sont chargées
+    en plus du profil.
+    """
     defaults = {
         "nom": username,
         "preferences": {},
@@ -76,26 +123,26 @@ def get_user_info(username):
         "images": [],
         "conversation_resumer": []
     }
-    if os.path.exists(user_info_path):
-        with open(user_info_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        for key in defaults:
-            if key not in data:
-                data[key] = defaults[key]
+    with user_lock(username, "r"):
+        data = get_storage().load_user(username, sections)
+    if data is not None:
+        # Sections et préférences sont complétées par le schéma (records.py) ; seul le nom
+        # dépend de l'utilisateur
+        data.setdefault("nom", defaults["nom"])
         if not data.get("preferences"):
             return data, True
         return data, False
     else:
-        os.makedirs("users", exist_ok=True)
-        with open(user_info_path, "w", encoding="utf-8") as f:
-            json.dump(defaults, f, ensure_ascii=False, indent=4)
+        with user_transaction(username):
+            data = get_storage().load_user(username, sections)
+            if data is not None:
+                return data, not data.get("preferences")
+            get_storage().save_user(username, defaults)
         return defaults, True
 
 def save_user_info(username, user_info):
     """Sauvegarde la fiche utilisateur en respectant la structure de base."""
-    user_info_path = f"users/{username}.json"
-    with open(user_info_path, "w", encoding="utf-8") as f:
-        json.dump(user_info, f, ensure_ascii=False, indent=4)
+    get_storage().save_user(username, user_info)
 
 def get_next_question(user_info):
     """Renvoie la prochaine question non renseignée."""
@@ -119,38 +166,27 @@ def convert_history_to_messages(history: list) -> list:
 
 def save_conversation_history(username: str, history: list) -> list:
     """
-    Charge l'historique existant depuis 'historique/<username>.json', y ajoute les nouveaux messages,
-    et sauvegarde l'historique cumulatif.
+    Ajoute à l'historique de l'utilisateur uniquement les nouveaux messages
+    (ceux qui n'ont pas encore d'identifiant). Retourne les messages ajoutés.
     """
-    directory = "historique"
-    os.makedirs(directory, exist_ok=True)
-    filepath = os.path.join(directory, f"{username}.json")
-    existing_history = []
-    if os.path.exists(filepath):
-        try:
-            with open(filepath, "r", encoding="utf-8") as f:
-                existing_history = json.load(f)
-        except Exception as e:
-            print(f"[ERROR] Erreur lors du chargement de l'historique existant : {e}")
-    combined = existing_history + convert_history_to_messages(history)
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(combined, f, ensure_ascii=False, indent=4)
-    return combined
+    with user_transaction(username):
+        return get_storage().append_messages(username, history)
 
 def update_user_info_from_history(username: str, history: list) -> dict:
     """Met à jour la clé 'conversation_history' dans la fiche utilisateur."""
-    user_info, _ = get_user_info(username)
-    filtered_history = convert_history_to_messages(history)
-    user_info["conversation_history"] = filtered_history
-    save_user_info(username, user_info)
+    with user_transaction(username):
+        user_info, _ = get_user_info(username, ("history",))
+        filtered_history = convert_history_to_messages(history)
+        user_info["conversation_history"] = filtered_history
+        save_user_info(username, user_info)
     return user_info
 
 def update_uploaded_cards(username):
-    user_info, _ = get_user_info(username)
-    return user_info.get("images", [])
+    # Cartes identifiées (clé de l'index des tags)
+    return load_image_cards(username)
 
 def play_card_description(index, username):
-    user_info, _ = get_user_info(username)
+    user_info, _ = get_user_info(username, ("images",))
     images = user_info.get("images", [])
     if index < len(images):
         description = images[index].get("description", "")
@@ -163,95 +199,154 @@ def chat_response(user_message, history, username, tts_enabled):
     Gère la réponse de l'utilisateur.
       - En mode image, ajoute le message à la description de l'image en cours.
       - En mode collecte de préférences, enregistre la réponse et insère la prochaine question.
-      - Sinon, envoie la requête au chatbot (seuls les 20 derniers messages sont utilisés).
+      - Sinon, envoie la requête au chatbot (messages récents dans le budget de tokens).
     """
     if session.get("image_mode", False):
         current_index = session.get("current_image_index", None)
         if current_index is not None:
-            user_info, _ = get_user_info(username)
-            images = user_info.get("images", [])
+            with user_transaction(username):
+                user_info, _ = get_user_info(username, ("images",))
+                images = user_info.get("images", [])
+                if current_index < len(images):
+                    images[current_index]["description"] += " " + user_message
+                    save_user_info(username, user_info)
             if current_index < len(images):
-                images[current_index]["description"] += " " + user_message
-                save_user_info(username, user_info)
-                tag_update = handle_image_tagging(user_message, user_info, username, LLaMAChat(username=username))
+                # Génération des tags hors verrou : update_image_tags relit la fiche pour les enregistrer
+                tag_update = handle_image_tagging(user_message, user_info, username, get_chatbot(username))
                 if tag_update:
                     history.append({"role": "assistant", "content": tag_update["content"]})
                 history.append({"role": "assistant", "content": f"(Message ajouté à l'image) {user_message}"})
-                save_conversation_history(username, history)
-                update_user_info_from_history(username, history)
+                with user_transaction(username):
+                    save_conversation_history(username, history)
+                    update_user_info_from_history(username, history)
                 return history
 
-    user_info, _ = get_user_info(username)
-    if "current_question" in user_info:
-        current_q = user_info["current_question"]
-        user_info["preferences"][current_q] = user_message
-        user_info.pop("current_question")
-        save_user_info(username, user_info)
-        next_q = get_next_question(user_info)
-        if next_q:
-            user_info["current_question"] = next_q
+    with user_transaction(username):
+        user_info, _ = get_user_info(username, ("profile",))
+        if "current_question" in user_info:
+            current_q = user_info["current_question"]
+            user_info["preferences"][current_q] = user_message
+            user_info.pop("current_question")
             save_user_info(username, user_info)
-            history.append({"role": "system_question", "content": next_q})
-            save_conversation_history(username, history)
-            update_user_info_from_history(username, history)
-            return history
-        else:
-            history.append({"role": "assistant", "content": "Merci pour vos réponses. Vous pouvez maintenant discuter librement."})
+            next_q = get_next_question(user_info)
+            if next_q:
+                user_info["current_question"] = next_q
+                save_user_info(username, user_info)
+                history.append({"role": "system_question", "content": next_q})
+            else:
+                history.append({"role": "assistant", "content": "Merci pour vos réponses. Vous pouvez maintenant discuter librement."})
             save_conversation_history(username, history)
             update_user_info_from_history(username, history)
             return history
-    else:
-        truncated_history = history[-20:] if len(history) > 20 else history
-        for msg in truncated_history:
-            if msg.get("role") == "system_question":
-                msg["role"] = "assistant"
-        chatbot = LLaMAChat(username=username)
-        chatbot.history = truncated_history
+    # Discussion libre : l'appel au modèle se fait sans verrou de l'utilisateur (session réservée)
+    with chat_session(username) as chatbot:
+        prepare_chatbot(chatbot, history)
         response = chatbot.ask(user_message)
         history = chatbot.history
+    return finish_free_chat(history, username, tts_enabled, response)
 
+def prepare_chatbot(chatbot, history):
+    """Prépare le chatbot de discussion libre sur l'historique récent (borné à l'envoi)."""
+    for msg in history:
+        if msg.get("role") == "system_question":
+            msg["role"] = "assistant"
+    chatbot.history = history
+
+def finish_free_chat(history, username, tts_enabled, response):
+    """Fin d'un tour de discussion libre : synthèse vocale et enregistrement (une seule fois)."""
     if tts_enabled and response.strip():
         generate_speech(response)
-    save_conversation_history(username, history)
-    update_user_info_from_history(username, history)
+    with user_transaction(username):
+        save_conversation_history(username, history)
+        update_user_info_from_history(username, history)
     return history
 
-def image_response(image_obj, history, username):
+def last_assistant_reply(history):
+    for msg in reversed(history):
+        if msg["role"] in ("assistant", "system_question"):
+            return msg["content"]
+    return ""
+
+def chat_response_stream(user_message, history, username, tts_enabled):
+    """
+    Variante en flux de chat_response : en discussion libre, renvoie les morceaux de la
+    réponse au fur et à mesure. Les modes image et questions de préférences n'appellent pas
+    le modèle de chat en continu : leur réponse est renvoyée d'un bloc.
     """
-    Traite l'envoi d'une image :
-      - Sauvegarde l'image dans le dossier images/<username>.
+    user_info, _ = get_user_info(username, ("profile",))
+    image_mode = session.get("image_mode", False) and session.get("current_image_index") is not None
+    if image_mode or "current_question" in user_info:
+        yield last_assistant_reply(chat_response(user_message, history, username, tts_enabled))
+        return
+    parts = []
+    with chat_session(username) as chatbot:
+        prepare_chatbot(chatbot, history)
+        for token in chatbot.ask_stream(user_message):
+            parts.append(token)
+            yield token
+        history = chatbot.history
+    finish_free_chat(history, username, tts_enabled, "".join(parts))
+
+UPLOADS_DIR = "image_uploads"
+
+def process_image_job(job, progress):
+    """
+    Traitement en arrière-plan d'une image envoyée (voir jobs.py) :
+      - Convertit le fichier reçu en JPEG dans le dossier images/<username>.
       - Analyse son contenu pour générer une description.
-      - Ajoute les métadonnées de l'image dans la fiche utilisateur.
+      - Ajoute les métadonnées de l'image dans la fiche utilisateur et la description à l'historique.
+    Le mode image est activé par /image_job/<id> quand le navigateur constate la fin de la tâche.
     """
-    if image_obj is None:
-        return history
-    user_info, _ = get_user_info(username)
+    username = job["username"]
+    upload_path = job["payload"]["upload_path"]
     user_dir = os.path.join("images", username)
     os.makedirs(user_dir, exist_ok=True)
-    # Utiliser un nom de fichier basé sur le nombre d'images déjà enregistrées dans la fiche utilisateur
-    image_filename = f"{len(user_info.get('images', [])) + 1}.jpg"
+    # Nom unique : plusieurs images du même utilisateur peuvent être traitées en parallèle
+    image_filename = f"{job['id'][:12]}.jpg"
     image_path = os.path.join(user_dir, image_filename).replace("\\", "/")
-    image_obj.save(image_path)
-    analyzer = LLaVAAnalyzer()
-    description = analyzer.describe_image(image_path)
-    history.append({"role": "assistant", "content": f"**Image Description**: {description}"})
-    if "images" not in user_info:
-        user_info["images"] = []
-    image_metadata = {
-         "filename": image_filename,
-         "path": image_path,
-         "description": description,
-         "tags": []
-    }
-    user_info["images"].append(image_metadata)
-    save_user_info(username, user_info)
-    save_conversation_history(username, history)
-    update_user_info_from_history(username, history)
+    saved = False
+    try:
+        progress("Préparation de l'image", 10)
+        with Image.open(upload_path) as image_obj:
+            image_obj.convert("RGB").save(image_path)
+        progress("Analyse de l'image", 30)
+        analyzer = LLaVAAnalyzer()
+        description = analyzer.describe_image(image_path)
+        progress("Enregistrement", 90)
+        with user_transaction(username):
+            user_info = get_storage().load_user(username, ("images",)) or {"nom": username, "preferences": {}}
+            image_metadata = {
+                 "filename": image_filename,
+                 "path": image_path,
+                 "description": description,
+                 "tags": []
+            }
+            user_info.setdefault("images", []).append(image_metadata)
+            get_storage().save_user(username, user_info)
+            saved = True
+            get_tag_index(username).index_image(image_metadata)
+            save_conversation_history(username, [{"role": "assistant", "content": f"**Image Description**: {description}"}])
+            update_user_info_from_history(username, get_storage().load_history_tail(username))
+    finally:
+        # Le fichier reçu ne sert plus, que la tâche réussisse ou échoue (statut "error")
+        if os.path.exists(upload_path):
+            os.remove(upload_path)
+        if not saved and os.path.exists(image_path):
+            os.remove(image_path)
     generate_speech(description)
-    # Active le mode image
-    session["image_mode"] = True
-    session["current_image_index"] = len(user_info["images"]) - 1
-    return history
+    # Identifiant de la carte, pas sa position : d'autres cartes peuvent être ajoutées ou
+    # supprimées avant la lecture du résultat (voir /image_job)
+    return {"id": image_metadata["id"], "path": image_path, "description": description}
+
+image_jobs = JobQueue("image", process_image_job, workers=int(os.environ.get("REMEMORY_IMAGE_WORKERS", "2")))
+image_jobs.resume()
+
+def process_retag_job(job, progress):
+    """Re-tagging de toutes les images de l'utilisateur (voir tagging.retag_all_images)."""
+    return {"updated": retag_all_images(job["username"], progress=progress)}
+
+retag_jobs = JobQueue("retag", process_retag_job, workers=1)
+retag_jobs.resume()
 
 @app.route("/", methods=["GET", "POST"])
 def login():
@@ -266,28 +361,45 @@ def login():
         if not username:
             flash("Veuillez entrer un nom d'utilisateur.")
             return redirect(url_for("login"))
+        # Nom unique pour la fiche, l'historique, les verrous et le service de préparation
+        username = canonical_username(username)
         session["username"] = username
-        user_info, is_new = get_user_info(username)
-        if is_new or not user_info.get("preferences"):
-            first_q = get_next_question(user_info)
-            if first_q:
-                user_info["current_question"] = first_q
-                save_user_info(username, user_info)
-        else:
-            history_file = f"historique/{username}.json"
-            if os.path.exists(history_file):
-                with open(history_file, "r", encoding="utf-8") as f:
-                    session["chat_history"] = json.load(f)
-            else:
-                session["chat_history"] = []
+        try:
+            with user_transaction(username):
+                user_info, is_new = get_user_info(username, ("profile",))
+                if is_new or not user_info.get("preferences"):
+                    first_q = get_next_question(user_info)
+                    if first_q:
+                        user_info["current_question"] = first_q
+                        save_user_info(username, user_info)
+        except LockTimeout as e:
+            print(f"[ERROR] {e}")
+            flash("Vos données sont en cours de mise à jour, veuillez réessayer.")
+            return redirect(url_for("login"))
+        if not is_new and user_info.get("preferences"):
+            session["chat_history"] = get_storage().load_history_tail(username)
         session.setdefault("chat_history", [])
         session.setdefault("image_mode", False)
         session.setdefault("current_image_index", None)
-        subprocess.Popen([sys.executable, "data_preparer.py", username])
+        # Un seul service de préparation pour tous les utilisateurs (voir preparer_service.py)
+        enqueue_user(username)
         print(f"[DEBUG] Utilisateur détecté : {username}")
         return redirect(url_for("chat"))
     return render_template("login.html", title="Login - ReMemory Chat")
 
+def load_chat_history(username):
+    """Charge la partie récente de l'historique et y réaffiche la question en attente."""
+    history = get_storage().load_history_tail(username)
+    user_info, _ = get_user_info(username, ("profile",))
+    if "current_question" in user_info and user_info["current_question"]:
+        # Simple réaffichage de la question en attente : elle n'est pas réécrite dans le journal
+        system_msg = {"role": "system_question", "content": user_info["current_question"], "transient": True}
+        if not history or (history and history[0].get("role") != "system_question"):
+            history.insert(0, system_msg)
+        else:
+            history[0]["content"] = user_info["current_question"]
+    return history
+
 @app.route("/chat", methods=["GET", "POST"])
 def chat():
     """
@@ -299,30 +411,14 @@ def chat():
     if "username" not in session:
         return redirect(url_for("login"))
     username = session["username"]
-    history = []
-    history_file = f"historique/{username}.json"
-    if os.path.exists(history_file):
-        with open(history_file, "r", encoding="utf-8") as f:
-            history = json.load(f)
-    user_info, _ = get_user_info(username)
-    if "current_question" in user_info and user_info["current_question"]:
-        system_msg = {"role": "system_question", "content": user_info["current_question"]}
-        if not history or (history and history[0].get("role") != "system_question"):
-            history.insert(0, system_msg)
-        else:
-            history[0]["content"] = user_info["current_question"]
+    history = load_chat_history(username)
     if request.method == "POST":
         if request.is_json:
             data = request.get_json()
             user_message = data.get("message", "")
             tts_enabled = data.get("tts", False)
             updated_history = chat_response(user_message, history, username, tts_enabled)
-            last_reply = ""
-            for msg in reversed(updated_history):
-                if msg["role"] in ("assistant", "system_question"):
-                    last_reply = msg["content"]
-                    break
-            return jsonify({"reply": last_reply})
+            return jsonify({"reply": last_assistant_reply(updated_history)})
         else:
             user_message = request.form.get("message", "")
             tts_enabled = request.form.get("tts") == "on"
@@ -333,36 +429,90 @@ def chat():
                            username=username,
                            chat_history=[])#convert_history_to_messages(history) a la place tu tableau vide si on veut afficher hitorique dan sle chat
 
+@app.route("/chat_stream", methods=["POST"])
+def chat_stream():
+    """
+    Variante en flux de /chat (Server-Sent Events) : chaque morceau de la réponse est envoyé
+    dans un événement "data: {"token": ...}" dès qu'il est généré, puis un événement "done"
+    porte la réponse complète. L'historique est enregistré une seule fois, à la fin du flux
+    (sous le verrou de l'utilisateur, qui n'est pas tenu pendant la génération).
+    """
+    if "username" not in session:
+        return jsonify({"error": "Non connecté"}), 401
+    username = session["username"]
+    data = request.get_json(silent=True) or {}
+    user_message = data.get("message", "")
+    tts_enabled = data.get("tts", False)
+    history = load_chat_history(username)
+
+    def events():
+        parts = []
+        try:
+            for token in chat_response_stream(user_message, history, username, tts_enabled):
+                parts.append(token)
+                yield f"data: {json.dumps({'token': token}, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            print(f"[ERROR] Erreur pendant le flux de réponse : {e}")
+            yield f"event: error\ndata: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
+            return
+        yield f"event: done\ndata: {json.dumps({'reply': ''.join(parts)}, ensure_ascii=False)}\n\n"
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/upload_image", methods=["POST"])
 def upload_image():
+    """
+    Enregistre l'image reçue et confie son analyse à un worker : la requête répond
+    immédiatement. Le navigateur suit la tâche via /image_job/<id>.
+    """
     if "username" not in session:
         return redirect(url_for("login"))
     username = session["username"]
-    history = []
-    history_file = f"historique/{username}.json"
-    if os.path.exists(history_file):
-        with open(history_file, "r", encoding="utf-8") as f:
-            history = json.load(f)
     if "image" in request.files:
-        image_file = request.files["image"]
         try:
-            image_obj = Image.open(image_file.stream)
-            history = image_response(image_obj, history, username)
+            os.makedirs(UPLOADS_DIR, exist_ok=True)
+            upload_path = os.path.join(UPLOADS_DIR, uuid.uuid4().hex)
+            request.files["image"].save(upload_path)
+            job_id = image_jobs.submit(username, {"upload_path": upload_path})
+            session["image_job"] = job_id
+            if request.accept_mimetypes.best == "application/json":
+                return jsonify({"job_id": job_id}), 202
+            flash("Image reçue : analyse en cours.")
         except Exception as e:
             flash("Erreur lors du traitement de l'image.")
-    save_conversation_history(username, history)
     return redirect(url_for("chat"))
 
+@app.route("/image_job/<job_id>")
+def image_job(job_id):
+    """État d'une analyse d'image ; une fois terminée, active le mode image sur cette image."""
+    if "username" not in session:
+        return jsonify({"error": "Non connecté"}), 401
+    job = image_jobs.get(job_id)
+    followed = session.get("image_job") == job_id
+    if job is None or job["username"] != session["username"]:
+        if followed:
+            session.pop("image_job")
+        return jsonify({"error": "Tâche inconnue"}), 404
+    if job["status"] == "done" and followed:
+        session.pop("image_job")
+        # Position actuelle de la carte (elle a pu être supprimée depuis)
+        images = load_image_cards(session["username"])
+        position = next((i for i, image in enumerate(images) if image["id"] == job["result"].get("id")), None)
+        if position is not None:
+            session["image_mode"] = True
+            session["current_image_index"] = position
+    elif job["status"] == "error" and followed:
+        session.pop("image_job")
+        flash("Erreur lors du traitement de l'image.")
+    return jsonify({key: job[key] for key in ("id", "status", "step", "progress", "result", "error")})
+
 @app.route("/upload_audio", methods=["POST"])
 def upload_audio():
     if "username" not in session:
         return redirect(url_for("login"))
     username = session["username"]
-    history = []
-    history_file = f"historique/{username}.json"
-    if os.path.exists(history_file):
-        with open(history_file, "r", encoding="utf-8") as f:
-            history = json.load(f)
+    history = get_storage().load_history_tail(username)
     if "audio" in request.files:
         audio_file = request.files["audio"]
         try:
@@ -372,7 +522,11 @@ def upload_audio():
             filepath = os.path.join(audio_dir, filename)
             audio_file.save(filepath)
             text = transcribe_audio(filepath)
-            history = chat_response(text, history, username, tts_enabled=True)
+            if text is NO_SPEECH:
+                # Silence ou bruit seul : pas de prompt vide envoyé au modèle
+                flash("Aucune parole détectée dans l'enregistrement.")
+            else:
+                history = chat_response(text, history, username, tts_enabled=True)
         except Exception as e:
             flash("Erreur lors du traitement de l'audio: " + str(e))
         finally:
@@ -388,20 +542,53 @@ def clear_image():
     flash("Le mode image est désactivé. Le chat est revenu en mode normal.")
     return redirect(url_for("chat"))
 
+def image_search_args():
+    """Critères de recherche d'images : ?tags=lieu:plage,personne:famille&q=...&mode=and|or&page=1"""
+    tags = [tag for tag in request.args.get("tags", "").split(",") if tag.strip()]
+    mode = "or" if request.args.get("mode", "and").lower() == "or" else "and"
+    try:
+        page = int(request.args.get("page", 1))
+        per_page = min(max(int(request.args.get("per_page", 20)), 1), 100)
+    except ValueError:
+        page, per_page = 1, 20
+    return tags, request.args.get("q", ""), mode, page, per_page
+
 @app.route("/images")
 def images():
     if "username" not in session:
         return redirect(url_for("login"))
     username = session["username"]
     cards = update_uploaded_cards(username)
-    return render_template("images.html", title="Images Uploadées - ReMemory Chat", username=username, cards=cards)
+    indexes = list(range(len(cards)))
+    tags, query, mode, _, _ = image_search_args()
+    if tags or query.strip():
+        found = search_images(username, cards, tags, query, mode, per_page=len(cards) or 1)
+        indexes = [position for position, _ in found["results"]]
+        cards = [card for _, card in found["results"]]
+    return render_template("images.html", title="Images Uploadées - ReMemory Chat", username=username,
+                           cards=cards, indexes=indexes, tags=",".join(tags), query=query, mode=mode)
+
+@app.route("/search_images")
+def search_images_route():
+    """
+    Recherche dans les cartes images via l'index inversé (voir tag_index.py) : tags et mots
+    combinés en ET (mode=and, par défaut) ou en OU (mode=or), compte des tags par catégorie
+    parmi les résultats, pagination (page, per_page).
+    """
+    if "username" not in session:
+        return jsonify({"error": "Non connecté"}), 401
+    username = session["username"]
+    tags, query, mode, page, per_page = image_search_args()
+    found = search_images(username, update_uploaded_cards(username), tags, query, mode, page, per_page)
+    found["results"] = [dict(card, index=position) for position, card in found["results"]]
+    return jsonify(found)
 
 @app.route("/edit_image/<int:index>", methods=["GET", "POST"])
 def edit_image(index):
     if "username" not in session:
         return redirect(url_for("login"))
     username = session["username"]
-    user_info, _ = get_user_info(username)
+    user_info, _ = get_user_info(username, ("images",))
     images = user_info.get("images", [])
     if index >= len(images):
         flash("Image non trouvée.")
@@ -410,9 +597,16 @@ def edit_image(index):
         new_description = request.form.get("description", "")
         new_tags = request.form.get("tags", "")
         tags_list = [tag.strip() for tag in new_tags.split(",") if tag.strip()]
-        images[index]["description"] = new_description
-        images[index]["tags"] = tags_list
-        save_user_info(username, user_info)
+        with user_transaction(username):
+            user_info, _ = get_user_info(username, ("images",))
+            images = user_info.get("images", [])
+            if index >= len(images):
+                flash("Image non trouvée.")
+                return redirect(url_for("images"))
+            images[index]["description"] = new_description
+            images[index]["tags"] = tags_list
+            save_user_info(username, user_info)
+            get_tag_index(username).index_image(images[index])
         flash("Image modifiée avec succès.")
         return redirect(url_for("images"))
     image = images[index]
@@ -423,15 +617,20 @@ def delete_image(index):
     if "username" not in session:
         return redirect(url_for("login"))
     username = session["username"]
-    user_info, _ = get_user_info(username)
-    images = user_info.get("images", [])
-    if index >= len(images):
+    image = None
+    with user_transaction(username):
+        user_info, _ = get_user_info(username, ("images",))
+        images = user_info.get("images", [])
+        if index < len(images):
+            image = images.pop(index)
+            save_user_info(username, user_info)
+            get_tag_index(username).remove_image(image.get("id"))
+    if image is None:
         flash("Image non trouvée.")
     else:
-        image = images.pop(index)
+        # Fichier supprimé une fois la fiche enregistrée
         if os.path.exists(image["path"]):
             os.remove(image["path"])
-        save_user_info(username, user_info)
         flash("Image supprimée.")
     return redirect(url_for("images"))
 
@@ -440,11 +639,11 @@ def update_tags(index):
     if "username" not in session:
         return redirect(url_for("login"))
     username = session["username"]
-    user_info, _ = get_user_info(username)
+    user_info, _ = get_user_info(username, ("images",))
     images = user_info.get("images", [])
     if index < len(images):
         from tagging import handle_image_tagging
-        result = handle_image_tagging("", user_info, username, LLaMAChat(username=username), index)
+        result = handle_image_tagging("", user_info, username, get_chatbot(username), index)
         if result:
             flash(result["content"])
         else:
@@ -453,6 +652,26 @@ def update_tags(index):
         flash("Image non trouvée.")
     return redirect(url_for("images"))
 
+@app.route("/retag_images")
+def retag_images():
+    """Lance le re-tagging de toute la photothèque en arrière-plan (lots de descriptions)."""
+    if "username" not in session:
+        return redirect(url_for("login"))
+    job_id = retag_jobs.submit(session["username"], {})
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"job_id": job_id}), 202
+    flash("Re-tagging de toutes les images lancé : les tags apparaîtront après rafraîchissement.")
+    return redirect(url_for("images"))
+
+@app.route("/retag_job/<job_id>")
+def retag_job(job_id):
+    if "username" not in session:
+        return jsonify({"error": "Non connecté"}), 401
+    job = retag_jobs.get(job_id)
+    if job is None or job["username"] != session["username"]:
+        return jsonify({"error": "Tâche inconnue"}), 404
+    return jsonify({key: job[key] for key in ("id", "status", "step", "progress", "result", "error")})
+
 @app.route("/play_description/<int:index>")
 def play_description(index):
     if "username" not in session:
@@ -470,9 +689,16 @@ def stop_tts():
 
 @app.route("/logout")
 def logout_route():
+    if "username" in session:
+        chat_sessions.discard(session["username"])
     session.clear()
     return redirect(url_for("login"))
 
+@app.route("/inference_stats")
+def inference_stats():
+    # Files d'attente et compteurs de la passerelle d'inférence, par modèle ; pool de transcription
+    return jsonify(dict(gateway.metrics(), transcription=transcription_metrics()))
+
 @app.route("/serve_image/<path:filename>")
 def serve_image(filename):
     return send_from_directory("images", filename)
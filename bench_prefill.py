@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : bench_prefill.py
+Description : Mesure du coût de prefill par tour de discussion, avant/après le préfixe stable.
+              Rejoue les derniers tours de l'historique d'un utilisateur avec :
+              - "avant" : message système contenant json.dumps de la fiche complète (dont la
+                copie horodatée de l'historique) et fenêtre glissante des 20 derniers messages ;
+              - "après" : prompt système fixe + résumé de fiche et fenêtre ancrée de
+                context_builder.py.
+              Pour chaque tour : tokens du prompt (estimation), tokens du préfixe identique au
+              tour précédent (réutilisables par le cache d'Ollama) et, sauf avec --offline,
+              prompt_eval_count / durée de prefill mesurés par Ollama (num_predict=1).
+              Usage : python bench_prefill.py <utilisateur> [nombre_de_tours] [--offline]
+"""
+
+import sys
+import json
+import datetime
+from storage import get_storage
+from context_builder import build_context, profile_digest, message_tokens, CHAT_OPTIONS, KEEP_ALIVE
+
+MODEL = "rolandroland/llama3.1-uncensored:latest"
+SYSTEM_PROMPT = (
+    "Please respond as Angel, a compassionate and supportive assistant dedicated to helping individuals with memory loss (such as dementia or Alzheimer’s) recall their cherished memories. "
+    "Your responses should be clear, concise, and secure, focusing solely on providing gentle assistance and practical guidance. "
+    "Avoid personalizing your identity or using language qui implique des liens familiaux ou des anecdotes personnelles."
+)
+
+
+def old_context(user_data: dict, history: list, prompt: str) -> list:
+    """Reproduction de l'ancien LLaMAChat._prepare_messages."""
+    # La fiche contenait la copie de l'historique, réécrite (et réhorodatée) à chaque tour
+    user_data = dict(user_data, conversation_history=[
+        {"role": m["role"], "content": m["content"], "timestamp": datetime.datetime.now().isoformat()}
+        for m in history[-20:]
+    ])
+    messages = [{"role": "system", "content": f"User information: {json.dumps(user_data)}. " + SYSTEM_PROMPT}]
+    messages += [{"role": m["role"], "content": m["content"]} for m in history]
+    messages.append({"role": "user", "content": prompt})
+    return messages[-20:]
+
+
+class NewContext:
+    def __init__(self):
+        self.anchor = None
+
+    def __call__(self, user_data: dict, history: list, prompt: str) -> list:
+        messages, kept = build_context(SYSTEM_PROMPT, history + [{"role": "user", "content": prompt}],
+                                       digest=profile_digest(user_data), anchor=self.anchor)
+        self.anchor = kept[0] if kept else None
+        return messages
+
+
+def shared_prefix_tokens(previous: list, messages: list) -> int:
+    """Tokens des messages de tête identiques au tour précédent."""
+    shared = 0
+    for a, b in zip(previous, messages):
+        if a != b:
+            break
+        shared += message_tokens(b)
+    return shared
+
+
+def run(label: str, build, user_data: dict, turns: list, offline: bool) -> None:
+    gateway = None
+    if not offline:
+        from inference import get_gateway
+        gateway = get_gateway()
+    print(f"\n== {label} ==")
+    print(f"{'tour':>4}{'tokens':>9}{'réutil.':>9}" + ("" if offline else f"{'prefill':>9}{'durée ms':>10}"))
+    previous, history, total_ms = [], [], 0.0
+    for i, (prompt, answer) in enumerate(turns, 1):
+        messages = build(user_data, history, prompt)
+        tokens = sum(message_tokens(m) for m in messages)
+        reused = shared_prefix_tokens(previous, messages)
+        measured = ""
+        if gateway is not None:
+            response = gateway.chat(MODEL, messages, options=dict(CHAT_OPTIONS, num_predict=1),
+                                    keep_alive=KEEP_ALIVE)
+            duration_ms = (response.get("prompt_eval_duration") or 0) / 1e6
+            total_ms += duration_ms
+            measured = f"{response.get('prompt_eval_count') or 0:>9}{duration_ms:>10.0f}"
+        print(f"{i:>4}{tokens:>9}{reused:>9}" + measured)
+        previous = messages
+        history += [{"role": "user", "content": prompt}, {"role": "assistant", "content": answer}]
+    if gateway is not None:
+        print(f"Prefill total : {total_ms:.0f} ms, moyenne {total_ms / max(len(turns), 1):.0f} ms/tour")
+
+
+def main(username: str, count: int = 10, offline: bool = False) -> None:
+    storage = get_storage()
+    user_data = storage.load_user(username)
+    if user_data is None:
+        print(f"[ERROR] Utilisateur inconnu : {username}")
+        return
+    messages = [m for m in storage.iter_history(username) if m.get("role") in ("user", "assistant")]
+    turns = [(m["content"], messages[i + 1]["content"]) for i, m in enumerate(messages[:-1])
+             if m["role"] == "user" and messages[i + 1]["role"] == "assistant"][-count:]
+    if not turns:
+        print(f"[ERROR] Aucun tour question/réponse dans l'historique de {username}")
+        return
+    run("avant (json.dumps + 20 derniers messages)", old_context, user_data, turns, offline)
+    run("après (préfixe stable)", NewContext(), user_data, turns, offline)
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if a != "--offline"]
+    if not args:
+        print("Usage : python bench_prefill.py <utilisateur> [nombre_de_tours] [--offline]")
+        sys.exit(1)
+    main(args[0], int(args[1]) if len(args) > 1 else 10, "--offline" in sys.argv)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : bench_records.py
+Description : Micro-benchmark du codec de records.py face au module json standard.
+              Pour chaque fiche de users/*.json, mesure le temps moyen de décodage
+              (json.loads vs decode msgspec avec valeurs par défaut) et d'encodage (json.dumps indent=4 vs
+              encode compact / indenté).
+              Usage : python bench_records.py [nombre_de_répétitions]
+"""
+
+import os
+import sys
+import json
+import timeit
+import records
+
+USERS_DIR = "users"
+
+
+def bench(func, number: int) -> float:
+    """Temps moyen d'un appel, en microsecondes."""
+    return timeit.timeit(func, number=number) / number * 1e6
+
+
+def main(number: int = 200) -> None:
+    files = sorted(f for f in os.listdir(USERS_DIR) if f.endswith(".json"))
+    print(f"{'fichier':<14}{'taille':>9}{'json.loads':>12}{'decode':>10}"
+          f"{'json.dumps':>12}{'compact':>10}{'indenté':>10}   (µs)")
+    for name in files:
+        with open(os.path.join(USERS_DIR, name), "rb") as f:
+            raw = f.read()
+        data = json.loads(raw)
+        results = [
+            bench(lambda: json.loads(raw), number),
+            bench(lambda: records.decode(raw, "user"), number),
+            bench(lambda: json.dumps(data, ensure_ascii=False, indent=4).encode("utf-8"), number),
+            bench(lambda: records.encode(data, pretty=False), number),
+            bench(lambda: records.encode(data, pretty=True), number)
+        ]
+        print(f"{name:<14}{len(raw):>9}" + "".join(f"{r:>12.1f}" if i in (0, 2) else f"{r:>10.1f}"
+                                                  for i, r in enumerate(results)))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
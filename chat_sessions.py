@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : chat_sessions.py
+Description : Pool de sessions de chat par utilisateur.
+              - Garde un chatbot "chaud" (historique et fiche déjà chargés) par utilisateur
+                actif, au lieu d'en construire un nouveau à chaque requête.
+              - Les sessions inactives depuis plus de REMEMORY_CHAT_SESSION_IDLE secondes
+                (900 par défaut) sont libérées à l'accès suivant au pool.
+              - use() tient le verrou propre à la session pendant son utilisation : deux
+                requêtes du même utilisateur ne se servent jamais du même chatbot en même
+                temps (le verrou de l'utilisateur, lui, n'est pas tenu pendant la génération).
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+IDLE_TIMEOUT = float(os.environ.get("REMEMORY_CHAT_SESSION_IDLE", "900"))
+
+
+class ChatSessionPool:
+    def __init__(self, factory, idle_timeout: float = IDLE_TIMEOUT):
+        self.factory = factory            # username -> nouvelle session
+        self.idle_timeout = idle_timeout
+        self._sessions = OrderedDict()    # username -> (session, verrou, dernier accès), du plus ancien au plus récent
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, username: str) -> tuple:
+        with self._lock:
+            self._evict_idle()
+            entry = self._sessions.pop(username, None)
+            if entry is not None:
+                self.hits += 1
+                self._sessions[username] = (entry[0], entry[1], time.monotonic())
+                return entry[:2]
+        self.misses += 1
+        session = self.factory(username)
+        with self._lock:
+            # Une autre requête a pu créer la session pendant la construction de celle-ci
+            entry = self._sessions.pop(username, None) or (session, threading.Lock(), None)
+            self._sessions[username] = (entry[0], entry[1], time.monotonic())
+        return entry[:2]
+
+    def get(self, username: str):
+        """Renvoie la session de l'utilisateur, créée au premier accès (sans la réserver)."""
+        return self._entry(username)[0]
+
+    @contextmanager
+    def use(self, username: str):
+        """Fournit la session de l'utilisateur, réservée à l'appelant pendant le bloc `with`."""
+        session, lock = self._entry(username)
+        with lock:
+            yield session
+
+    def discard(self, username: str) -> None:
+        """Oublie la session de l'utilisateur (déconnexion)."""
+        with self._lock:
+            self._sessions.pop(username, None)
+
+    def _evict_idle(self) -> None:
+        deadline = time.monotonic() - self.idle_timeout
+        while self._sessions:
+            username, (_, _, last_used) = next(iter(self._sessions.items()))
+            if last_used > deadline:
+                break
+            del self._sessions[username]
+            print(f"[DEBUG] Session de chat de {username} libérée (inactive).")
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : context_builder.py
+Description : Construction du contexte envoyé au modèle de chat, dans un budget de tokens.
+              - count_tokens() estime le nombre de tokens sans tokenizer externe (mots découpés
+                par tranches d'environ 4 caractères, ponctuation comptée à part) : l'estimation
+                est volontairement un peu pessimiste pour ne jamais dépasser la fenêtre.
+              - profile_digest() résume la fiche (nom, ton, langue, préférences, derniers résumés,
+                tags des photos) en quelques lignes au lieu de la fiche JSON complète.
+              - Les souvenirs retrouvés pour la question (memory_index.py) sont placés juste
+                avant le dernier message, dans une taille fixe (REMEMORY_MEMORY_TOKENS, 400).
+              - build_context() place toujours le message système en tête, puis autant de
+                messages récents que le budget le permet (le dernier message est toujours gardé,
+                tronqué si nécessaire). Le début de la fenêtre ne glisse pas à chaque tour :
+                le préfixe envoyé reste identique et Ollama réutilise son calcul (voir
+                bench_prefill.py).
+              Fenêtre du modèle : REMEMORY_CONTEXT_TOKENS (4096 par défaut), dont
+              REMEMORY_REPLY_TOKENS (512) réservés à la réponse.
+"""
+
+import os
+import re
+
+CONTEXT_TOKENS = int(os.environ.get("REMEMORY_CONTEXT_TOKENS", "4096"))
+REPLY_TOKENS = int(os.environ.get("REMEMORY_REPLY_TOKENS", "512"))
+PROMPT_BUDGET = CONTEXT_TOKENS - REPLY_TOKENS
+DIGEST_TOKENS = int(os.environ.get("REMEMORY_DIGEST_TOKENS", "400"))
+MEMORY_TOKENS = int(os.environ.get("REMEMORY_MEMORY_TOKENS", "400"))
+# Part du budget remplie quand la fenêtre doit être reconstruite
+REFILL_RATIO = float(os.environ.get("REMEMORY_CONTEXT_REFILL", "0.6"))
+# Durée pendant laquelle Ollama garde le modèle (et son cache de préfixe) en mémoire
+KEEP_ALIVE = os.environ.get("REMEMORY_KEEP_ALIVE", "30m")
+
+# Coût fixe d'un message (rôle et balises du modèle de chat)
+MESSAGE_OVERHEAD = 4
+CHARS_PER_TOKEN = 4
+
+# Options Ollama correspondantes : la fenêtre est fixée explicitement
+CHAT_OPTIONS = {"num_ctx": CONTEXT_TOKENS}
+
+_PIECE = re.compile(r"\w+|[^\w\s]")
+
+
+def _piece_tokens(piece: str) -> int:
+    return 1 + (len(piece) - 1) // CHARS_PER_TOKEN
+
+
+def count_tokens(text: str) -> int:
+    """Estimation hors ligne du nombre de tokens d'un texte."""
+    return sum(_piece_tokens(m.group()) for m in _PIECE.finditer(text or ""))
+
+
+def message_tokens(message: dict) -> int:
+    return MESSAGE_OVERHEAD + count_tokens(message.get("content", ""))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Coupe le texte après environ `max_tokens` tokens."""
+    total = 0
+    for m in _PIECE.finditer(text):
+        total += _piece_tokens(m.group())
+        if total > max_tokens:
+            return text[:m.start()].rstrip() + " [...]"
+    return text
+
+
+def profile_digest(user_data: dict, max_tokens: int = DIGEST_TOKENS, memories: bool = True) -> str:
+    """
+    Résumé compact et stable de la fiche utilisateur, borné à `max_tokens`. Avec
+    memories=False (index des souvenirs disponible, voir memory_index.py), le résumé reste
+    minimal mais garde toujours les préférences et le dernier résumé de conversation : la
+    recherche de souvenirs peut ne rien trouver, le profil ne doit pas disparaître du prompt.
+    Les autres résumés et les tags des photos sont alors fournis par build_context(memories=...).
+    """
+    lines = []
+    if user_data.get("nom"):
+        lines.append(f"Name: {user_data['nom']}")
+    if user_data.get("ton"):
+        lines.append(f"Preferred tone: {user_data['ton']}")
+    if user_data.get("language"):
+        lines.append(f"Language: {user_data['language']}")
+    preferences = user_data.get("preferences") or {}
+    if preferences:
+        lines.append("Preferences:")
+        lines.extend(f"- {question} {answer}" for question, answer in preferences.items())
+    summaries = [s.get("resumer", "") for s in user_data.get("conversation_resumer") or []
+                 if s.get("resumer")]
+    if not memories:
+        summaries = summaries[-1:]
+    if summaries:
+        lines.append("Previous conversations:")
+        lines.extend(f"- {summary}" for summary in reversed(summaries))
+    images = user_data.get("images") or []
+    if images and not memories:
+        lines.append(f"Photos: {len(images)}")
+    elif images:
+        tags = []
+        for image in reversed(images):
+            for tag in image.get("tags", []):
+                if tag not in tags:
+                    tags.append(tag)
+        lines.append(f"Photos: {len(images)}" + (f" (tags: {', '.join(tags)})" if tags else ""))
+
+    digest, used = [], 0
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if used + cost > max_tokens:
+            break
+        digest.append(line)
+        used += cost
+    return "\n".join(digest)
+
+
+def _message_key(message: dict) -> tuple:
+    # Indépendant de l'identifiant, attribué seulement à l'enregistrement
+    return (message.get("role"), message.get("content", ""))
+
+
+def _newest_fitting(turns: list, limit: int) -> list:
+    """Messages les plus récents tenant dans `limit` (au moins le dernier)."""
+    used, start = 0, len(turns)
+    while start > 0:
+        cost = message_tokens(turns[start - 1])
+        if used + cost > limit and start < len(turns):
+            break
+        used += cost
+        start -= 1
+    return turns[start:]
+
+
+def build_context(system_prompt: str, history: list, budget: int = PROMPT_BUDGET, digest: str = "",
+                  anchor: dict = None, memories: str = "") -> tuple:
+    """
+    Construit la liste de messages pour le modèle : le message système (avec le résumé de
+    fiche) puis les messages user/assistant récents qui tiennent dans `budget`.
+    Pour que le début du contexte reste identique d'un tour à l'autre (et que le modèle
+    réutilise le calcul du préfixe), la fenêtre commence au message `anchor` du tour
+    précédent tant qu'elle tient dans le budget ; sinon, elle est reconstruite sur une
+    fraction du budget (REMEMORY_CONTEXT_REFILL) pour laisser de la place aux tours suivants.
+    `memories` (souvenirs retrouvés pour la question) est placé juste avant le dernier
+    message, après le préfixe stable, puisqu'il change à chaque tour.
+    Renvoie (messages, conservés) où `conservés` est la partie de `history` retenue
+    (objets d'origine, pour l'enregistrement).
+    """
+    system_content = system_prompt + (f"\n\nUser profile:\n{digest}" if digest else "")
+    system_msg = {"role": "system", "content": system_content}
+    memory_msg = {"role": "system", "content": f"Relevant memories:\n{memories}"} if memories else None
+    remaining = budget - message_tokens(system_msg) - (message_tokens(memory_msg) if memory_msg else 0)
+
+    turns = [msg for msg in history if msg.get("role") in ("user", "assistant")]
+    kept = None
+    if anchor is not None:
+        key = _message_key(anchor)
+        for i, msg in enumerate(turns):
+            if _message_key(msg) == key:
+                if sum(message_tokens(m) for m in turns[i:]) <= remaining:
+                    kept = turns[i:]
+                break
+    if kept is None:
+        kept = _newest_fitting(turns, int(remaining * REFILL_RATIO))
+
+    packed = [{"role": msg["role"], "content": msg.get("content", "")} for msg in kept]
+    used = sum(message_tokens(msg) for msg in packed)
+    if packed and used > remaining:
+        # Le dernier message est toujours envoyé, quitte à être tronqué
+        others = used - message_tokens(packed[-1])
+        packed[-1]["content"] = truncate_to_tokens(packed[-1]["content"],
+                                                   max(remaining - others - MESSAGE_OVERHEAD, 0))
+        used = others + message_tokens(packed[-1])
+    print(f"[DEBUG] Contexte : {len(packed)} message(s), ~{budget - remaining + used} tokens "
+          f"(budget {budget}).")
+    if memory_msg and packed:
+        packed.insert(len(packed) - 1, memory_msg)
+    return [system_msg] + packed, kept
@@ -3,23 +3,65 @@
 """
 Fichier : data_preparer.py
 Description :
-  - Lit l’historique de conversation depuis historique/<Username>.json
-    et la fiche utilisateur depuis users/<Username>.json (fusionne plusieurs fichiers s'ils existent).
-  - Génère un résumé de la conversation actuelle via l’IA (format JSON strict).
+  - Lit l’historique de conversation et la fiche utilisateur via le backend de stockage
+    configuré (storage.py : fichiers JSON par défaut, ou SQLite).
+    Avec le stockage JSON, fusionne plusieurs fichiers users/<Username>*.json s'ils existent.
+  - Génère un résumé des seuls messages arrivés depuis le dernier résumé via l’IA (format JSON
+    strict). Le repère (identifiant du dernier message résumé) est gardé dans
+    preparer_state/<Username>.json ; sans nouveau message, aucun appel à l’IA n’est fait.
+  - Résumé hiérarchique (map-reduce) : les messages sont découpés en blocs d'au plus
+    REMEMORY_SUMMARY_CHUNK_TOKENS tokens (2500), résumés en parallèle (REMEMORY_SUMMARY_WORKERS,
+    2 par défaut), puis les résumés partiels sont fusionnés, par groupes tenant dans la même
+    limite, jusqu'à un seul résumé. Le prompt d'un bloc ne dépend que de son contenu : le cache
+    des réponses (response_cache.py) évite de résumer à nouveau un bloc déjà traité.
   - Ajoute le nouveau résumé à la liste "conversation_resumer", afin de conserver tous les résumés.
-  - Sauvegarde la fiche utilisateur mise à jour (ainsi qu’un fichier RAG).
+  - Sauvegarde la fiche utilisateur mise à jour (ainsi qu’un fichier RAG) et tient à jour
+    l'index des souvenirs utilisé par le chat (memory_index.py).
   - IMPORTANT : L’historique n’est PAS supprimé afin de conserver toutes les informations.
-  - Ce processus se répète toutes les 1 minute.
+  - Ce processus se répète toutes les 1 à 3 minutes.
 """
 
 import os
 import json
 import datetime
 import time
-from ollama import Client  # Client pour communiquer avec l'IA
+from concurrent.futures import ThreadPoolExecutor
+from inference import get_gateway, BACKGROUND  # Passerelle partagée vers Ollama
+import records
+from unit_of_work import atomic_write_json
+from storage import get_storage, default_user_record, JsonStorage, canonical_username
+from user_locks import user_lock, LockTimeout
+from memory_index import update_user_index
+from context_builder import count_tokens, message_tokens, truncate_to_tokens, CHAT_OPTIONS
 
-# Configuration du client IA
-client = Client(host='http://127.0.0.1:11434')
+# Repères de résumé (dernier message résumé) par utilisateur
+STATE_DIR = os.environ.get("REMEMORY_PREPARER_STATE_DIR", "preparer_state")
+
+# Résumé hiérarchique : taille des blocs (le prompt et la réponse doivent tenir dans num_ctx)
+SUMMARY_MODEL = "rolandroland/llama3.1-uncensored:latest"
+SUMMARY_CHUNK_TOKENS = int(os.environ.get("REMEMORY_SUMMARY_CHUNK_TOKENS", "2500"))
+SUMMARY_WORKERS = int(os.environ.get("REMEMORY_SUMMARY_WORKERS", "2"))
+
+# Passerelle IA : les résumés passent après les requêtes interactives
+gateway = get_gateway()
+
+
+def chunk_by_tokens(items: list, size, max_tokens: int = SUMMARY_CHUNK_TOKENS) -> list:
+    """
+    Découpe `items` en blocs consécutifs d'au plus `max_tokens` tokens (`size(item)`).
+    Un élément trop gros à lui seul forme son propre bloc.
+    """
+    chunks, current, total = [], [], 0
+    for item in items:
+        tokens = size(item)
+        if current and total + tokens > max_tokens:
+            chunks.append(current)
+            current, total = [], 0
+        current.append(item)
+        total += tokens
+    if current:
+        chunks.append(current)
+    return chunks
 
 
 def merge_user_files(username: str) -> dict:
@@ -35,10 +77,9 @@ def merge_user_files(username: str) -> dict:
                     if f.lower().startswith(username.lower()) and f.endswith(".json")])
     print(f"[DEBUG] Fichiers trouvés pour fusionner pour '{username}': {files}")
     for file in files:
-        path = os.path.join(user_dir, file)
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            # Chargement de toutes les sections de la fiche (users/<nom>.json + users/<nom>/)
+            data = JsonStorage().load_user(file.rsplit(".", 1)[0]) or {}
             print(f"[DEBUG] Lecture réussie de {file}.")
             if "preferences" in data and isinstance(data["preferences"], dict):
                 merged["preferences"].update(data["preferences"])
@@ -55,55 +96,70 @@ def merge_user_files(username: str) -> dict:
 
 class DataPreparer:
     def __init__(self, username: str):
-        # Normalisation : première lettre en majuscule, le reste en minuscules
-        self.username = username.capitalize()
+        # Même nom que l'application (voir storage.canonical_username)
+        self.username = canonical_username(username)
         print(f"[DEBUG] Nom d'utilisateur normalisé: {self.username}")
-        self.history_path = f"historique/{self.username}.json"
-        self.user_info_path = f"users/{self.username}.json"
+        self.storage = get_storage()
         self.rag_output_path = f"rag_data/{self.username}_rag.json"
         os.makedirs("rag_data", exist_ok=True)
+        self.state_path = os.path.join(STATE_DIR, f"{self.username}.json")
+
+    def load_state(self) -> dict:
+        """Repère du dernier message résumé : {"last_id": ..., "summarized": nombre de messages}."""
+        try:
+            with open(self.state_path, "rb") as f:
+                return records.decode(f.read())
+        except FileNotFoundError:
+            return {"last_id": None, "summarized": 0}
+        except (OSError, records.DecodeError) as e:
+            print(f"[ERROR] Repère de résumé illisible ({e}) : tout l'historique sera résumé.")
+            return {"last_id": None, "summarized": 0}
+
+    def save_state(self, state: dict) -> None:
+        atomic_write_json(self.state_path, state)
+
+    def load_new_messages(self, state: dict) -> list:
+        """Messages ajoutés depuis le dernier résumé."""
+        with user_lock(self.username, "r"):
+            messages = [msg for msg in self.storage.iter_history_since(self.username, state.get("last_id"))
+                        if msg.get("id")]
+        print(f"[DEBUG] {len(messages)} nouveau(x) message(s) depuis le dernier résumé.")
+        return messages
 
     def load_history(self) -> list:
-        if os.path.exists(self.history_path):
-            print(f"[DEBUG] Fichier d'historique trouvé: {self.history_path}")
-            try:
-                with open(self.history_path, "r", encoding="utf-8") as f:
-                    history = json.load(f)
-                    if isinstance(history, list):
-                        print(f"[DEBUG] Historique chargé avec {len(history)} messages.")
-                        return history
-            except Exception as e:
-                print(f"[ERROR] Erreur lors de la lecture de l'historique: {e}")
+        with user_lock(self.username, "r"):
+            # Parcours segment par segment de tout l'historique (archives froides comprises)
+            history = list(self.storage.iter_history(self.username))
+        if history:
+            print(f"[DEBUG] Historique chargé avec {len(history)} messages.")
         else:
-            print(f"[DEBUG] Aucun fichier d'historique trouvé pour {self.username}.")
-        return []
+            print(f"[DEBUG] Aucun historique trouvé pour {self.username}.")
+        return history
 
     def load_user_info(self) -> dict:
-        if os.path.exists(self.user_info_path):
-            print(f"[DEBUG] Fichier utilisateur trouvé: {self.user_info_path}")
-            try:
-                with open(self.user_info_path, "r", encoding="utf-8") as f:
-                    user_info = json.load(f)
-                user_info.setdefault("preferences", {})
-                user_info.setdefault("images", [])
-                user_info.setdefault("conversation_history", [])
-                user_info.setdefault("conversation_resumer", [])
+        try:
+            with user_lock(self.username, "r"):
+                user_info = self.storage.load_user(self.username)
+            if user_info is not None:
                 print("[DEBUG] Fiche utilisateur chargée.")
                 return user_info
-            except Exception as e:
-                print(f"[ERROR] Erreur lors de la lecture de la fiche utilisateur: {e}")
-        else:
-            print(f"[DEBUG] Aucun fichier utilisateur trouvé pour {self.username}. Création d'une fiche par défaut.")
-        return {"nom": self.username, "preferences": {}, "images": [],
-                "conversation_history": [], "conversation_resumer": []}
+            print(f"[DEBUG] Aucune fiche utilisateur trouvée pour {self.username}. Création d'une fiche par défaut.")
+        except Exception as e:
+            print(f"[ERROR] Erreur lors de la lecture de la fiche utilisateur: {e}")
+        return default_user_record(self.username)
 
-    def prepare_prompt(self, history: list, user_info: dict) -> str:
-        current_date = datetime.datetime.now().strftime("%Y-%m-%d")
-        history_text = "\n".join([f"{msg['role']}: {msg['content']}"
+    def prepare_prompt(self, history: list, user_info: dict = None) -> str:
+        """
+        Prompt de résumé d'un bloc de messages. La date est celle des messages (et non celle du
+        jour) pour que le prompt d'un bloc, et donc son entrée dans le cache, ne change pas.
+        """
+        timestamps = [msg["timestamp"] for msg in history if msg.get("timestamp")]
+        messages_date = timestamps[0][:10] if timestamps else datetime.datetime.now().strftime("%Y-%m-%d")
+        history_text = "\n".join([f"{msg['role']}: {truncate_to_tokens(msg['content'], SUMMARY_CHUNK_TOKENS)}"
                                   for msg in history if "role" in msg and "content" in msg])
         prompt = (
-            f"Date actuelle : {current_date}\n\n"
-            "Voici l'historique complet de notre conversation:\n"
+            f"Date des messages : {messages_date}\n\n"
+            "Voici les derniers messages de notre conversation:\n"
             f"{history_text}\n\n"
             "Résume uniquement les informations importantes, telles que les événements marquants, les résultats obtenus, "
             "et les points clés qui pourraient aider à se remémorer la conversation. Veuillez conserver le maximum de détails importants. "
@@ -111,16 +167,32 @@ class DataPreparer:
             "Le résumé doit être retourné sous forme d'une liste d'objets JSON, chaque objet ayant exactement deux clés : "
             "'role' et 'content'. Ne renvoyez aucun texte additionnel."
         )
-        print("[DEBUG] Prompt généré pour résumé:")
-        print(prompt)
+        print(f"[DEBUG] Prompt de résumé généré ({count_tokens(prompt)} tokens environ).")
+        return prompt
+
+    def prepare_reduce_prompt(self, partial_summaries: list) -> str:
+        """Prompt de fusion de résumés partiels successifs en un seul résumé."""
+        parts_text = "\n".join(f"Partie {i} : {text}" for i, text in enumerate(partial_summaries, 1))
+        prompt = (
+            "Voici, dans l'ordre chronologique, les résumés partiels d'une même conversation:\n"
+            f"{parts_text}\n\n"
+            "Fusionne-les en un seul résumé qui conserve les événements marquants, les résultats obtenus "
+            "et les points clés, sans répétition. "
+            "Le résumé doit être retourné sous forme d'une liste d'objets JSON, chaque objet ayant exactement deux clés : "
+            "'role' et 'content'. Ne renvoyez aucun texte additionnel."
+        )
+        print(f"[DEBUG] Prompt de fusion généré pour {len(partial_summaries)} résumé(s) partiel(s).")
         return prompt
 
     def call_ai_summarizer(self, prompt: str) -> list:
         try:
             print("[DEBUG] Envoi du prompt à l'IA pour résumé...")
-            response = client.chat(
-                model="rolandroland/llama3.1-uncensored:latest",
-                messages=[{"role": "user", "content": prompt}]
+            response = gateway.chat(
+                SUMMARY_MODEL,
+                [{"role": "user", "content": prompt}],
+                priority=BACKGROUND,
+                cache=True,
+                options=CHAT_OPTIONS
             )
             summary_text = response['message']['content']
             print("[DEBUG] Réponse de l'IA reçue:")
@@ -140,13 +212,19 @@ class DataPreparer:
             return []
 
     def save_user_info(self, user_info: dict) -> None:
-        with open(self.user_info_path, "w", encoding="utf-8") as f:
-            json.dump(user_info, f, ensure_ascii=False, indent=4)
-        print(f"[DEBUG] Fiche utilisateur mise à jour dans {self.user_info_path}")
+        with user_lock(self.username, "w"):
+            self.storage.save_user(self.username, user_info)
+        print(f"[DEBUG] Fiche utilisateur de {self.username} mise à jour ({self.storage.name}).")
+
+    def update_memory_index(self, user_info: dict) -> None:
+        """Ajoute à l'index des souvenirs (memory_index.py) les résumés, photos et préférences nouveaux."""
+        try:
+            update_user_index(self.username, user_info)
+        except Exception as e:
+            print(f"[ERROR] Mise à jour de l'index des souvenirs impossible : {e}")
 
     def save_rag_data(self, data: dict) -> None:
-        with open(self.rag_output_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        atomic_write_json(self.rag_output_path, data)
         print(f"[DEBUG] Données préparées sauvegardées dans {self.rag_output_path}")
 
     # La suppression de l'historique est désactivée pour conserver toutes les informations
@@ -155,70 +233,124 @@ class DataPreparer:
     #         json.dump([], f)
     #     print(f"[DEBUG] L'historique {self.history_path} a été vidé.")
 
-    def update_conversation_history_summary(self, user_info: dict, history: list) -> dict:
-        prompt = self.prepare_prompt(history, user_info)
+    def _summary_text(self, prompt: str) -> str:
         summary_list = self.call_ai_summarizer(prompt)
-        new_summary_text = " ".join([item["content"] for item in summary_list if "content" in item]).strip()
+        return " ".join([item["content"] for item in summary_list if "content" in item]).strip()
+
+    def _summarize_all(self, prompts: list) -> list:
+        """Résume les prompts en parallèle (ordre conservé) ; liste vide si l'un d'eux échoue."""
+        if len(prompts) == 1:
+            texts = [self._summary_text(prompts[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix="summary") as executor:
+                texts = list(executor.map(self._summary_text, prompts))
+        if not all(texts):
+            print("[ERROR] Au moins un résumé partiel est vide : résumé abandonné pour ce cycle.")
+            return []
+        return texts
+
+    def summarize_history(self, history: list) -> str:
+        """
+        Map : un résumé par bloc de messages. Reduce : fusion des résumés partiels, par groupes
+        tenant dans SUMMARY_CHUNK_TOKENS, jusqu'à n'en garder qu'un. Renvoie "" en cas d'échec.
+        """
+        chunks = chunk_by_tokens([msg for msg in history if "role" in msg and "content" in msg],
+                                 message_tokens)
+        if not chunks:
+            return ""
+        print(f"[DEBUG] Résumé de {len(history)} message(s) en {len(chunks)} bloc(s).")
+        parts = self._summarize_all([self.prepare_prompt(chunk) for chunk in chunks])
+        while len(parts) > 1:
+            groups = chunk_by_tokens(parts, count_tokens)
+            if len(groups) == len(parts):
+                # Résumés trop longs pour être regroupés : fusion de tous en une fois
+                groups = [parts]
+            print(f"[DEBUG] Fusion de {len(parts)} résumé(s) partiel(s) en {len(groups)}.")
+            parts = self._summarize_all([self.prepare_reduce_prompt(group) for group in groups])
+        return parts[0] if parts else ""
+
+    def update_conversation_history_summary(self, user_info: dict, history: list) -> dict:
+        new_summary_text = self.summarize_history(history)
         if not new_summary_text:
             print("[DEBUG] Aucun nouveau résumé généré pour cette session.")
             return user_info
 
-        # Ajoute le nouveau résumé dans la clé "conversation_resumer" sans supprimer les précédents
-        if "conversation_resumer" not in user_info or not isinstance(user_info["conversation_resumer"], list):
-            user_info["conversation_resumer"] = []
-        user_info["conversation_resumer"].append({"resumer": new_summary_text})
-        self.save_user_info(user_info)
+        # Ajoute le nouveau résumé dans "conversation_resumer" sans supprimer les précédents.
+        # Ajout ponctuel : la fiche n'est pas réécrite (évite d'écraser les modifications de l'application)
+        with user_lock(self.username, "w"):
+            self.storage.add_summary(self.username, new_summary_text)
         print("[DEBUG] Nouveau résumé ajouté dans 'conversation_resumer' de la fiche utilisateur.")
-        return user_info
+        return self.load_user_info()
+
+    def run_cycle(self) -> bool:
+        """
+        Résume les messages arrivés depuis le dernier passage (un appel au modèle par bloc,
+        plus les fusions) et avance le repère. Renvoie False, sans appel au modèle, s'il n'y a rien de nouveau.
+        """
+        state = self.load_state()
+        new_messages = self.load_new_messages(state)
+        user_info = self.load_user_info()
+        if not new_messages:
+            print("[DEBUG] Aucun nouveau message, pas de résumé.")
+            self.update_memory_index(user_info)
+            return False
+        updated = self.update_conversation_history_summary(user_info, new_messages)
+        if updated is user_info:  # fiche inchangée : aucun résumé obtenu
+            print("[ERROR] Échec de la mise à jour via l'IA.")
+            self.update_memory_index(user_info)
+            return False
+        self.save_rag_data(updated)
+        self.update_memory_index(updated)
+        self.save_state({"last_id": new_messages[-1]["id"],
+                         "summarized": state.get("summarized", 0) + len(new_messages)})
+        return True
 
     def run_preparation(self) -> None:
         while True:
             print("\n=== Début de la mise à jour ===")
-            history = self.load_history()
-            if not history:
-                print("[DEBUG] L'historique est vide, aucune mise à jour effectuée.")
-                time.sleep(60)
-                continue
-            user_info = self.load_user_info()
-            print(f"[DEBUG] Historique lu: {len(history)} messages.")
-            prompt = self.prepare_prompt(history, user_info)
-            summary_result = self.call_ai_summarizer(prompt)
-            if summary_result:
-                print("[DEBUG] Résumé obtenu avec succès.")
-                user_info = self.update_conversation_history_summary(user_info, history)
-                self.save_rag_data(user_info)
-            else:
-                print("[ERROR] Échec de la mise à jour via l'IA.")
+            try:
+                updated = self.run_cycle()
+            except LockTimeout as e:
+                # L'application tient le verrou de l'utilisateur : on réessaiera au prochain cycle
+                print(f"[ERROR] {e}")
+                updated = False
             # Ne pas vider l'historique pour conserver toutes les informations
-            print("=== Mise à jour terminée. Attente d'une minute avant la prochaine exécution... ===")
-            time.sleep(180)
+            print("=== Mise à jour terminée. Attente avant la prochaine exécution... ===")
+            time.sleep(180 if updated else 60)
+
+
+def merge_legacy_user_files(username: str) -> None:
+    """Avec le stockage JSON, fusionne les fichiers users/<Username>*.json s'il y en a plusieurs."""
+    user_dir = "users"
+    username = canonical_username(username)
+    storage = get_storage()
+    if storage.name == "json" and os.path.exists(user_dir):
+        user_files = [f for f in os.listdir(user_dir)
+                      if f.lower().startswith(username.lower()) and f.endswith(".json")]
+        if len(user_files) > 1:
+            print(f"[DEBUG] Plusieurs fichiers trouvés pour '{username}'. Fusion en cours...")
+            with user_lock(username, "w"):
+                merged_data = merge_user_files(username)
+                storage.save_user(username, merged_data)
+            print(f"[DEBUG] Fiche fusionnée sauvegardée pour {username}")
 
 
 if __name__ == "__main__":
+    # Préparation d'un seul utilisateur (l'application utilise preparer_service.py)
     import sys
-    user_dir = "users"
     username = None
+    storage = get_storage()
     if len(sys.argv) > 1:
         username = sys.argv[1]
     else:
-        if os.path.exists(user_dir):
-            files = sorted([f for f in os.listdir(user_dir) if f.endswith(".json")])
-            if files:
-                username = files[0].rsplit(".", 1)[0]
-                print(f"[DEBUG] Fichier utilisateur détecté automatiquement : {files[0]}")
+        users = storage.list_users()
+        if users:
+            username = users[0]
+            print(f"[DEBUG] Utilisateur détecté automatiquement : {username}")
     if not username:
         username = "guest"
-    username = username.capitalize()
+    username = canonical_username(username)
     print(f"[DEBUG] Utilisateur détecté : {username}")
-    if os.path.exists(user_dir):
-        user_files = [f for f in os.listdir(user_dir)
-                      if f.lower().startswith(username.lower()) and f.endswith(".json")]
-        if len(user_files) > 1:
-            print(f"[DEBUG] Plusieurs fichiers trouvés pour '{username}'. Fusion en cours...")
-            merged_data = merge_user_files(username)
-            merged_file_path = os.path.join(user_dir, f"{username}.json")
-            with open(merged_file_path, "w", encoding="utf-8") as f:
-                json.dump(merged_data, f, ensure_ascii=False, indent=4)
-            print(f"[DEBUG] Fichier fusionné sauvegardé sous {merged_file_path}")
+    merge_legacy_user_files(username)
     preparer = DataPreparer(username)
     preparer.run_preparation()
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : history_store.py
+Description : Journal de conversation en ajout seul (append-only) au format JSONL.
+              - Chaque message est stocké sur une ligne de historique/<username>.jsonl
+                avec un identifiant stable ("id") et un horodatage.
+              - Un tour de conversation n'ajoute que ses nouveaux messages (ceux qui n'ont
+                pas encore d'identifiant) : le coût d'écriture ne dépend plus de la taille
+                de l'historique.
+              - Les anciens fichiers historique/<username>.json sont migrés au premier ajout,
+                sous le verrou "w" de l'utilisateur ; d'ici là, les lectures (verrou "r") les
+                lisent sans rien écrire, avec les mêmes identifiants que ceux de la migration.
+                L'outil de compaction (voir __main__) migre et répare les fichiers existants en
+                supprimant les blocs de messages dupliqués.
+              - Pendant une requête, les ajouts sont regroupés par l'unité de travail
+                (unit_of_work.py) et écrits en une seule fois à la fin.
+              - Segmentation : historique/<username>.jsonl n'est que la partie "chaude"
+                (les messages récents). Quand il dépasse HOT_MAX_BYTES, les messages les plus
+                anciens sont archivés en segments compressés de SEGMENT_SIZE messages dans
+                historique/<username>/ (000001.jsonl.gz, ...), décrits par index.json
+                (nombre de messages, premier/dernier id, plage horaire). Les routes ne lisent
+                que la partie chaude (load_tail) ; les résumés parcourent les segments à la
+                demande (iter_history).
+"""
+
+import os
+import gzip
+import uuid
+import hashlib
+import tempfile
+import datetime
+import unit_of_work
+import records
+from user_locks import user_lock
+
+HISTORY_DIR = "historique"
+
+# Taille d'un segment froid (en messages), seuil de la partie chaude et messages gardés chauds
+SEGMENT_SIZE = int(os.environ.get("REMEMORY_HISTORY_SEGMENT_SIZE", "200"))
+HOT_MAX_BYTES = int(os.environ.get("REMEMORY_HISTORY_HOT_MAX_KB", "256")) * 1024
+HOT_KEEP = int(os.environ.get("REMEMORY_HISTORY_HOT_KEEP", "50"))
+
+# Rôles conservés dans le journal (le message "system" contient la fiche utilisateur complète)
+PERSISTED_ROLES = ("assistant", "user", "system_question")
+# Les questions de préférences sont affichées avec l'avatar de l'assistant
+STORED_ROLES = {"system_question": "assistant"}
+
+
+def history_path(username: str) -> str:
+    return os.path.join(HISTORY_DIR, f"{username}.jsonl")
+
+
+def legacy_history_path(username: str) -> str:
+    return os.path.join(HISTORY_DIR, f"{username}.json")
+
+
+def segments_dir(username: str) -> str:
+    return os.path.join(HISTORY_DIR, username)
+
+
+def segment_index_path(username: str) -> str:
+    return os.path.join(segments_dir(username), "index.json")
+
+
+def new_message_id() -> str:
+    return uuid.uuid4().hex
+
+
+def _read_jsonl(path: str) -> list:
+    messages = []
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                messages.append(records.decode(line, "message"))
+            except records.DecodeError:
+                # Une ligne tronquée (arrêt brutal pendant l'écriture) est ignorée
+                print(f"[ERROR] Ligne illisible ignorée dans {path}")
+    return messages
+
+
+def _write_jsonl(path: str, messages: list) -> None:
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=".jsonl")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for msg in messages:
+                f.write(records.encode_line(msg))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def dedup_messages(messages: list, min_run: int = 2) -> list:
+    """
+    Supprime les blocs de messages (d'au moins `min_run` messages consécutifs) qui répètent
+    un bloc déjà présent plus haut dans l'historique. Les répétitions isolées d'un seul
+    message (ex. "coucou") sont conservées.
+    """
+    def key(msg):
+        return (msg.get("role"), msg.get("content"))
+
+    kept = []
+    positions = {}
+    i = 0
+    while i < len(messages):
+        k = key(messages[i])
+        best = 0
+        for j in positions.get(k, []):
+            length = 0
+            while (i + length < len(messages) and j + length < len(kept)
+                   and key(messages[i + length]) == key(kept[j + length])):
+                length += 1
+            best = max(best, length)
+        if best >= min_run:
+            i += best
+            continue
+        positions.setdefault(k, []).append(len(kept))
+        kept.append(messages[i])
+        i += 1
+    return kept
+
+
+def _normalize(messages: list) -> list:
+    # Identifiant déduit de la position et du contenu : une lecture de l'ancien fichier avant
+    # sa migration donne les mêmes identifiants que la migration
+    normalized = []
+    for msg in messages:
+        if not isinstance(msg, dict) or "role" not in msg or "content" not in msg:
+            continue
+        entry = dict(msg)
+        if not entry.get("id"):
+            content = f"{len(normalized)}\n{entry['role']}\n{entry['content']}"
+            entry["id"] = hashlib.sha1(content.encode("utf-8")).hexdigest()[:32]
+        normalized.append(entry)
+    return normalized
+
+
+def _read_legacy(username: str) -> list:
+    """Messages de l'ancien fichier <username>.json, dédupliqués (lecture seule)."""
+    legacy_path = legacy_history_path(username)
+    try:
+        with open(legacy_path, "rb") as f:
+            legacy = records.decode(f.read(), "history")
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        print(f"[ERROR] Erreur lors de la lecture de {legacy_path}: {e}")
+        return []
+    return _normalize(dedup_messages(legacy)) if isinstance(legacy, list) else []
+
+
+def compact_history(username: str) -> int:
+    """
+    Réécrit une fois pour toutes l'historique de l'utilisateur au format JSONL dédupliqué.
+    L'ancien fichier JSON (s'il existe) est conservé sous <username>.json.bak.
+    À appeler sous le verrou "w" de l'utilisateur. Retourne le nombre de messages conservés.
+    """
+    path = history_path(username)
+    legacy_path = legacy_history_path(username)
+    messages = _read_legacy(username)
+    index = load_segment_index(username)
+    cold_files = [entry["file"] for entry in index]
+    for entry in index:
+        messages.extend(read_segment(username, entry))
+    if os.path.exists(path):
+        messages.extend(_read_jsonl(path))
+    compacted = _normalize(dedup_messages(messages))
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    # Tout est réécrit dans la partie chaude, puis réarchivé en segments
+    _write_jsonl(path, compacted)
+    for name in cold_files:
+        os.remove(os.path.join(segments_dir(username), name))
+    if cold_files:
+        unit_of_work.atomic_write_json(segment_index_path(username), [])
+    roll_segments(username)
+    if os.path.exists(legacy_path):
+        os.replace(legacy_path, legacy_path + ".bak")
+    print(f"[DEBUG] Historique de {username} compacté : {len(messages)} -> {len(compacted)} messages.")
+    return len(compacted)
+
+
+def load_segment_index(username: str) -> list:
+    """Index des segments froids, du plus ancien au plus récent."""
+    path = segment_index_path(username)
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        return records.decode(f.read())
+
+
+def read_segment(username: str, entry: dict) -> list:
+    """Décompresse et renvoie les messages d'un segment froid."""
+    with gzip.open(os.path.join(segments_dir(username), entry["file"]), "rb") as f:
+        return [records.decode(line, "message") for line in f if line.strip()]
+
+
+def roll_segments(username: str) -> int:
+    """
+    Archive les messages anciens de la partie chaude en segments compressés de SEGMENT_SIZE
+    messages, en gardant au moins HOT_KEEP messages chauds. À appeler sous le verrou "w" de
+    l'utilisateur. Retourne le nombre de segments créés.
+    """
+    path = history_path(username)
+    if not os.path.exists(path):
+        return 0
+    hot = _read_jsonl(path)
+    count = (len(hot) - HOT_KEEP) // SEGMENT_SIZE
+    if count <= 0:
+        return 0
+    directory = segments_dir(username)
+    os.makedirs(directory, exist_ok=True)
+    index = load_segment_index(username)
+    for n in range(count):
+        chunk = hot[n * SEGMENT_SIZE:(n + 1) * SEGMENT_SIZE]
+        name = f"{len(index) + 1:06d}.jsonl.gz"
+        tmp_path = os.path.join(directory, f".tmp_{name}")
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(b"".join(records.encode_line(msg) for msg in chunk))
+        os.replace(tmp_path, os.path.join(directory, name))
+        index.append({
+            "file": name,
+            "count": len(chunk),
+            "first_id": chunk[0].get("id"),
+            "last_id": chunk[-1].get("id"),
+            "start": chunk[0].get("timestamp"),
+            "end": chunk[-1].get("timestamp")
+        })
+    # L'index est écrit avant de raccourcir la partie chaude : un arrêt entre les deux
+    # laisse au pire des doublons, jamais de pertes
+    unit_of_work.atomic_write_json(segment_index_path(username), index)
+    _write_jsonl(path, hot[count * SEGMENT_SIZE:])
+    print(f"[DEBUG] Historique de {username} : {count} segment(s) archivé(s).")
+    return count
+
+
+def _ensure_migrated(username: str) -> None:
+    """Migre l'ancien fichier JSON s'il n'a pas encore été migré (sous le verrou "w")."""
+    if not os.path.exists(history_path(username)) and os.path.exists(legacy_history_path(username)):
+        compact_history(username)
+
+
+def _staged(username: str) -> list:
+    uow = unit_of_work.current()
+    return [dict(msg) for msg in uow.staged_messages(username)] if uow is not None else []
+
+
+def load_tail(username: str, limit: int = None) -> list:
+    """
+    Charge seulement la partie chaude de l'historique (taille bornée), y compris les messages
+    encore en attente dans l'unité de travail de la requête courante. Si `limit` est fourni,
+    seuls les `limit` derniers messages sont renvoyés. Un ancien fichier JSON pas encore
+    migré est lu tel quel (la migration n'a lieu qu'au premier ajout, sous le verrou "w").
+    """
+    path = history_path(username)
+    tail = []
+    if os.path.exists(path):
+        try:
+            tail = _read_jsonl(path)
+        except Exception as e:
+            print(f"[ERROR] Erreur lors du chargement de l'historique : {e}")
+    else:
+        tail = _read_legacy(username)
+    tail += _staged(username)
+    return tail[-limit:] if limit else tail
+
+
+def iter_history(username: str):
+    """Parcourt tout l'historique, segment par segment, sans le charger d'un bloc."""
+    for entry in load_segment_index(username):
+        yield from read_segment(username, entry)
+    yield from load_tail(username)
+
+
+def iter_history_since(username: str, message_id: str = None):
+    """
+    Parcourt les messages postérieurs au message `message_id` (tout l'historique si None ou
+    introuvable). Le repère est cherché dans la partie chaude puis dans les segments, du plus
+    récent au plus ancien : les segments antérieurs au repère ne sont pas relus.
+    """
+    if message_id is None:
+        yield from iter_history(username)
+        return
+    tail = load_tail(username)
+    for i, msg in enumerate(tail):
+        if msg.get("id") == message_id:
+            yield from tail[i + 1:]
+            return
+    index = load_segment_index(username)
+    for pos in range(len(index) - 1, -1, -1):
+        if index[pos].get("last_id") == message_id:
+            segment = []
+        else:
+            segment = read_segment(username, index[pos])
+            ids = [msg.get("id") for msg in segment]
+            if message_id not in ids:
+                continue
+            segment = segment[ids.index(message_id) + 1:]
+        yield from segment
+        for entry in index[pos + 1:]:
+            yield from read_segment(username, entry)
+        yield from tail
+        return
+    print(f"[DEBUG] Message {message_id} introuvable dans l'historique de {username} : lecture complète.")
+    yield from iter_history(username)
+
+
+def load_history(username: str) -> list:
+    """
+    Charge l'historique complet (segments froids + partie chaude). Réservé aux outils qui ont
+    réellement besoin de tout l'historique ; les routes utilisent load_tail.
+    """
+    return list(iter_history(username))
+
+
+def take_new_messages(history: list) -> list:
+    """
+    Attribue un identifiant aux messages à enregistrer qui n'en ont pas encore et renvoie
+    leur représentation stockée (id, role, content, timestamp).
+    """
+    new_messages = []
+    for msg in history:
+        if msg.get("id") or msg.get("transient") or msg.get("role") not in PERSISTED_ROLES:
+            continue
+        msg["id"] = new_message_id()
+        msg.setdefault("timestamp", datetime.datetime.now().isoformat())
+        new_messages.append({
+            "id": msg["id"],
+            "role": STORED_ROLES.get(msg["role"], msg["role"]),
+            "content": msg.get("content", ""),
+            "timestamp": msg["timestamp"]
+        })
+    return new_messages
+
+
+def append_messages(username: str, history: list) -> list:
+    """
+    Ajoute au journal les messages de `history` qui n'ont pas encore d'identifiant.
+    Les identifiants attribués sont reportés sur les dictionnaires d'origine, ce qui rend
+    l'appel idempotent : un même message n'est jamais écrit deux fois.
+    Les messages marqués "transient" (simple réaffichage) ne sont pas enregistrés.
+    Retourne la liste des messages effectivement ajoutés.
+    """
+    new_messages = take_new_messages(history)
+    if not new_messages:
+        return []
+    uow = unit_of_work.current()
+    if uow is not None:
+        uow.stage_append(username, new_messages, lambda staged: _append_lines(username, staged))
+    else:
+        _append_lines(username, new_messages)
+    return new_messages
+
+
+def _append_lines(username: str, new_messages: list) -> None:
+    """Ajoute les messages en une seule écriture (une ligne tronquée est ignorée à la lecture)."""
+    path = history_path(username)
+    _ensure_migrated(username)
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    with open(path, "ab") as f:
+        f.write(b"".join(records.encode_line(msg) for msg in new_messages))
+        size = f.tell()
+    if size > HOT_MAX_BYTES:
+        roll_segments(username)
+    notify_append(username, new_messages)
+
+
+# Fonctions appelées après chaque ajout effectif au journal : callback(username, messages)
+_append_listeners = []
+
+
+def add_append_listener(callback) -> None:
+    """Abonne `callback(username, messages)` aux ajouts de messages (tous backends)."""
+    _append_listeners.append(callback)
+
+
+def notify_append(username: str, messages: list) -> None:
+    for callback in _append_listeners:
+        try:
+            callback(username, messages)
+        except Exception as e:
+            print(f"[ERROR] Notification d'ajout de messages en échec : {e}")
+
+
+if __name__ == "__main__":
+    import sys
+    # Usage : python history_store.py [username ...]  (sans argument : tous les utilisateurs)
+    usernames = sys.argv[1:]
+    if not usernames and os.path.exists(HISTORY_DIR):
+        usernames = sorted({f.rsplit(".", 1)[0] for f in os.listdir(HISTORY_DIR)
+                            if f.endswith(".json") or f.endswith(".jsonl")})
+    for name in usernames:
+        with user_lock(name, "w"):
+            compact_history(name)
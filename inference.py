@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : inference.py
+Description : Passerelle d'inférence unique vers Ollama, partagée par tout le processus.
+              - Un seul client Ollama (et donc un seul pool de connexions HTTP) par processus.
+              - Limite de générations simultanées par modèle (REMEMORY_MODEL_CONCURRENCY,
+                ex. "llava:7b=1,rolandroland/llama3.1-uncensored:latest=2" ; 1 par défaut).
+              - File d'attente par priorité : la discussion (INTERACTIVE) passe avant les
+                tâches de fond comme les résumés (BACKGROUND) ; FIFO à priorité égale. Le
+                classement se fait entre requêtes d'un même modèle : une requête bloquée sur
+                un modèle saturé ne fait pas attendre celles d'un modèle qui a de la place.
+              - File bornée (REMEMORY_INFERENCE_QUEUE_MAX, 8 par défaut) : au-delà, QueueFull
+                est levée immédiatement au lieu de laisser toutes les requêtes ralentir.
+              - Résidence des modèles : seuls REMEMORY_RESIDENT_MODELS modèles (1 par défaut)
+                tiennent en mémoire. Un modèle n'est chargé qu'une fois les générations du modèle
+                à décharger terminées ; les tâches de fond d'un modèle non chargé sont regroupées
+                et attendent qu'il le soit, ou que le modèle en place soit inutilisé depuis
+                REMEMORY_SWAP_IDLE secondes (60), sans dépasser REMEMORY_BACKGROUND_MAX_DEFER (300).
+                Les modèles d'embedding (embed()) sont petits et servent à chaque tour de chat :
+                ils ont leurs propres créneaux mais ne comptent pas parmi les modèles chargés
+                et ne déclenchent ni n'attendent de changement de modèle.
+              - Cache disque optionnel des réponses déterministes (voir response_cache.py).
+              - Métriques (en cours, en attente, rejets, attente moyenne, changements de modèle,
+                temps de chargement rapportés par Ollama, succès du cache).
+              Les limites s'appliquent par processus (application Flask, data_preparer.py).
+"""
+
+import os
+import time
+import itertools
+import threading
+from ollama import Client
+from response_cache import get_response_cache, cache_key
+
+OLLAMA_HOST = os.environ.get("REMEMORY_OLLAMA_HOST", "http://127.0.0.1:11434")
+RESIDENT_MODELS = int(os.environ.get("REMEMORY_RESIDENT_MODELS", "1"))
+SWAP_IDLE = float(os.environ.get("REMEMORY_SWAP_IDLE", "60"))
+BACKGROUND_MAX_DEFER = float(os.environ.get("REMEMORY_BACKGROUND_MAX_DEFER", "300"))
+# Les tâches différées réexaminent périodiquement leur droit de démarrer
+POLL_INTERVAL = 1.0
+
+# Priorités (plus petit = servi en premier)
+INTERACTIVE = 0
+BACKGROUND = 10
+
+
+class QueueFull(RuntimeError):
+    """La file d'attente du modèle est pleine : la requête est rejetée sans attendre."""
+
+
+def _parse_limits(value: str) -> dict:
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            model, limit = item.rsplit("=", 1)
+            limits[model.strip()] = max(1, int(limit))
+    return limits
+
+
+class _ModelSlots:
+    """Créneaux de génération d'un modèle et compteurs associés."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.queued = 0
+        self.last_used = 0.0
+        self.stats = {"requests": 0, "rejected": 0, "max_queued": 0, "wait_total": 0.0,
+                      "loads": 0, "load_total": 0.0, "last_load": 0.0}
+
+
+class _Ticket:
+    def __init__(self, model: str, priority: int, seq: int):
+        self.model = model
+        self.priority = priority
+        self.seq = seq
+        self.enqueued = time.monotonic()
+
+
+class InferenceGateway:
+    def __init__(self, host: str = OLLAMA_HOST, limits: dict = None, default_limit: int = 1,
+                 max_queue: int = 8, resident_models: int = RESIDENT_MODELS):
+        self.client = Client(host=host)
+        self.limits = limits or {}
+        self.default_limit = default_limit
+        self.max_queue = max_queue
+        self.resident_models = resident_models
+        self.resident = []   # modèles supposés chargés, du moins au plus récemment utilisé
+        self.exempt = set()  # modèles hors résidence (embeddings)
+        self.swaps = 0
+        self._models = {}
+        self._waiting = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    def _slots(self, model: str) -> _ModelSlots:
+        if model not in self._models:
+            self._models[model] = _ModelSlots(self.limits.get(model, self.default_limit))
+        return self._models[model]
+
+    # --- Ordonnancement (appelé sous self._cond) ---
+
+    def _exempt(self, model: str) -> bool:
+        # Ollama (ollama ps) nomme "nomic-embed-text:latest" ce qui est demandé en "nomic-embed-text"
+        return model in self.exempt or model.removesuffix(":latest") in self.exempt
+
+    def _victim(self):
+        """Modèle à décharger pour en charger un autre (None s'il reste de la place)."""
+        if len(self.resident) < self.resident_models:
+            return None
+        return self.resident[0]
+
+    def _deferred(self, ticket: _Ticket, now: float) -> bool:
+        """Tâche de fond pour un modèle non chargé, qui peut encore attendre son tour."""
+        if ticket.priority < BACKGROUND or ticket.model in self.resident or self._exempt(ticket.model):
+            return False
+        victim = self._victim()
+        if victim is None or now - ticket.enqueued >= BACKGROUND_MAX_DEFER:
+            return False
+        return now - self._slots(victim).last_used < SWAP_IDLE
+
+    def _rank(self, ticket: _Ticket, now: float) -> tuple:
+        return (ticket.priority, self._deferred(ticket, now), ticket.seq)
+
+    def _can_start(self, ticket: _Ticket, now: float) -> bool:
+        """Créneau libre pour le modèle du ticket, et modèle chargé ou chargeable tout de suite."""
+        slots = self._slots(ticket.model)
+        if slots.active >= slots.limit or self._deferred(ticket, now):
+            return False
+        if ticket.model not in self.resident and not self._exempt(ticket.model):
+            victim = self._victim()
+            if victim is not None and self._slots(victim).active > 0:
+                return False
+        return True
+
+    def _may_start(self, ticket: _Ticket) -> bool:
+        """
+        Le ticket démarre s'il le peut et qu'aucun ticket mieux classé ne passe avant lui sur
+        la même ressource :
+          - un ticket du même modèle qui peut démarrer (ou, pour un chargement, un ticket du
+            modèle qu'il déchargerait) ;
+          - pour un chargement qui remplace un modèle, un autre chargement qui peut démarrer
+            (un seul changement à la fois, le mieux classé d'abord) ;
+          - pour le modèle qui sera déchargé, un ticket qui attend de le remplacer : le
+            modèle ne prend plus de nouvelles requêtes, le temps que les siennes se terminent.
+        Un ticket bloqué sur un autre modèle (créneaux pleins, chargement en attente) ne
+        retient pas les requêtes des autres modèles chargés. Un modèle hors résidence ne
+        rivalise qu'avec les tickets de son propre modèle.
+        """
+        now = time.monotonic()
+        if not self._can_start(ticket, now):
+            return False
+        rank = self._rank(ticket, now)
+        victim = self._victim()
+        exempt = self._exempt(ticket.model)
+        swap = victim is not None and ticket.model not in self.resident and not exempt
+        for other in self._waiting:
+            if other is ticket or self._rank(other, now) >= rank:
+                continue
+            if other.model == ticket.model or (swap and other.model == victim):
+                if self._can_start(other, now):
+                    return False
+            elif exempt or self._exempt(other.model):
+                continue
+            elif other.model not in self.resident and not self._deferred(other, now):
+                if swap and self._can_start(other, now):
+                    return False
+                if ticket.model == victim:
+                    return False
+        return True
+
+    def _mark_resident(self, model: str) -> None:
+        if self._exempt(model):
+            return
+        if model in self.resident:
+            self.resident.remove(model)
+        else:
+            victim = self._victim()
+            if victim is not None:
+                self.resident.remove(victim)
+                self.swaps += 1
+                print(f"[DEBUG] Passerelle : {victim} remplacé par {model} (changement n°{self.swaps}).")
+        self.resident.append(model)
+
+    def refresh_resident(self) -> None:
+        """
+        Met à jour les modèles chargés d'après Ollama (ollama ps) : un autre processus
+        (application Flask ou data_preparer.py) a pu en changer.
+        """
+        try:
+            loaded = [m.get("model") for m in self.client.ps().get("models", [])]
+        except Exception as e:
+            print(f"[ERROR] Impossible de lister les modèles chargés : {e}")
+            return
+        with self._cond:
+            loaded = [model for model in loaded if not self._exempt(model)]
+            now = time.monotonic()
+            for model in loaded:
+                if model not in self.resident:
+                    # Chargé par un autre processus : considéré comme utilisé à l'instant
+                    self._slots(model).last_used = now
+            # Un modèle en cours d'utilisation ici reste compté, même s'il se charge encore
+            self.resident = [m for m in self.resident if m in loaded or self._slots(m).active > 0] + \
+                            [m for m in loaded if m not in self.resident]
+            self._cond.notify_all()
+
+    # --- API ---
+
+    def acquire(self, model: str, priority: int = INTERACTIVE) -> None:
+        """Attend un créneau libre pour `model` (QueueFull si la file est pleine)."""
+        if priority >= BACKGROUND:
+            self.refresh_resident()
+        with self._cond:
+            slots = self._slots(model)
+            if slots.active >= slots.limit and slots.queued >= self.max_queue:
+                slots.stats["rejected"] += 1
+                raise QueueFull(f"File d'attente pleine pour {model} ({self.max_queue} requêtes)")
+            ticket = _Ticket(model, priority, next(self._counter))
+            self._waiting.append(ticket)
+            slots.queued += 1
+            slots.stats["max_queued"] = max(slots.stats["max_queued"], slots.queued)
+            try:
+                while not self._may_start(ticket):
+                    self._cond.wait(POLL_INTERVAL)
+            finally:
+                self._waiting.remove(ticket)
+                slots.queued -= 1
+            self._mark_resident(model)
+            slots.active += 1
+            slots.last_used = time.monotonic()
+            slots.stats["requests"] += 1
+            slots.stats["wait_total"] += slots.last_used - ticket.enqueued
+            # Le suivant dans la file peut peut-être démarrer aussi (limite > 1)
+            self._cond.notify_all()
+
+    def release(self, model: str, load_duration: int = None) -> None:
+        """Libère le créneau ; `load_duration` (ns) est le temps de chargement rapporté par Ollama."""
+        with self._cond:
+            slots = self._slots(model)
+            slots.active -= 1
+            slots.last_used = time.monotonic()
+            # Ollama rapporte quelques ms quand le modèle était déjà chargé
+            if load_duration and load_duration > 0.5e9:
+                slots.stats["loads"] += 1
+                slots.stats["load_total"] += load_duration / 1e9
+                slots.stats["last_load"] = load_duration / 1e9
+            self._cond.notify_all()
+
+    def chat(self, model: str, messages: list, priority: int = INTERACTIVE, stream: bool = False,
+             cache: bool = False, cache_if=None, **kwargs):
+        """
+        Équivalent de Client.chat, sous la limite de concurrence du modèle.
+        Avec stream=True, renvoie un générateur qui garde le créneau jusqu'au dernier morceau.
+        Avec cache=True (requêtes déterministes uniquement), une requête identique déjà traitée
+        est servie depuis le cache disque (response_cache.py) sans passer par la file.
+        `cache_if(contenu)` : seules les réponses qui le vérifient sont mises en cache ou servies
+        depuis le cache (une réponse mal formée n'est pas rejouée).
+        """
+        if stream:
+            return self._chat_stream(model, messages, priority, **kwargs)
+        if cache:
+            key = cache_key(model, messages, kwargs.get("options"))
+            cached = get_response_cache().get(key)
+            if cached is not None and (cache_if is None or cache_if(cached["message"]["content"])):
+                return cached
+        self.acquire(model, priority)
+        response = None
+        try:
+            response = self.client.chat(model=model, messages=messages, **kwargs)
+        finally:
+            self.release(model, response.get("load_duration") if response is not None else None)
+        content = response["message"]["content"]
+        if cache and content and (cache_if is None or cache_if(content)):
+            get_response_cache().put(key, {"message": {"role": response["message"]["role"],
+                                                       "content": response["message"]["content"]}})
+        return response
+
+    def _chat_stream(self, model: str, messages: list, priority: int, **kwargs):
+        self.acquire(model, priority)
+        last = None
+        try:
+            for chunk in self.client.chat(model=model, messages=messages, stream=True, **kwargs):
+                last = chunk
+                yield chunk
+        finally:
+            # Le temps de chargement figure dans le dernier morceau
+            self.release(model, last.get("load_duration") if last is not None else None)
+
+    def embed(self, model: str, input, priority: int = INTERACTIVE) -> dict:
+        """
+        Équivalent de Client.embed (vecteurs d'un ou plusieurs textes), sous la même limite de
+        concurrence mais hors résidence : une recherche de souvenirs à chaque tour de chat ne
+        compte pas comme un changement de modèle et n'attend pas les tâches de fond.
+        """
+        with self._cond:
+            self.exempt.add(model)
+            self.resident = [m for m in self.resident if not self._exempt(m)]
+        self.acquire(model, priority)
+        response = None
+        try:
+            response = self.client.embed(model=model, input=input)
+        finally:
+            self.release(model, response.get("load_duration") if response is not None else None)
+        return response
+
+    def metrics(self) -> dict:
+        """Instantané des files d'attente, des modèles chargés et des compteurs."""
+        with self._cond:
+            return {
+                "resident": list(self.resident),
+                "exempt": sorted(self.exempt),
+                "swaps": self.swaps,
+                "cache": {"hits": get_response_cache().hits, "misses": get_response_cache().misses},
+                "models": {
+                    model: {
+                        "limit": slots.limit,
+                        "active": slots.active,
+                        "queued": slots.queued,
+                        "max_queued": slots.stats["max_queued"],
+                        "requests": slots.stats["requests"],
+                        "rejected": slots.stats["rejected"],
+                        "avg_wait_s": round(slots.stats["wait_total"] / slots.stats["requests"], 3)
+                        if slots.stats["requests"] else 0.0,
+                        "loads": slots.stats["loads"],
+                        "load_total_s": round(slots.stats["load_total"], 3),
+                        "last_load_s": round(slots.stats["last_load"], 3)
+                    }
+                    for model, slots in self._models.items()
+                }
+            }
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway() -> InferenceGateway:
+    """Renvoie la passerelle partagée du processus (créée à la première utilisation)."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = InferenceGateway(
+                limits=_parse_limits(os.environ.get("REMEMORY_MODEL_CONCURRENCY", "")),
+                max_queue=int(os.environ.get("REMEMORY_INFERENCE_QUEUE_MAX", "8"))
+            )
+        return _gateway
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : jobs.py
+Description : File de tâches en arrière-plan avec table des tâches persistée (SQLite).
+              - submit() enregistre la tâche et la confie à un pool de workers ; la requête
+                HTTP qui l'a créée peut répondre immédiatement avec son identifiant.
+              - Chaque tâche passe par les états queued -> running -> done / error, avec une
+                étape et un pourcentage de progression consultables via get().
+              - Une tâche prise en charge enregistre son propriétaire (machine et pid du
+                processus), qui la signale vivante toutes les HEARTBEAT_INTERVAL secondes.
+              - resume() relance au démarrage les tâches restées en attente, et les tâches
+                "running" dont le propriétaire est mort (pid absent sur cette machine) ou
+                silencieux depuis STALE_AFTER secondes ; une tâche longue d'un autre worker
+                vivant n'est jamais relancée en double.
+              La table est dans REMEMORY_JOBS_DB (jobs.db par défaut) ; le nombre de workers
+              est fixé par file (REMEMORY_IMAGE_WORKERS pour les images, 2 par défaut).
+"""
+
+import os
+import json
+import uuid
+import socket
+import sqlite3
+import time
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+JOBS_DB = os.environ.get("REMEMORY_JOBS_DB", "jobs.db")
+# Signal de vie des tâches en cours ; sans signal depuis STALE_AFTER, la tâche est interrompue
+HEARTBEAT_INTERVAL = 30
+STALE_AFTER = 300
+# Propriétaire des tâches prises en charge par ce processus
+OWNER_HOST = socket.gethostname()
+
+
+def _owner() -> str:
+    return f"{OWNER_HOST}:{os.getpid()}"
+
+
+def _owner_alive(owner: str) -> bool:
+    """False si le propriétaire est un processus de cette machine qui n'existe plus."""
+    host, _, pid = (owner or "").rpartition(":")
+    if host != OWNER_HOST or not pid.isdigit():
+        return True  # autre machine : seul le signal de vie fait foi
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # processus existant d'un autre utilisateur
+    return True
+
+
+class JobQueue:
+    def __init__(self, kind: str, handler, workers: int = 2, db_path: str = JOBS_DB):
+        """
+        `handler(job, progress)` traite une tâche (dict) et renvoie son résultat (sérialisable
+        en JSON) ; `progress(étape, pourcentage)` met à jour son avancement.
+        """
+        self.kind = kind
+        self.handler = handler
+        self.db_path = db_path
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"jobs-{kind}")
+        self._init_schema()
+        threading.Thread(target=self._heartbeat, name=f"jobs-{kind}-heartbeat", daemon=True).start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self) -> None:
+        conn = self._connect()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                username TEXT NOT NULL,
+                status TEXT NOT NULL,
+                step TEXT,
+                progress INTEGER DEFAULT 0,
+                payload TEXT,
+                result TEXT,
+                error TEXT,
+                created TEXT,
+                updated TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(kind, status);
+        """)
+        # Tables créées avant le suivi des propriétaires
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column in ("owner", "heartbeat"):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+        conn.commit()
+
+    def _heartbeat(self) -> None:
+        """Signale toutes les HEARTBEAT_INTERVAL secondes que les tâches de ce processus sont vivantes."""
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                conn = self._connect()
+                conn.execute("UPDATE jobs SET heartbeat = ? WHERE kind = ? AND status = 'running' AND owner = ?",
+                             (datetime.datetime.now().isoformat(), self.kind, _owner()))
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"[ERROR] Signal de vie des tâches {self.kind} impossible : {e}")
+
+    def _update(self, job_id: str, **fields) -> None:
+        fields["updated"] = datetime.datetime.now().isoformat()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        conn = self._connect()
+        conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+        conn.commit()
+
+    def submit(self, username: str, payload: dict) -> str:
+        """Enregistre une tâche et la met en file ; renvoie son identifiant."""
+        job_id = uuid.uuid4().hex
+        now = datetime.datetime.now().isoformat()
+        conn = self._connect()
+        conn.execute(
+            "INSERT INTO jobs (id, kind, username, status, step, payload, created, updated) "
+            "VALUES (?, ?, ?, 'queued', 'En attente', ?, ?, ?)",
+            (job_id, self.kind, username, json.dumps(payload, ensure_ascii=False), now, now))
+        conn.commit()
+        self._executor.submit(self._run, job_id)
+        print(f"[DEBUG] Tâche {self.kind} {job_id} créée pour {username}.")
+        return job_id
+
+    def get(self, job_id: str):
+        """Renvoie la tâche (payload et résultat décodés) ou None."""
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ? AND kind = ?",
+                                      (job_id, self.kind)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"]) if job["payload"] else {}
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def _run(self, job_id: str) -> None:
+        # Prise en charge atomique : un autre processus a pu relancer la même tâche
+        conn = self._connect()
+        now = datetime.datetime.now().isoformat()
+        claimed = conn.execute("UPDATE jobs SET status = 'running', step = 'Démarrage', updated = ?, "
+                               "owner = ?, heartbeat = ? WHERE id = ? AND status = 'queued'",
+                               (now, _owner(), now, job_id)).rowcount
+        conn.commit()
+        if not claimed:
+            return
+        job = self.get(job_id)
+
+        def progress(step: str, percent: int) -> None:
+            self._update(job_id, step=step, progress=percent)
+
+        try:
+            result = self.handler(job, progress)
+            self._update(job_id, status="done", step="Terminé", progress=100,
+                         result=json.dumps(result, ensure_ascii=False))
+        except Exception as e:
+            print(f"[ERROR] Tâche {self.kind} {job_id} en échec : {e}")
+            self._update(job_id, status="error", step="Erreur", error=str(e))
+
+    def resume(self) -> int:
+        """
+        Relance les tâches en attente, et celles restées "running" dont le propriétaire est mort
+        ou sans signal de vie depuis STALE_AFTER secondes (serveur arrêté pendant leur traitement).
+        """
+        conn = self._connect()
+        cutoff = (datetime.datetime.now() - datetime.timedelta(seconds=STALE_AFTER)).isoformat()
+        running = conn.execute("SELECT id, owner, heartbeat, updated FROM jobs WHERE kind = ? AND status = 'running'",
+                               (self.kind,)).fetchall()
+        for row in running:
+            if _owner_alive(row["owner"]) and (row["heartbeat"] or row["updated"]) >= cutoff:
+                continue
+            # Condition répétée : un autre processus a pu relancer la tâche entre-temps
+            conn.execute("UPDATE jobs SET status = 'queued' WHERE id = ? AND status = 'running' "
+                         "AND owner IS ?", (row["id"], row["owner"]))
+        conn.commit()
+        rows = conn.execute("SELECT id FROM jobs WHERE kind = ? AND status = 'queued' ORDER BY created",
+                            (self.kind,)).fetchall()
+        for row in rows:
+            self._executor.submit(self._run, row["id"])
+        if rows:
+            print(f"[DEBUG] {len(rows)} tâche(s) {self.kind} relancée(s).")
+        return len(rows)
@@ -13,30 +13,32 @@ import os
 import base64
 import io
 import pyttsx3         # Pour la synthèse vocale
-import whisper         # Pour la transcription audio
 from langdetect import detect  # Pour la détection de langue (facultatif)
-from ollama import Client  # Client pour communiquer avec l'IA
+from inference import get_gateway, INTERACTIVE  # Passerelle partagée vers Ollama
 from PIL import Image
 import datetime
 import threading
+from contextlib import contextmanager
 import subprocess
 import sys
+from storage import get_storage
+from user_locks import user_lock, user_transaction
+from chat_sessions import ChatSessionPool
+from context_builder import (build_context, profile_digest, count_tokens, truncate_to_tokens, CHAT_OPTIONS,
+                             KEEP_ALIVE, MEMORY_TOKENS)
+from memory_index import MemoryIndex
+from transcription import get_transcriber, transcription_metrics, QueueFull  # Processus de transcription (Whisper)
+from model_registry import WHISPER_WARMUP
 
-# Lancement de data_preparer.py en arrière-plan (approche ponctuelle, peu gourmande en ressources)
+# Lancement du service de préparation en arrière-plan (une seule instance, voir preparer_service.py)
 def start_data_preparer():
-    try:
-        subprocess.Popen([sys.executable, "data_preparer.py"])
-        print("data_preparer.py a été lancé en arrière-plan.")
-    except Exception as e:
-        print("Erreur lors du lancement de data_preparer.py:", e)
+    from preparer_service import ensure_service
+    ensure_service()
 
 #start_data_preparer()
 
-# Chargement global du modèle Whisper pour éviter de le recharger à chaque appel
-whisper_model = whisper.load_model("medium")
-
-# Configuration du client Ollama
-client = Client(host='http://127.0.0.1:11434')
+# Passerelle Ollama partagée (client unique, limites de concurrence, file par priorité)
+gateway = get_gateway()
 
 # --- Classe LLaMAChat ---
 class LLaMAChat:
@@ -44,81 +46,197 @@ class LLaMAChat:
     Classe pour gérer les interactions avec l'IA via le client Ollama.
     Gère l'historique des conversations et la fiche utilisateur.
     Le paramètre 'save_history' (True par défaut) permet d'activer ou non l'enregistrement
-    des messages dans l'historique.
+    des messages dans l'historique ; 'priority' fixe la place des requêtes dans la file
+    de la passerelle d'inférence.
     """
-    def __init__(self, model_name='rolandroland/llama3.1-uncensored:latest', username="guest", save_history=True):
+    def __init__(self, model_name='rolandroland/llama3.1-uncensored:latest', username="guest", save_history=True,
+                 priority=INTERACTIVE):
         self.model = model_name
+        self.priority = priority
+        self.context_anchor = None  # premier message de la fenêtre envoyée au tour précédent
         self.username = username
         self.save_history_flag = save_history
         self.history = self.load_history()
         self.saved_count = len(self.history)
         self.user_data = self.load_user_data()
-        self.tts_engine = pyttsx3.init()
+        # Index des souvenirs construit par le service de préparation (même nom, voir canonical_username)
+        self.memory_index = MemoryIndex(username)
 
     def load_history(self) -> list:
-        history_path = f"historique/{self.username}.json"  # Changement d'extension
-        history = []
-        if os.path.exists(history_path):
-            try:
-                with open(history_path, "r", encoding="utf-8") as f:
-                    history = json.load(f)
-                    if isinstance(history, list):
-                        return history
-            except Exception as e:
-                print(f"Erreur de lecture de l'historique : {e}")
-        return []
+        with user_lock(self.username, "r"):
+            return get_storage().load_history_tail(self.username)
 
     def save_history(self) -> None:
-        os.makedirs("historique", exist_ok=True)
-        history_path = f"historique/{self.username}.json"  # Changement d'extension
-        # Sauvegarde de l'intégralité de l'historique à chaque fois
-        with open(history_path, "w", encoding="utf-8") as f:
-            json.dump(self.history, f, ensure_ascii=False, indent=4)
+        # Seuls les nouveaux messages (sans identifiant) sont ajoutés au journal
+        with user_transaction(self.username):
+            get_storage().append_messages(self.username, self.history)
         self.saved_count = len(self.history)
 
     def load_user_data(self) -> dict:
-        user_info_path = f"users/{self.username}.json"
-        if os.path.exists(user_info_path):
-            with open(user_info_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if "preferences" not in data:
-                    data["preferences"] = {}
-                return data
+        # Profil seul : l'historique est déjà transmis au modèle, et les images et résumés ne
+        # sont lus qu'à la demande (voir digest_data)
+        with user_lock(self.username, "r"):
+            # Version lue avant la fiche : une écriture concurrente provoquera une relecture
+            self.user_version = get_storage().user_version(self.username)
+            data = get_storage().load_user(self.username, ("profile",))
+        if data is not None:
+            return data
         return {"nom": self.username, "ton": "neutral", "language": "en", "preferences": {}}
 
-    def ask(self, prompt: str) -> str:
+    def refresh_user_data(self) -> None:
+        """Relit la fiche (session réutilisée) si elle a changé depuis la dernière lecture."""
+        if get_storage().user_version(self.username) != self.user_version:
+            self.user_data = self.load_user_data()
+
+    def system_prompt(self) -> str:
         ia_name = "Angel"
+        return (
+            f"Please respond as {ia_name}, a compassionate and supportive assistant dedicated to helping individuals with memory loss (such as dementia or Alzheimer’s) recall their cherished memories. "
+            "Your responses should be clear, concise, and secure, focusing solely on providing gentle assistance and practical guidance. "
+            "Avoid personalizing your identity or using language qui implique des liens familiaux ou des anecdotes personnelles."
+        )
+
+    def recall(self, prompt: str):
+        """
+        Souvenirs les plus proches de la question, en lignes "- ...", dans MEMORY_TOKENS.
+        Renvoie None si l'index n'est pas encore construit (la fiche complète est alors résumée).
+        """
+        try:
+            if not len(self.memory_index):
+                return None
+            found = self.memory_index.search(prompt)
+        except Exception as e:
+            print(f"[ERROR] Recherche dans l'index des souvenirs impossible : {e}")
+            return None
+        lines, used = [], 0
+        for _, memory in found:
+            line = "- " + truncate_to_tokens(memory["text"], MEMORY_TOKENS - used)
+            used += count_tokens(line) + 1
+            lines.append(line)
+            if used >= MEMORY_TOKENS:
+                break
+        return "\n".join(lines)
+
+    def digest_data(self, memories) -> dict:
+        """
+        Fiche résumée dans le prompt. Si l'index des souvenirs a répondu (`memories` non None),
+        le profil suffit, complété du dernier résumé indexé ; sinon les images et les résumés
+        sont relus pour résumer la fiche complète.
+        """
+        if memories is not None:
+            latest = self.memory_index.texts("summary")[-1:]
+            return dict(self.user_data, conversation_resumer=[{"resumer": text} for text in latest])
+        with user_lock(self.username, "r"):
+            sections = get_storage().load_user(self.username, ("images", "summaries")) or {}
+        return dict(self.user_data, images=sections.get("images") or [],
+                    conversation_resumer=sections.get("conversation_resumer") or [])
+
+    def _prepare_messages(self, prompt: str) -> list:
+        """
+        Ajoute la question à l'historique et renvoie le contexte à envoyer au modèle : message
+        système, résumé de la fiche, souvenirs retrouvés pour la question et messages récents
+        dans le budget de tokens (voir context_builder.py). L'historique est ramené aux messages
+        effectivement envoyés ; le début de la fenêtre est conservé d'un tour à l'autre pour
+        garder un préfixe stable.
+        """
+        memories = self.recall(prompt)
+        self.history.append({'role': 'user', 'content': prompt})
+        messages, self.history = build_context(self.system_prompt(), self.history,
+                                               digest=profile_digest(self.digest_data(memories), memories=memories is None),
+                                               anchor=self.context_anchor, memories=memories or "")
+        self.context_anchor = self.history[0] if self.history else None
+        return messages
+
+    def _record_answer(self, answer: str) -> None:
+        self.history.append({'role': 'assistant', 'content': answer})
+        if self.save_history_flag:
+            self.save_history()
+
+    def ask(self, prompt: str) -> str:
         if not prompt.strip():
             return "Le prompt est vide. Veuillez fournir un message valide."
-        if not any(msg.get("role") == "system" for msg in self.history):
-            system_msg = {
-                "role": "system",
-                "content": (
-                    f"User information: {json.dumps(self.user_data)}. "
-                    f"Please respond as {ia_name}, a compassionate and supportive assistant dedicated to helping individuals with memory loss (such as dementia or Alzheimer’s) recall their cherished memories. "
-                    "Your responses should be clear, concise, and secure, focusing solely on providing gentle assistance and practical guidance. "
-                    "Avoid personalizing your identity or using language qui implique des liens familiaux ou des anecdotes personnelles."
-                )
-            }
-            self.history.insert(0, system_msg)
-        self.history.append({'role': 'user', 'content': prompt})
-        if len(self.history) > 20:
-            self.history = self.history[-20:]
+        messages = self._prepare_messages(prompt)
         try:
-            response = client.chat(model=self.model, messages=self.history)
+            response = gateway.chat(self.model, messages, priority=self.priority, options=CHAT_OPTIONS,
+                                    keep_alive=KEEP_ALIVE)
             answer = response['message']['content']
         except Exception as e:
             answer = f"Error calling the AI: {str(e)}"
-        self.history.append({'role': 'assistant', 'content': answer})
-        if self.save_history_flag:
-            self.save_history()
+        self._record_answer(answer)
         return answer
 
+    def ask_cached(self, prompt: str, valid=None) -> str:
+        """
+        Question isolée (sans historique ni fiche, non enregistrée), pour les tâches
+        déterministes comme le tagging : une question identique est servie depuis le cache.
+        `valid(réponse)` : seules les réponses exploitables sont mises en cache.
+        """
+        messages = [{"role": "system", "content": self.system_prompt()}, {"role": "user", "content": prompt}]
+        try:
+            response = gateway.chat(self.model, messages, priority=self.priority, options=CHAT_OPTIONS,
+                                    keep_alive=KEEP_ALIVE, cache=True, cache_if=valid)
+            return response['message']['content']
+        except Exception as e:
+            return f"Error calling the AI: {str(e)}"
+
+    def ask_stream(self, prompt: str):
+        """
+        Variante de ask() qui renvoie la réponse morceau par morceau (stream=True d'Ollama),
+        dès que le modèle les produit. L'historique n'est enregistré qu'une fois, à la fin.
+        """
+        if not prompt.strip():
+            yield "Le prompt est vide. Veuillez fournir un message valide."
+            return
+        messages = self._prepare_messages(prompt)
+        parts = []
+        try:
+            for chunk in gateway.chat(self.model, messages, priority=self.priority, stream=True,
+                                      options=CHAT_OPTIONS, keep_alive=KEEP_ALIVE):
+                token = chunk['message']['content']
+                if token:
+                    parts.append(token)
+                    yield token
+        except Exception as e:
+            error = f"Error calling the AI: {str(e)}"
+            parts.append(error)
+            yield error
+        self._record_answer("".join(parts))
+
     def generate_speech(self, text: str, rate: int = 80) -> None:
         if text:
-            self.tts_engine.setProperty('rate', rate)
-            self.tts_engine.say(text)
-            self.tts_engine.runAndWait()
+            with _tts_lock:
+                engine = get_tts_engine()
+                engine.setProperty('rate', rate)
+                engine.say(text)
+                engine.runAndWait()
+
+# Moteur de synthèse vocale pyttsx3 : créé à la première lecture et partagé par le processus
+# (le parcours web utilise gTTS et n'en a jamais besoin)
+_tts_engine = None
+_tts_lock = threading.Lock()
+
+def get_tts_engine():
+    global _tts_engine
+    if _tts_engine is None:
+        _tts_engine = pyttsx3.init()
+    return _tts_engine
+
+# Sessions de chat chaudes par utilisateur (voir chat_sessions.py)
+chat_sessions = ChatSessionPool(lambda username: LLaMAChat(username=username))
+
+def get_chatbot(username: str) -> LLaMAChat:
+    """
+    Renvoie le chatbot de l'utilisateur sans le réserver : uniquement pour les questions
+    isolées (ask_cached), qui ne touchent ni à l'historique ni à la fiche de la session.
+    """
+    return chat_sessions.get(username)
+
+@contextmanager
+def chat_session(username: str):
+    """Chatbot de l'utilisateur réservé pendant le bloc `with`, fiche relue si elle a changé."""
+    with chat_sessions.use(username) as chatbot:
+        chatbot.refresh_user_data()
+        yield chatbot
 
 # --- Classe LLaVAAnalyzer ---
 class LLaVAAnalyzer:
@@ -134,27 +252,35 @@ class LLaVAAnalyzer:
                 buffered = io.BytesIO()
                 img.save(buffered, format="JPEG")
                 img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            response = client.chat(
-                model=self.model,
-                messages=[{
+            response = gateway.chat(
+                self.model,
+                [{
                     'role': 'user',
                     'content': (
                         "Look at this image carefully and provide a detailed description in English, "
                         "mentioning objects, colors, emotions, and context."
                     ),
                     'images': [img_base64]
-                }]
+                }],
+                cache=True
             )
             return response['message']['content']
         except Exception as e:
             return f"Error: {str(e)}"
 
+# Résultat de transcribe_audio() quand l'enregistrement ne contient aucune parole
+NO_SPEECH = None
+
 def transcribe_audio(file_path: str) -> str:
+    """Texte de l'enregistrement ; NO_SPEECH si aucune parole n'y est détectée."""
     if not file_path or not os.path.exists(file_path):
          return "Error: audio file not found"
     try:
-         result = whisper_model.transcribe(file_path, fp16=False)
-         return result.get("text", "Error: transcription failed.")
+         # Pool de processus dédié, silences retirés et audio long découpé (voir transcription.py)
+         result = get_transcriber().transcribe(file_path)
+         return NO_SPEECH if result.get("no_speech") else result["text"]
+    except QueueFull:
+         raise
     except Exception as e:
          return f"Error in transcription: {str(e)}"
 
@@ -170,37 +296,36 @@ def convert_history_to_messages(history: list) -> list:
     return filtered_history
 
 def save_conversation_history(username: str, history: list) -> list:
-    directory = "historique"
-    os.makedirs(directory, exist_ok=True)
-    filepath = os.path.join(directory, f"{username}.json")
-    filtered_history = convert_history_to_messages(history)
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(filtered_history, f, ensure_ascii=False, indent=4)
-    return filtered_history
+    with user_transaction(username):
+        get_storage().append_messages(username, history)
+    return convert_history_to_messages(history)
 
 def update_user_info_from_history(username: str, history: list) -> dict:
-    user_info_path = f"users/{username}.json"
-    if os.path.exists(user_info_path):
-        with open(user_info_path, "r", encoding="utf-8") as f:
-            user_info = json.load(f)
-    else:
-        user_info = {"nom": username, "preferences": {}}
-    filtered_history = convert_history_to_messages(history)
-    user_info["conversation_history"] = filtered_history
-    with open(user_info_path, "w", encoding="utf-8") as f:
-        json.dump(user_info, f, ensure_ascii=False, indent=4)
+    with user_transaction(username):
+        user_info = get_storage().load_user(username, ("history",))
+        if user_info is None:
+            user_info = {"nom": username, "preferences": {}}
+        filtered_history = convert_history_to_messages(history)
+        user_info["conversation_history"] = filtered_history
+        get_storage().save_user(username, user_info)
     return user_info
 
 def warmup():
     try:
         dummy_history = [{"role": "system", "content": "Warming up chat model."}]
-        _ = client.chat(model='rolandroland/llama3.1-uncensored:latest', messages=dummy_history)
+        # Mêmes options que le chat : sinon Ollama recharge le modèle au premier message
+        _ = gateway.chat('rolandroland/llama3.1-uncensored:latest', dummy_history, options=CHAT_OPTIONS,
+                         keep_alive=KEEP_ALIVE)
         print("Warmup du modèle de chat terminé.")
     except Exception as e:
         print("Erreur lors du warmup du modèle de chat:", e)
     print("Warmup complet.")
 
-warmup()
+# Le warmup ne bloque plus l'import (et donc le démarrage du serveur) : il tourne en arrière-plan
+if os.environ.get("REMEMORY_CHAT_WARMUP", "1") == "1":
+    threading.Thread(target=warmup, name="warmup-chat", daemon=True).start()
+if WHISPER_WARMUP:
+    get_transcriber().warmup()
 
 # # --- Menu interactif ---
 # if __name__ == "__main__":
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : memory_index.py
+Description : Index vectoriel local des souvenirs d'un utilisateur (résumés de conversation,
+              descriptions et tags des photos, préférences).
+              - Construit par le service de préparation (data_preparer.py), de façon
+                incrémentale : seuls les souvenirs nouveaux ou modifiés sont vectorisés.
+              - Stockage dans memory_index/<username>/ (REMEMORY_MEMORY_INDEX_DIR) :
+                vectors.<version>.f32 (vecteurs float32 normalisés, lus en mémoire partagée via
+                numpy.memmap si NumPy est installé, sinon via mmap) et items.json (textes, et
+                nom du fichier de vecteurs correspondant). items.json est toujours écrit en
+                dernier : un lecteur ne voit jamais des textes sans leurs vecteurs. Un fichier
+                de vecteurs réécrit l'est sous un nouveau nom, jamais à la place de celui
+                qu'un lecteur peut être en train de lire.
+              - search() renvoie les k souvenirs les plus proches de la question : le chat
+                n'envoie plus au modèle que ces souvenirs, quel que soit leur nombre total.
+              - Vectorisation par défaut : hachage des mots et paires de mots (déterministe,
+                sans modèle, utilisable hors ligne et dans les tests). Avec
+                REMEMORY_EMBED_MODEL (ex. "nomic-embed-text"), les vecteurs sont calculés par
+                Ollama ; changer de méthode reconstruit l'index.
+              Usage : python memory_index.py <utilisateur> "<question>"
+"""
+
+import os
+import re
+import uuid
+import mmap
+import array
+import hashlib
+import math
+import unicodedata
+import records
+from unit_of_work import atomic_write_json
+
+try:
+    import numpy
+except ImportError:  # recherche en Python pur, plus lente mais équivalente
+    numpy = None
+
+INDEX_DIR = os.environ.get("REMEMORY_MEMORY_INDEX_DIR", "memory_index")
+EMBED_MODEL = os.environ.get("REMEMORY_EMBED_MODEL", "")
+HASH_DIM = 512
+TOP_K = int(os.environ.get("REMEMORY_MEMORY_TOP_K", "5"))
+# En dessous de ce score (cosinus), un souvenir n'est pas jugé pertinent
+MIN_SCORE = float(os.environ.get("REMEMORY_MEMORY_MIN_SCORE", "0.1"))
+
+_WORD = re.compile(r"\w{2,}")
+_STOP_WORDS = {
+    "le", "la", "les", "un", "une", "des", "de", "du", "et", "ou", "en", "au", "aux", "ce", "ces",
+    "est", "sont", "je", "tu", "il", "elle", "nous", "vous", "ils", "elles", "que", "qui", "dans",
+    "sur", "pour", "par", "avec", "pas", "ne", "se", "sa", "son", "ses", "mon", "ma", "mes",
+    "the", "a", "an", "and", "or", "of", "to", "in", "on", "for", "with", "is", "are", "was",
+    "it", "this", "that", "my", "your", "you", "me", "do", "did", "what", "who",
+}
+
+
+def words(text: str) -> list:
+    # Minuscules sans accents : "Été" et "ete" donnent le même mot
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [w for w in _WORD.findall(text) if w not in _STOP_WORDS]
+
+
+def hash_embed(text: str, dim: int = HASH_DIM) -> list:
+    """Vecteur normalisé obtenu par hachage signé des mots et des paires de mots."""
+    text_words = words(text)
+    features = text_words + [f"{a} {b}" for a, b in zip(text_words, text_words[1:])]
+    vector = [0.0] * dim
+    for feature in features:
+        h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+        vector[h % dim] += 1.0 if (h >> 63) & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector] if norm else vector
+
+
+def embedding_method() -> str:
+    return f"ollama:{EMBED_MODEL}" if EMBED_MODEL else f"hash:{HASH_DIM}"
+
+
+def embed_texts(texts: list, background: bool = False) -> list:
+    """Vectorise `texts` avec la méthode configurée (vecteurs normalisés)."""
+    if not EMBED_MODEL:
+        return [hash_embed(text) for text in texts]
+    from inference import get_gateway, INTERACTIVE, BACKGROUND
+    response = get_gateway().embed(EMBED_MODEL, texts, priority=BACKGROUND if background else INTERACTIVE)
+    vectors = []
+    for vector in response["embeddings"]:
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        vectors.append([v / norm for v in vector])
+    return vectors
+
+
+def user_memories(user_data: dict) -> list:
+    """Souvenirs indexables de la fiche : liste de {"kind", "text"}."""
+    memories = []
+    for summary in user_data.get("conversation_resumer") or []:
+        if isinstance(summary, dict) and summary.get("resumer"):
+            memories.append({"kind": "summary", "text": summary["resumer"]})
+    for image in user_data.get("images") or []:
+        parts = [image.get("description", "")]
+        if image.get("tags"):
+            parts.append("Tags: " + ", ".join(image["tags"]))
+        text = " ".join(p for p in parts if p).strip()
+        if text:
+            memories.append({"kind": "photo", "text": f"Photo {image.get('filename', '')}: {text}"})
+    for question, answer in (user_data.get("preferences") or {}).items():
+        memories.append({"kind": "preference", "text": f"{question} {answer}"})
+    return memories
+
+
+def _memory_key(memory: dict) -> str:
+    return hashlib.sha1(f"{memory['kind']}\n{memory['text']}".encode("utf-8")).hexdigest()
+
+
+class MemoryIndex:
+    def __init__(self, username: str, directory: str = INDEX_DIR):
+        self.username = username
+        self.directory = os.path.join(directory, username)
+        self.items_path = os.path.join(self.directory, "items.json")
+        self._loaded_mtime = None
+        self.meta = {"method": embedding_method(), "dim": 0, "items": []}
+        self._vectors = None
+
+    # --- Lecture ---
+
+    def _load(self) -> None:
+        """(Re)charge l'index s'il a changé sur disque depuis la dernière lecture."""
+        try:
+            mtime = os.path.getmtime(self.items_path)
+        except OSError:
+            self.meta, self._vectors, self._loaded_mtime = {"method": embedding_method(), "dim": 0,
+                                                            "items": []}, None, None
+            return
+        if mtime == self._loaded_mtime:
+            return
+        try:
+            with open(self.items_path, "rb") as f:
+                meta = records.decode(f.read())
+        except (OSError, records.DecodeError) as e:
+            print(f"[ERROR] Index des souvenirs illisible pour {self.username} : {e}")
+            return
+        try:
+            vectors = self._map_vectors(self._vectors_path(meta), len(meta["items"]), meta["dim"])
+        except (OSError, ValueError) as e:
+            # Fichier remplacé entre la lecture de items.json et son ouverture : relu au prochain appel
+            print(f"[ERROR] Vecteurs des souvenirs de {self.username} illisibles : {e}")
+            return
+        self.meta, self._vectors, self._loaded_mtime = meta, vectors, mtime
+
+    def _vectors_path(self, meta: dict) -> str:
+        # Index d'avant le nommage par version : un seul fichier vectors.f32
+        return os.path.join(self.directory, meta.get("vectors", "vectors.f32"))
+
+    @staticmethod
+    def _map_vectors(path: str, count: int, dim: int):
+        """Vecteurs en mémoire partagée ; seules les `count` premières lignes sont valides."""
+        if not count or not dim:
+            return None
+        if os.path.getsize(path) < count * dim * 4:
+            raise ValueError(f"{path} plus court que les {count} vecteurs annoncés")
+        if numpy is not None:
+            return numpy.memmap(path, dtype=numpy.float32, mode="r", shape=(count, dim))
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), count * dim * 4, access=mmap.ACCESS_READ)
+        return memoryview(mapped).cast("f")
+
+    def __len__(self) -> int:
+        self._load()
+        return len(self.meta["items"])
+
+    def texts(self, kind: str) -> list:
+        """Textes indexés d'une sorte ("summary", "photo", "preference"), du plus ancien au plus récent."""
+        self._load()
+        return [item["text"] for item in self.meta["items"] if item["kind"] == kind]
+
+    def search(self, query: str, k: int = TOP_K, min_score: float = MIN_SCORE) -> list:
+        """Les `k` souvenirs les plus proches de `query` : liste de (score, {"kind", "text"})."""
+        self._load()
+        items = self.meta["items"]
+        if not items or self._vectors is None or self.meta.get("method") != embedding_method():
+            return []
+        query_vector = embed_texts([query])[0]
+        dim = self.meta["dim"]
+        if len(query_vector) != dim:
+            return []
+        if numpy is not None:
+            scores = (self._vectors @ numpy.asarray(query_vector, dtype=numpy.float32)).tolist()
+        else:
+            active = [(j, q) for j, q in enumerate(query_vector) if q]
+            scores = [sum(self._vectors[i * dim + j] * q for j, q in active) for i in range(len(items))]
+        ranked = sorted(range(len(items)), key=lambda i: scores[i], reverse=True)[:k]
+        return [(scores[i], {"kind": items[i]["kind"], "text": items[i]["text"]})
+                for i in ranked if scores[i] >= min_score]
+
+    # --- Construction (service de préparation) ---
+
+    def update(self, memories: list) -> int:
+        """
+        Met l'index en accord avec `memories`. Les souvenirs déjà indexés gardent leur vecteur ;
+        seuls les nouveaux sont vectorisés. Si rien n'a été retiré, les vecteurs sont ajoutés en
+        fin de fichier, sinon le fichier est réécrit. Renvoie le nombre de souvenirs vectorisés.
+        """
+        self._load()
+        method = embedding_method()
+        old_items = self.meta["items"] if self.meta.get("method") == method else []
+        old_keys = [item["key"] for item in old_items]
+        wanted, seen = [], set()
+        for memory in memories:
+            key = _memory_key(memory)
+            if key not in seen:
+                seen.add(key)
+                wanted.append(dict(memory, key=key))
+        known = set(old_keys)
+        new_items = [item for item in wanted if item["key"] not in known]
+        if not new_items and len(wanted) == len(old_items):
+            return 0
+        new_vectors = embed_texts([item["text"] for item in new_items], background=True)
+        dim = len(new_vectors[0]) if new_vectors else self.meta["dim"]
+        os.makedirs(self.directory, exist_ok=True)
+
+        old_path = self._vectors_path(self.meta)
+        if seen.issuperset(old_keys) and old_items and dim == self.meta["dim"]:
+            # Ajout seul : les lecteurs ne lisent que les lignes annoncées par leur items.json,
+            # les nouvelles ne sont visibles qu'une fois items.json remplacé
+            vectors_name = os.path.basename(old_path)
+            with open(old_path, "r+b") as f:
+                # Lignes orphelines d'un ajout interrompu avant l'écriture de items.json : retirées,
+                # sinon les vecteurs suivants seraient décalés par rapport aux items
+                f.truncate(len(old_items) * dim * 4)
+                f.seek(0, os.SEEK_END)
+                for vector in new_vectors:
+                    f.write(array.array("f", vector).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            items = old_items + new_items
+        else:
+            # Réécriture dans un nouveau fichier : l'ancien reste intact pour les lecteurs en cours
+            row = {key: i for i, key in enumerate(old_keys)}
+            fresh = dict(zip((item["key"] for item in new_items), new_vectors))
+            vectors_name = f"vectors.{uuid.uuid4().hex[:12]}.f32"
+            tmp_path = os.path.join(self.directory, vectors_name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                for item in wanted:
+                    vector = fresh[item["key"]] if item["key"] in fresh else self._row(row[item["key"]])
+                    f.write(array.array("f", vector).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(self.directory, vectors_name))
+            items = wanted
+        # items.json en dernier : il désigne le fichier de vecteurs et le nombre de lignes valides
+        atomic_write_json(self.items_path, {"method": method, "dim": dim, "vectors": vectors_name, "items": items})
+        if os.path.basename(old_path) != vectors_name and os.path.exists(old_path):
+            os.remove(old_path)
+        print(f"[DEBUG] Index des souvenirs de {self.username} : {len(new_items)} vectorisé(s), "
+              f"{len(items)} au total.")
+        self._loaded_mtime = None
+        return len(new_items)
+
+    def _row(self, i: int) -> list:
+        dim = self.meta["dim"]
+        if numpy is not None:
+            return self._vectors[i].tolist()
+        return list(self._vectors[i * dim:(i + 1) * dim])
+
+
+def update_user_index(username: str, user_data: dict) -> int:
+    return MemoryIndex(username).update(user_memories(user_data))
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 3:
+        print('Usage : python memory_index.py <utilisateur> "<question>"')
+        sys.exit(1)
+    from storage import canonical_username
+    for score, memory in MemoryIndex(canonical_username(sys.argv[1])).search(sys.argv[2]):
+        print(f"{score:.3f}  [{memory['kind']}] {memory['text']}")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : model_registry.py
+Description : Registre des modèles chargés dans le processus (Whisper pour la transcription).
+              - Un modèle n'est chargé qu'à sa première utilisation, ou par warmup() dans un
+                thread d'arrière-plan ; ready() indique s'il est en mémoire.
+              - use() garde le modèle pendant son utilisation ; un modèle inutilisé depuis son
+                délai d'inactivité est déchargé pour rendre la mémoire.
+              - Whisper : taille choisie par REMEMORY_WHISPER_MODEL (tiny, base, small, medium ;
+                medium par défaut), déchargé après REMEMORY_WHISPER_IDLE secondes (600 ; 0 pour
+                le garder), préchargé au démarrage si REMEMORY_WHISPER_WARMUP=1. Utilisé par
+                transcription_worker.py : chaque processus de transcription a son registre
+                et renvoie status() avec chaque réponse (état exposé dans /inference_stats).
+"""
+
+import os
+import gc
+import time
+import threading
+from contextlib import contextmanager
+
+WHISPER_MODEL = os.environ.get("REMEMORY_WHISPER_MODEL", "medium")
+WHISPER_IDLE = float(os.environ.get("REMEMORY_WHISPER_IDLE", "600"))
+WHISPER_WARMUP = os.environ.get("REMEMORY_WHISPER_WARMUP", "0") == "1"
+# Fréquence de vérification des modèles inactifs
+REAPER_INTERVAL = 30
+
+
+class _Entry:
+    def __init__(self, loader, idle_unload: float):
+        self.loader = loader
+        self.idle_unload = idle_unload
+        self.model = None
+        self.users = 0
+        self.last_used = 0.0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.lock = threading.Lock()  # un seul chargement à la fois
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def register(self, name: str, loader, idle_unload: float = 0) -> None:
+        """`loader()` renvoie le modèle ; `idle_unload` secondes d'inactivité avant déchargement (0 : jamais)."""
+        self._entries[name] = _Entry(loader, idle_unload)
+
+    def ready(self, name: str) -> bool:
+        return self._entries[name].model is not None
+
+    def _load(self, name: str):
+        entry = self._entries[name]
+        with entry.lock:
+            if entry.model is None:
+                print(f"[DEBUG] Chargement du modèle {name}...")
+                start = time.monotonic()
+                entry.model = entry.loader()
+                entry.loads += 1
+                entry.load_seconds = time.monotonic() - start
+                print(f"[DEBUG] Modèle {name} chargé en {entry.load_seconds:.1f} s.")
+                self._start_reaper()
+            return entry.model
+
+    @contextmanager
+    def use(self, name: str):
+        """Fournit le modèle (chargé si besoin) et empêche son déchargement pendant l'utilisation."""
+        entry = self._entries[name]
+        with self._lock:
+            entry.users += 1
+        try:
+            yield self._load(name)
+        finally:
+            with self._lock:
+                entry.users -= 1
+                entry.last_used = time.monotonic()
+
+    def warmup(self, name: str) -> threading.Thread:
+        """Charge le modèle dans un thread d'arrière-plan (sans bloquer l'appelant)."""
+        def run():
+            try:
+                self._load(name)
+                self._entries[name].last_used = time.monotonic()
+            except Exception as e:
+                print(f"[ERROR] Préchargement du modèle {name} impossible : {e}")
+        thread = threading.Thread(target=run, name=f"warmup-{name}", daemon=True)
+        thread.start()
+        return thread
+
+    def unload_idle(self) -> None:
+        now = time.monotonic()
+        for name, entry in self._entries.items():
+            with self._lock:
+                idle = (entry.model is not None and entry.users == 0 and entry.idle_unload > 0
+                        and now - entry.last_used >= entry.idle_unload)
+                if idle:
+                    entry.model = None
+            if idle:
+                print(f"[DEBUG] Modèle {name} inutilisé depuis {entry.idle_unload:.0f} s : déchargé.")
+                gc.collect()
+                _release_gpu_memory()
+
+    def _start_reaper(self) -> None:
+        if self._reaper is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(REAPER_INTERVAL)
+                self.unload_idle()
+        self._reaper = threading.Thread(target=run, name="model-reaper", daemon=True)
+        self._reaper.start()
+
+    def status(self) -> dict:
+        return {name: {"ready": entry.model is not None, "in_use": entry.users, "loads": entry.loads,
+                       "last_load_s": round(entry.load_seconds, 1), "idle_unload_s": entry.idle_unload}
+                for name, entry in self._entries.items()}
+
+
+def _release_gpu_memory() -> None:
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+def _load_whisper():
+    # Import différé : whisper importe torch, coûteux en temps et en mémoire
+    import whisper
+    return whisper.load_model(WHISPER_MODEL)
+
+
+registry = ModelRegistry()
+registry.register("whisper", _load_whisper, idle_unload=WHISPER_IDLE)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : preparer_service.py
+Description : Service unique de préparation des données (résumés) pour tous les utilisateurs.
+              - Remplace le processus data_preparer.py lancé à chaque connexion : la route de
+                connexion inscrit simplement l'utilisateur dans le registre (enqueue_user) et
+                démarre le service s'il ne tourne pas encore.
+              - Registre des utilisateurs actifs : un fichier par utilisateur dans
+                preparer_registry/ (REMEMORY_PREPARER_REGISTRY), rafraîchi à chaque connexion ;
+                un utilisateur sans connexion depuis REMEMORY_PREPARER_USER_TTL secondes
+                (24 h par défaut) en est retiré.
+              - Déclenché par l'activité : l'application note chaque ajout de messages dans
+                preparer_registry/<username>.activity (notify_activity). Un résumé est lancé après
+                REMEMORY_PREPARER_BATCH_MESSAGES nouveaux messages (10) ou REMEMORY_PREPARER_IDLE_SECONDS
+                secondes sans nouveau message (120) ; un utilisateur sans activité ne coûte aucune
+                lecture de son historique. Si watchdog est installé, le service est réveillé dès
+                l'écriture de la notification.
+              - Un seul cycle à la fois par utilisateur, au plus REMEMORY_PREPARER_CONCURRENCY
+                cycles en parallèle (2 par défaut), en servant d'abord les utilisateurs servis
+                le moins récemment.
+              - Une seule instance du service : verrou locks/_preparer.lock.
+              Usage : python preparer_service.py
+"""
+
+import os
+import sys
+import time
+import json
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import records
+from unit_of_work import atomic_write_json
+from user_locks import acquire_user_lock, LockTimeout
+
+REGISTRY_DIR = os.environ.get("REMEMORY_PREPARER_REGISTRY", "preparer_registry")
+PID_FILE = os.path.join(REGISTRY_DIR, "service.pid")
+CONCURRENCY = int(os.environ.get("REMEMORY_PREPARER_CONCURRENCY", "2"))
+USER_TTL = float(os.environ.get("REMEMORY_PREPARER_USER_TTL", str(24 * 3600)))
+SERVICE_LOCK = "_preparer"
+# Déclenchement d'un résumé : N nouveaux messages, ou T secondes sans nouveau message
+BATCH_MESSAGES = int(os.environ.get("REMEMORY_PREPARER_BATCH_MESSAGES", "10"))
+IDLE_SECONDS = float(os.environ.get("REMEMORY_PREPARER_IDLE_SECONDS", "120"))
+POLL_INTERVAL = 5
+RETRY_DELAY = 60
+
+
+# Les noms reçus sont ceux de storage.canonical_username (session de l'application), les mêmes
+# que ceux utilisés par DataPreparer pour lire l'historique et écrire les résumés.
+def _registry_path(username: str) -> str:
+    return os.path.join(REGISTRY_DIR, f"{username}.user")
+
+
+def _activity_path(username: str) -> str:
+    return os.path.join(REGISTRY_DIR, f"{username}.activity")
+
+
+def notify_activity(username: str, messages: list) -> None:
+    """
+    Abonné aux ajouts de messages (history_store.add_append_listener) côté application :
+    compte les messages ajoutés et note l'heure de la dernière activité. Les ajouts sont faits
+    sous le verrou "w" de l'utilisateur, qui protège aussi cette mise à jour.
+    """
+    activity = read_activity(username)
+    activity["appended"] += len(messages)
+    activity["last_activity"] = time.time()
+    atomic_write_json(_activity_path(username), activity)
+
+
+def read_activity(username: str) -> dict:
+    try:
+        with open(_activity_path(username), "rb") as f:
+            return records.decode(f.read())
+    except (OSError, records.DecodeError):
+        return {"appended": 0, "last_activity": 0.0}
+
+
+def register_user(username: str) -> None:
+    """Inscrit (ou rafraîchit) l'utilisateur dans le registre des utilisateurs actifs."""
+    os.makedirs(REGISTRY_DIR, exist_ok=True)
+    with open(_registry_path(username), "w", encoding="utf-8") as f:
+        json.dump({"username": username}, f)
+
+
+def active_users() -> dict:
+    """Utilisateurs inscrits -> date de leur dernière connexion."""
+    users = {}
+    if not os.path.exists(REGISTRY_DIR):
+        return users
+    for name in os.listdir(REGISTRY_DIR):
+        if name.endswith(".user"):
+            try:
+                users[name[:-len(".user")]] = os.path.getmtime(os.path.join(REGISTRY_DIR, name))
+            except OSError:
+                continue
+    return users
+
+
+def service_running() -> bool:
+    try:
+        with open(PID_FILE, "r") as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def ensure_service() -> None:
+    """Démarre le service en arrière-plan s'il ne tourne pas (une instance en trop s'arrête seule)."""
+    if service_running():
+        return
+    try:
+        subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                        "preparer_service.py")])
+        print("[DEBUG] Service de préparation lancé en arrière-plan.")
+    except Exception as e:
+        print(f"[ERROR] Erreur lors du lancement du service de préparation : {e}")
+
+
+def enqueue_user(username: str) -> None:
+    """À appeler à la connexion : inscrit l'utilisateur et s'assure que le service tourne."""
+    register_user(username)
+    ensure_service()
+
+
+class PreparerService:
+    def __init__(self, concurrency: int = CONCURRENCY):
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="preparer")
+        self.preparers = {}     # username -> DataPreparer
+        self.in_flight = set()
+        self.seen = {}          # username -> compteur "appended" au début du dernier cycle
+        self.retry_at = {}      # username -> date de nouvel essai après un échec
+        self.last_run = {}      # username -> date du dernier cycle (équité)
+        self.wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def _preparer(self, username: str):
+        from data_preparer import DataPreparer, merge_legacy_user_files
+        if username not in self.preparers:
+            merge_legacy_user_files(username)
+            self.preparers[username] = DataPreparer(username)
+        return self.preparers[username]
+
+    def _run(self, username: str, previous_seen) -> None:
+        try:
+            self._preparer(username).run_cycle()
+        except Exception as e:
+            # Verrou tenu par l'application (LockTimeout) ou autre erreur : nouvel essai plus tard
+            print(f"[ERROR] Cycle de préparation de {username} en échec : {e}")
+            with self._lock:
+                if previous_seen is None:
+                    self.seen.pop(username, None)
+                else:
+                    self.seen[username] = previous_seen
+                self.retry_at[username] = time.time() + RETRY_DELAY
+        finally:
+            with self._lock:
+                self.last_run[username] = time.time()
+                self.in_flight.discard(username)
+            self.wake.set()
+
+    def _forget(self, username: str) -> None:
+        print(f"[DEBUG] {username} inactif depuis plus de {USER_TTL:.0f} s : retiré du registre.")
+        for state in (self.preparers, self.seen, self.retry_at, self.last_run):
+            state.pop(username, None)
+        for path in (_registry_path(username), _activity_path(username)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _is_due(self, username: str, activity: dict, now: float) -> bool:
+        """Nouveaux messages en nombre suffisant, ou conversation au repos depuis IDLE_SECONDS."""
+        if self.retry_at.get(username, 0) > now:
+            return False
+        if username not in self.seen:
+            return True  # premier passage : rattrapage de ce qui n'a pas encore été résumé
+        pending = activity["appended"] - self.seen[username]
+        if pending <= 0:
+            return False
+        return pending >= BATCH_MESSAGES or now - activity["last_activity"] >= IDLE_SECONDS
+
+    def schedule(self) -> None:
+        """Lance les cycles dus, les moins récemment servis d'abord, dans la limite de concurrence."""
+        now = time.time()
+        with self._lock:
+            due = []
+            for username, last_login in active_users().items():
+                if username in self.in_flight:
+                    continue
+                activity = read_activity(username)
+                if now - max(last_login, activity["last_activity"]) > USER_TTL:
+                    self._forget(username)
+                elif self._is_due(username, activity, now):
+                    due.append((username, activity["appended"]))
+            due.sort(key=lambda item: self.last_run.get(item[0], 0))
+            for username, appended in due[:self.concurrency - len(self.in_flight)]:
+                self.in_flight.add(username)
+                previous_seen = self.seen.get(username)
+                self.seen[username] = appended
+                self.executor.submit(self._run, username, previous_seen)
+
+    def run_forever(self) -> None:
+        observer = _watch_registry(self.wake)
+        try:
+            while True:
+                self.schedule()
+                # Réveil immédiat sur notification (watchdog) ou fin de cycle, sinon toutes les POLL_INTERVAL s
+                self.wake.wait(POLL_INTERVAL)
+                self.wake.clear()
+        finally:
+            if observer is not None:
+                observer.stop()
+
+
+def _watch_registry(wake: threading.Event):
+    """Surveille le registre avec watchdog (inotify) s'il est installé ; sinon simple attente."""
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        return None
+
+    class _Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if str(event.src_path).endswith(".activity"):
+                wake.set()
+
+    observer = Observer()
+    observer.schedule(_Handler(), REGISTRY_DIR, recursive=False)
+    observer.start()
+    print("[DEBUG] Registre surveillé par watchdog.")
+    return observer
+
+
+def main() -> None:
+    try:
+        acquire_user_lock(SERVICE_LOCK, "w", timeout=0)
+    except LockTimeout:
+        print("[DEBUG] Le service de préparation tourne déjà.")
+        return
+    os.makedirs(REGISTRY_DIR, exist_ok=True)
+    with open(PID_FILE, "w") as f:
+        f.write(str(os.getpid()))
+    print(f"[DEBUG] Service de préparation démarré (pid {os.getpid()}, {CONCURRENCY} cycle(s) en parallèle).")
+    PreparerService().run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : records.py
+Description : Modèle typé des fiches et de l'historique, et codec JSON rapide (msgspec).
+              - UserRecord, ImageCard, Message, Summary décrivent les données stockées ;
+                les clés manquantes reçoivent leur valeur par défaut au décodage (plus besoin
+                de setdefault à la main).
+              - decode() renvoie des dict/list Python ordinaires, pour que le reste de
+                l'application continue de manipuler des dictionnaires : décodage msgspec sans
+                schéma (une seule passe), puis ajout des valeurs par défaut des champs absents.
+                Les clés non décrites par le schéma (anciens formats, champs ajoutés) sont
+                conservées telles quelles : une fiche relue puis sauvegardée ne perd rien.
+                (msgspec ne sait pas garder les champs inconnus d'une Struct : un décodage
+                typé les perdrait, et le reconvertir en dictionnaires coûterait plus que
+                json.loads.)
+              - encode() produit du JSON compact (production) ou indenté si la variable
+                d'environnement REMEMORY_JSON_PRETTY vaut 1 (débogage).
+              Voir bench_records.py pour la comparaison avec le module json standard.
+"""
+
+import os
+from typing import Any, Union
+import msgspec
+from msgspec import UNSET, UnsetType
+
+
+class ImageCard(msgspec.Struct):
+    # Identifiant stable de la carte (attribué à l'enregistrement, voir storage.assign_image_ids)
+    id: Union[str, UnsetType] = UNSET
+    filename: str = ""
+    path: str = ""
+    description: str = ""
+    tags: list[str] = []
+    # Ancien format : un seul tag texte
+    tag: Union[str, UnsetType] = UNSET
+
+
+class Message(msgspec.Struct):
+    role: str
+    content: str = ""
+    id: Union[str, UnsetType] = UNSET
+    timestamp: Union[str, UnsetType] = UNSET
+
+
+class Summary(msgspec.Struct):
+    resumer: str = ""
+
+
+class UserRecord(msgspec.Struct):
+    # Les sections (images, historique, résumés) sont absentes d'un profil seul : UNSET
+    # permet de distinguer "section non chargée" de "section vide".
+    nom: Union[str, UnsetType] = UNSET
+    preferences: dict[str, Any] = {}
+    current_question: Union[str, UnsetType] = UNSET
+    ton: Union[str, UnsetType] = UNSET
+    language: Union[str, UnsetType] = UNSET
+    images: Union[list[ImageCard], UnsetType] = UNSET
+    conversation_history: Union[list[Message], UnsetType] = UNSET
+    conversation_resumer: Union[list[Summary], UnsetType] = UNSET
+
+
+# Type attendu pour chaque sorte de document : (Struct, liste de Struct ?)
+SCHEMAS = {
+    "user": (UserRecord, False),
+    "images": (ImageCard, True),
+    "history": (Message, True),
+    "summaries": (Summary, True),
+    "message": (Message, False)
+}
+# Sections d'une fiche complète et type de leurs éléments
+SECTIONS = {"images": ImageCard, "conversation_history": Message, "conversation_resumer": Summary}
+
+
+def _field_defaults(struct) -> list:
+    """(clé, valeur par défaut ou fabrique) des champs de `struct` qui ont une valeur par défaut."""
+    defaults = []
+    for field in msgspec.structs.fields(struct):
+        if field.default_factory is not msgspec.NODEFAULT:
+            defaults.append((field.encode_name, field.default_factory, True))
+        elif field.default is not msgspec.NODEFAULT and field.default is not UNSET:
+            defaults.append((field.encode_name, field.default, False))
+    return defaults
+
+
+DEFAULTS = {struct: _field_defaults(struct) for struct in (UserRecord, ImageCard, Message, Summary)}
+
+_untyped_decoder = msgspec.json.Decoder()
+_encoder = msgspec.json.Encoder()
+
+# Erreur levée pour un document JSON illisible (ou tronqué)
+DecodeError = msgspec.DecodeError
+
+PRETTY = os.environ.get("REMEMORY_JSON_PRETTY", "0") == "1"
+
+
+def decode(data: bytes, kind: str = None):
+    """
+    Décode un document JSON. Si `kind` est fourni, les champs absents du schéma
+    correspondant reçoivent leur valeur par défaut (les autres clés sont gardées).
+    """
+    raw = _untyped_decoder.decode(data)
+    if kind is None:
+        return raw
+    struct, many = SCHEMAS[kind]
+    for item in raw if many and isinstance(raw, list) else (raw,):
+        _fill(item, struct)
+    return raw
+
+
+def _fill(obj, struct) -> None:
+    """Ajoute à `obj` les valeurs par défaut des champs absents (sections d'une fiche comprises)."""
+    if not isinstance(obj, dict):
+        return
+    for key, default, factory in DEFAULTS[struct]:
+        if key not in obj:
+            obj[key] = default() if factory else default
+    if struct is UserRecord:
+        for key, item_struct in SECTIONS.items():
+            items = obj.get(key)
+            if isinstance(items, list):
+                for item in items:
+                    _fill(item, item_struct)
+
+
+def encode(obj, pretty: bool = None) -> bytes:
+    """Encode en JSON UTF-8 (compact, ou indenté sur 4 espaces en mode débogage)."""
+    data = _encoder.encode(obj)
+    if PRETTY if pretty is None else pretty:
+        return msgspec.json.format(data, indent=4)
+    return data
+
+
+def clone(obj):
+    """Copie profonde d'un document JSON (aller-retour par le codec, plus rapide que deepcopy)."""
+    return _untyped_decoder.decode(_encoder.encode(obj))
+
+
+def encode_line(obj) -> bytes:
+    """Encode un objet sur une seule ligne (journal JSONL)."""
+    return _encoder.encode(obj) + b"\n"
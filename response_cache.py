@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : response_cache.py
+Description : Cache disque des réponses du modèle pour les requêtes déterministes
+              (tags, descriptions d'images, résumés). La discussion libre n'y passe pas.
+              - Clé : empreinte SHA-256 du modèle, des messages (images comprises) et des options.
+              - Une entrée par fichier : llm_cache/<2 premiers caractères>/<empreinte>.json.
+              - Durée de vie : REMEMORY_LLM_CACHE_TTL secondes (7 jours par défaut).
+              - Taille bornée : REMEMORY_LLM_CACHE_MB (64 Mo par défaut) ; au-delà, les entrées
+                les moins récemment utilisées (date de modification, rafraîchie à chaque lecture)
+                sont supprimées.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import records
+from unit_of_work import atomic_write_json
+
+CACHE_DIR = os.environ.get("REMEMORY_LLM_CACHE_DIR", "llm_cache")
+TTL = float(os.environ.get("REMEMORY_LLM_CACHE_TTL", str(7 * 24 * 3600)))
+MAX_BYTES = int(float(os.environ.get("REMEMORY_LLM_CACHE_MB", "64")) * 1024 * 1024)
+
+
+def cache_key(model: str, messages: list, options: dict = None) -> str:
+    payload = json.dumps({"model": model, "messages": messages, "options": options or {}},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, directory: str = CACHE_DIR, ttl: float = TTL, max_bytes: int = MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._total_bytes = None  # calculé au premier ajout
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str):
+        """Renvoie la réponse en cache (dict {"message": ...}) ou None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = records.decode(f.read())
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, records.DecodeError) as e:
+            print(f"[ERROR] Entrée de cache illisible {path} : {e}")
+            self.misses += 1
+            return None
+        if time.time() - entry.get("created", 0) > self.ttl:
+            self._remove(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)  # marque l'entrée comme récemment utilisée
+        except OSError:
+            pass
+        self.hits += 1
+        return entry["response"]
+
+    def put(self, key: str, response: dict) -> None:
+        path = self._path(key)
+        try:
+            atomic_write_json(path, {"created": time.time(), "response": response})
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f"[ERROR] Écriture du cache impossible : {e}")
+            return
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_size()
+            else:
+                self._total_bytes += size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self) -> list:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".json") and not name.startswith(".tmp_"):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        """Supprime les entrées les plus anciennes jusqu'à revenir à 90 % de la taille maximale."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+        self._total_bytes = total
+        print(f"[DEBUG] Cache des réponses : {removed} entrée(s) supprimée(s), {total} octets.")
+
+
+_cache = None
+
+
+def get_response_cache() -> ResponseCache:
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
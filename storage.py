@@ -0,0 +1,595 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : storage.py
+Description : Couche de stockage interchangeable pour les fiches utilisateur, les images,
+              l'historique et les résumés.
+              - JsonStorage : fichiers users/<username>.json et historique/<username>.jsonl
+                (comportement historique, par défaut).
+              La fiche utilisateur est découpée en sections chargées à la demande :
+                - "profile"   : nom, préférences, question en cours (toujours chargée, petite) ;
+                - "images"    : cartes images (clé "images") ;
+                - "history"   : copie de l'historique (clé "conversation_history") ;
+                - "summaries" : résumés (clé "conversation_resumer").
+              load_user(username, sections) ne lit que les sections demandées, et save_user
+              n'écrit que les sections présentes dans la fiche passée. En JSON, le profil reste
+              dans users/<username>.json et les autres sections sont dans users/<username>/.
+              Une ancienne fiche monolithique est lue telle quelle (aucune écriture sous le
+              verrou "r") ; elle est découpée à la première écriture, sous le verrou "w", ou
+              par python storage.py split-json.
+              - SQLiteStorage : base SQLite en mode WAL avec des tables indexées (users,
+                preferences, images, image_tags, messages, summaries). Les ajouts de messages
+                et de résumés sont de simples INSERT, les lectures des requêtes indexées.
+              canonical_username() donne le nom unique sous lequel un utilisateur est rangé
+              (application, service de préparation, index) quelle que soit la casse saisie.
+              Le backend est choisi par la variable d'environnement REMEMORY_STORAGE
+              ("json" ou "sqlite") ; la base est dans REMEMORY_DB_PATH (rememory.db par défaut).
+              Usage : python storage.py import-json [username ...]
+                      -> importe les fichiers JSON existants dans la base SQLite.
+                      python storage.py split-json [username ...]
+                      -> découpe les anciennes fiches JSON monolithiques en sections.
+"""
+
+import os
+import sqlite3
+import datetime
+import threading
+import uuid
+import history_store
+import unit_of_work
+import records
+from user_cache import user_cache
+from user_locks import user_lock, user_transaction
+
+USERS_DIR = "users"
+DEFAULT_DB_PATH = "rememory.db"
+# Nombre de messages récents exposés dans la clé "conversation_history" de la fiche (SQLite)
+RECENT_HISTORY_SIZE = 20
+
+# Sections de la fiche utilisateur (hors profil) et clé correspondante dans la fiche
+SECTION_KEYS = {
+    "images": "images",
+    "history": "conversation_history",
+    "summaries": "conversation_resumer"
+}
+ALL_SECTIONS = ("profile",) + tuple(SECTION_KEYS)
+
+
+def _requested_sections(sections) -> list:
+    """Sections à charger en plus du profil (toutes si `sections` vaut None)."""
+    if sections is None:
+        return list(SECTION_KEYS)
+    unknown = set(sections) - set(ALL_SECTIONS)
+    if unknown:
+        raise ValueError(f"Sections inconnues : {sorted(unknown)}")
+    return [section for section in SECTION_KEYS if section in sections]
+
+
+def canonical_username(username: str) -> str:
+    """
+    Nom sous lequel les données de l'utilisateur sont rangées, à utiliser partout (fiche,
+    historique, verrous, service de préparation, index). Un utilisateur existant garde la casse
+    de sa fiche ("smato" reste "smato") ; un nouveau nom prend une majuscule initiale.
+    """
+    name = username.strip()
+    for existing in get_storage().list_users():
+        if existing.lower() == name.lower():
+            return existing
+    return name.capitalize()
+
+
+def assign_image_ids(images: list) -> bool:
+    """
+    Donne un identifiant stable ("id") aux cartes images qui n'en ont pas encore (anciennes
+    fiches). Le chemin ne suffit pas : deux cartes peuvent désigner le même fichier.
+    Renvoie True si une carte a reçu un identifiant.
+    """
+    assigned = False
+    for image in images:
+        if not image.get("id"):
+            image["id"] = uuid.uuid4().hex[:12]
+            assigned = True
+    return assigned
+
+
+def load_image_cards(username: str) -> list:
+    """
+    Cartes images de l'utilisateur, toutes identifiées : les identifiants manquants sont
+    attribués et enregistrés une seule fois, sous le verrou de l'utilisateur.
+    """
+    with user_lock(username, "r"):
+        record = get_storage().load_user(username, ("images",)) or {}
+    images = record.get("images") or []
+    if all(image.get("id") for image in images):
+        return images
+    with user_transaction(username):
+        record = get_storage().load_user(username, ("images",))
+        if record is None:
+            return []
+        # save_user attribue les identifiants manquants
+        get_storage().save_user(username, record)
+    return record["images"]
+
+
+def default_user_record(username: str) -> dict:
+    return {
+        "nom": username,
+        "preferences": {},
+        "conversation_history": [],
+        "images": [],
+        "conversation_resumer": []
+    }
+
+
+class JsonStorage:
+    """Stockage sur fichiers JSON (profil + un fichier par section + journal JSONL)."""
+    name = "json"
+
+    def user_path(self, username: str) -> str:
+        return os.path.join(USERS_DIR, f"{username}.json")
+
+    def section_path(self, username: str, section: str) -> str:
+        return os.path.join(USERS_DIR, username, f"{section}.json")
+
+    @staticmethod
+    def _is_legacy(profile: dict) -> bool:
+        return any(key in profile for key in SECTION_KEYS.values())
+
+    def split_legacy(self, username: str) -> bool:
+        """
+        Découpe une ancienne fiche monolithique en sections (une seule fois). Écrit des
+        fichiers : à appeler sous le verrou "w" de l'utilisateur. Renvoie True si la fiche
+        a été découpée.
+        """
+        profile = user_cache.load(self.user_path(username), "user")
+        if profile is None or not self._is_legacy(profile):
+            return False
+        for section, key in SECTION_KEYS.items():
+            if key in profile:
+                user_cache.save(self.section_path(username, section), profile.pop(key))
+        user_cache.save(self.user_path(username), profile)
+        print(f"[DEBUG] Fiche de {username} découpée en sections.")
+        return True
+
+    def load_user(self, username: str, sections=None):
+        profile = user_cache.load(self.user_path(username), "user")
+        if profile is None:
+            return None
+        requested = _requested_sections(sections)
+        if self._is_legacy(profile):
+            # Ancienne fiche pas encore découpée : sections lues dans la fiche, sans écrire
+            legacy, record = profile, {k: v for k, v in profile.items() if k not in SECTION_KEYS.values()}
+            for section in requested:
+                record[SECTION_KEYS[section]] = legacy.get(SECTION_KEYS[section]) or []
+            return record
+        record = profile
+        for section in requested:
+            data = user_cache.load(self.section_path(username, section), section)
+            record[SECTION_KEYS[section]] = data if data is not None else []
+        return record
+
+    def save_user(self, username: str, record: dict) -> None:
+        # Une ancienne fiche est découpée avant d'être réécrite : ses sections absentes de
+        # `record` (non chargées) sont ainsi conservées
+        self.split_legacy(username)
+        assign_image_ids(record.get("images") or [])
+        profile = {k: v for k, v in record.items() if k not in SECTION_KEYS.values()}
+        user_cache.save(self.user_path(username), profile)
+        for section, key in SECTION_KEYS.items():
+            if key in record:
+                user_cache.save(self.section_path(username, section), record[key])
+
+    def user_version(self, username: str) -> tuple:
+        """Signature (mtime, taille) du profil, des images et des résumés : change à chaque écriture."""
+        version = []
+        for path in (self.user_path(username), self.section_path(username, "images"),
+                     self.section_path(username, "summaries")):
+            try:
+                st = os.stat(path)
+                version.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def load_history(self, username: str) -> list:
+        return history_store.load_history(username)
+
+    def load_history_tail(self, username: str, limit: int = None) -> list:
+        return history_store.load_tail(username, limit)
+
+    def iter_history(self, username: str):
+        return history_store.iter_history(username)
+
+    def iter_history_since(self, username: str, message_id: str = None):
+        return history_store.iter_history_since(username, message_id)
+
+    def append_messages(self, username: str, history: list) -> list:
+        return history_store.append_messages(username, history)
+
+    def add_summary(self, username: str, text: str) -> None:
+        self.split_legacy(username)
+        path = self.section_path(username, "summaries")
+        summaries = user_cache.load(path, "summaries")
+        if not isinstance(summaries, list):
+            summaries = []
+        summaries.append({"resumer": text})
+        user_cache.save(path, summaries)
+
+    def list_users(self) -> list:
+        if not os.path.exists(USERS_DIR):
+            return []
+        return sorted(f.rsplit(".", 1)[0] for f in os.listdir(USERS_DIR) if f.endswith(".json"))
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    nom TEXT,
+    current_question TEXT,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS preferences (
+    username TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (username, question)
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    filename TEXT,
+    path TEXT,
+    description TEXT,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS idx_images_user ON images (username, position);
+CREATE TABLE IF NOT EXISTS image_tags (
+    image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    tag TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_image_tags_image ON image_tags (image_id);
+CREATE INDEX IF NOT EXISTS idx_image_tags_tag ON image_tags (tag);
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT,
+    timestamp TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (username, seq);
+CREATE TABLE IF NOT EXISTS summaries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_summaries_user ON summaries (username, id);
+CREATE TABLE IF NOT EXISTS user_versions (
+    username TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+# Clés du profil stockées dans des colonnes ou tables dédiées
+PROFILE_KEYS = ("nom", "current_question", "preferences")
+IMAGE_KEYS = ("filename", "path", "description", "tags")
+
+
+class SQLiteStorage:
+    """Stockage SQLite (WAL) : une connexion par thread, tables indexées par utilisateur."""
+    name = "sqlite"
+
+    def __init__(self, db_path: str = DEFAULT_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def _user_key(self, username: str, section: str = "messages") -> str:
+        return f"sqlite:{self.db_path}:{username}:{section}"
+
+    # --- Fiche utilisateur ---
+
+    def load_user(self, username: str, sections=None):
+        uow = unit_of_work.current()
+
+        def staged(section):
+            return uow.staged_document(self._user_key(username, section)) if uow is not None else None
+
+        record = staged("profile")
+        record = dict(record) if record is not None else self._load_profile(username)
+        if record is None:
+            return None
+        loaders = {"images": self._load_images, "history": self._load_recent_history,
+                   "summaries": self._load_summaries}
+        for section in _requested_sections(sections):
+            data = staged(section)
+            record[SECTION_KEYS[section]] = data if data is not None else loaders[section](username)
+        return record
+
+    def _load_profile(self, username: str):
+        conn = self._connect()
+        row = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            return None
+        record = records.decode(row["extra"] or "{}")
+        record["nom"] = row["nom"] or username
+        if row["current_question"] is not None:
+            record["current_question"] = row["current_question"]
+        record["preferences"] = {
+            r["question"]: r["answer"] for r in conn.execute(
+                "SELECT question, answer FROM preferences WHERE username = ? ORDER BY position",
+                (username,))
+        }
+        return record
+
+    def _load_images(self, username: str) -> list:
+        conn = self._connect()
+        tags = {}
+        for t in conn.execute(
+                "SELECT t.image_id, t.tag FROM image_tags t JOIN images i ON i.id = t.image_id "
+                "WHERE i.username = ? ORDER BY t.rowid", (username,)):
+            tags.setdefault(t["image_id"], []).append(t["tag"])
+        return [
+            dict(records.decode(r["extra"] or "{}"), filename=r["filename"], path=r["path"],
+                 description=r["description"], tags=tags.get(r["id"], []))
+            for r in conn.execute(
+                "SELECT id, filename, path, description, extra FROM images WHERE username = ? ORDER BY position",
+                (username,))
+        ]
+
+    def _load_recent_history(self, username: str) -> list:
+        recent = self._connect().execute(
+            "SELECT role, content, timestamp FROM messages WHERE username = ? ORDER BY seq DESC LIMIT ?",
+            (username, RECENT_HISTORY_SIZE)).fetchall()
+        return [dict(r) for r in reversed(recent)]
+
+    def _load_summaries(self, username: str) -> list:
+        return [
+            {"resumer": r["content"]} for r in self._connect().execute(
+                "SELECT content FROM summaries WHERE username = ? ORDER BY id", (username,))
+        ]
+
+    def save_user(self, username: str, record: dict) -> None:
+        assign_image_ids(record.get("images") or [])
+        profile = {k: v for k, v in record.items() if k not in SECTION_KEYS.values()}
+        parts = [("profile", profile, self._write_profile)]
+        if "images" in record:
+            parts.append(("images", record["images"], self._write_images))
+        if "conversation_resumer" in record:
+            parts.append(("summaries", record["conversation_resumer"], self._write_summaries))
+        # "conversation_history" n'est pas stocké : la table messages fait foi
+        uow = unit_of_work.current()
+        for section, data, writer in parts:
+            if uow is not None:
+                uow.stage_document(self._user_key(username, section), data,
+                                   lambda staged, writer=writer: writer(username, staged))
+            else:
+                writer(username, data)
+
+    def _write_user(self, username: str, record: dict) -> None:
+        """Écriture immédiate de toutes les sections présentes (utilisée par l'import)."""
+        assign_image_ids(record.get("images") or [])
+        self._write_profile(username, {k: v for k, v in record.items() if k not in SECTION_KEYS.values()})
+        self._write_images(username, record.get("images") or [])
+        self._write_summaries(username, record.get("conversation_resumer") or [])
+
+    def _write_profile(self, username: str, profile: dict) -> None:
+        extra = {k: v for k, v in profile.items() if k not in PROFILE_KEYS}
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO users (username, nom, current_question, extra) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET nom = excluded.nom, "
+                "current_question = excluded.current_question, extra = excluded.extra",
+                (username, profile.get("nom", username), profile.get("current_question"),
+                 records.encode(extra, pretty=False)))
+            conn.execute("DELETE FROM preferences WHERE username = ?", (username,))
+            conn.executemany(
+                "INSERT INTO preferences (username, question, answer, position) VALUES (?, ?, ?, ?)",
+                [(username, q, a, i) for i, (q, a) in enumerate((profile.get("preferences") or {}).items())])
+            self._bump_version(conn, username)
+
+    def _write_images(self, username: str, images: list) -> None:
+        """
+        Met la table images en accord avec `images` par opérations ponctuelles : une carte
+        inchangée garde sa ligne (seule sa position est corrigée si elle a bougé), une carte
+        modifiée réutilise une ligne libérée, et seules les lignes en trop sont supprimées.
+        """
+        conn = self._connect()
+        with conn:
+            tags = {}
+            for t in conn.execute(
+                    "SELECT t.image_id, t.tag FROM image_tags t JOIN images i ON i.id = t.image_id "
+                    "WHERE i.username = ? ORDER BY t.rowid", (username,)):
+                tags.setdefault(t["image_id"], []).append(t["tag"])
+            existing = {}  # contenu -> [(id, position)]
+            for r in conn.execute(
+                    "SELECT id, position, filename, path, description, extra FROM images "
+                    "WHERE username = ? ORDER BY position", (username,)):
+                content = (r["filename"], r["path"], r["description"], r["extra"], tuple(tags.get(r["id"], [])))
+                existing.setdefault(content, []).append((r["id"], r["position"]))
+
+            changed = []
+            for position, image in enumerate(images):
+                row = (image.get("filename"), image.get("path"), image.get("description"),
+                       records.encode({k: v for k, v in image.items() if k not in IMAGE_KEYS}, pretty=False))
+                same = existing.get(row + (tuple(image.get("tags") or []),))
+                if same:
+                    image_id, old_position = same.pop(0)
+                    if old_position != position:
+                        conn.execute("UPDATE images SET position = ? WHERE id = ?", (position, image_id))
+                else:
+                    changed.append((position, row, image.get("tags") or []))
+
+            free = {old_position: image_id for rows in existing.values() for image_id, old_position in rows}
+            for position, row, image_tags in changed:
+                if free:
+                    # De préférence la ligne qui occupait la même position (carte modifiée sur place)
+                    image_id = free.pop(position) if position in free else free.pop(next(iter(free)))
+                    conn.execute(
+                        "UPDATE images SET position = ?, filename = ?, path = ?, description = ?, extra = ? "
+                        "WHERE id = ?", (position,) + row + (image_id,))
+                    conn.execute("DELETE FROM image_tags WHERE image_id = ?", (image_id,))
+                else:
+                    image_id = conn.execute(
+                        "INSERT INTO images (username, position, filename, path, description, extra) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", (username, position) + row).lastrowid
+                conn.executemany("INSERT INTO image_tags (image_id, tag) VALUES (?, ?)",
+                                 [(image_id, tag) for tag in image_tags])
+            conn.executemany("DELETE FROM images WHERE id = ?", [(image_id,) for image_id in free.values()])
+            self._bump_version(conn, username)
+
+    def _write_summaries(self, username: str, summaries: list) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM summaries WHERE username = ?", (username,))
+            conn.executemany(
+                "INSERT INTO summaries (username, content, created_at) VALUES (?, ?, ?)",
+                [(username, s.get("resumer", ""), None) for s in summaries if isinstance(s, dict)])
+            self._bump_version(conn, username)
+
+    def add_summary(self, username: str, text: str) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT INTO summaries (username, content, created_at) VALUES (?, ?, ?)",
+                         (username, text, datetime.datetime.now().isoformat()))
+            self._bump_version(conn, username)
+
+    def _bump_version(self, conn: sqlite3.Connection, username: str) -> None:
+        conn.execute("INSERT INTO user_versions (username, version) VALUES (?, 1) "
+                     "ON CONFLICT(username) DO UPDATE SET version = version + 1", (username,))
+
+    def user_version(self, username: str) -> int:
+        """Compteur incrémenté à chaque écriture du profil, des images ou des résumés."""
+        row = self._connect().execute("SELECT version FROM user_versions WHERE username = ?",
+                                      (username,)).fetchone()
+        return row["version"] if row is not None else 0
+
+    def list_users(self) -> list:
+        return [r["username"] for r in self._connect().execute("SELECT username FROM users ORDER BY username")]
+
+    # --- Historique ---
+
+    def _staged_messages(self, username: str) -> list:
+        uow = unit_of_work.current()
+        return [dict(msg) for msg in uow.staged_messages(self._user_key(username))] if uow is not None else []
+
+    def load_history(self, username: str) -> list:
+        return list(self.iter_history(username))
+
+    def load_history_tail(self, username: str, limit: int = None) -> list:
+        rows = self._connect().execute(
+            "SELECT id, role, content, timestamp FROM messages WHERE username = ? ORDER BY seq DESC LIMIT ?",
+            (username, limit or history_store.HOT_KEEP)).fetchall()
+        tail = [dict(r) for r in reversed(rows)] + self._staged_messages(username)
+        return tail[-limit:] if limit else tail
+
+    def iter_history(self, username: str, batch_size: int = 500):
+        """Parcourt l'historique par lots (pagination sur seq) sans tout charger."""
+        return self.iter_history_since(username, None, batch_size)
+
+    def iter_history_since(self, username: str, message_id: str = None, batch_size: int = 500):
+        """Parcourt les messages postérieurs à `message_id` (tout l'historique si None ou introuvable)."""
+        conn = self._connect()
+        last_seq = 0
+        if message_id is not None:
+            row = conn.execute("SELECT seq FROM messages WHERE username = ? AND id = ?",
+                               (username, message_id)).fetchone()
+            if row is not None:
+                last_seq = row["seq"]
+            else:
+                print(f"[DEBUG] Message {message_id} introuvable dans l'historique de {username} : "
+                      "lecture complète.")
+        while True:
+            rows = conn.execute(
+                "SELECT seq, id, role, content, timestamp FROM messages WHERE username = ? AND seq > ? "
+                "ORDER BY seq LIMIT ?", (username, last_seq, batch_size)).fetchall()
+            if not rows:
+                break
+            for r in rows:
+                yield {"id": r["id"], "role": r["role"], "content": r["content"], "timestamp": r["timestamp"]}
+            last_seq = rows[-1]["seq"]
+        yield from self._staged_messages(username)
+
+    def append_messages(self, username: str, history: list) -> list:
+        new_messages = history_store.take_new_messages(history)
+        if not new_messages:
+            return []
+        uow = unit_of_work.current()
+        if uow is not None:
+            uow.stage_append(self._user_key(username), new_messages,
+                             lambda staged: self._insert_messages(username, staged))
+        else:
+            self._insert_messages(username, new_messages)
+        return new_messages
+
+    def _insert_messages(self, username: str, messages: list) -> None:
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO messages (id, username, role, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                [(m["id"], username, m["role"], m.get("content", ""), m.get("timestamp")) for m in messages])
+        history_store.notify_append(username, messages)
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Renvoie le backend de stockage configuré (instance partagée par processus)."""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            backend = os.environ.get("REMEMORY_STORAGE", "json").lower()
+            if backend == "sqlite":
+                _storage = SQLiteStorage(os.environ.get("REMEMORY_DB_PATH", DEFAULT_DB_PATH))
+            else:
+                _storage = JsonStorage()
+            print(f"[DEBUG] Backend de stockage : {_storage.name}")
+        return _storage
+
+
+def import_json(target: SQLiteStorage, usernames: list = None) -> None:
+    """Importe les fiches users/*.json et les historiques historique/* dans la base SQLite."""
+    source = JsonStorage()
+    for username in usernames or source.list_users():
+        record = source.load_user(username)
+        if record is not None:
+            target._write_user(username, record)
+        history = source.load_history(username)
+        if history:
+            target._insert_messages(username, [
+                {"id": m.get("id") or history_store.new_message_id(), "role": m.get("role"),
+                 "content": m.get("content", ""), "timestamp": m.get("timestamp")}
+                for m in history if "role" in m
+            ])
+        print(f"[DEBUG] {username} importé : {len(history)} messages.")
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "import-json":
+        import_json(SQLiteStorage(os.environ.get("REMEMORY_DB_PATH", DEFAULT_DB_PATH)), sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "split-json":
+        json_storage = JsonStorage()
+        for name in sys.argv[2:] or json_storage.list_users():
+            with user_transaction(name):
+                json_storage.split_legacy(name)
+    else:
+        print("Usage : python storage.py import-json|split-json [username ...]")
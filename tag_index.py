@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : tag_index.py
+Description : Index inversé des images d'un utilisateur : tag ("catégorie:valeur") -> images et
+              mot de la description -> images. Une image est identifiée par l'identifiant de
+              sa carte ("id", voir storage.assign_image_ids) : ni sa position dans la liste ni
+              son chemin (deux cartes peuvent partager un fichier) ne sont stables.
+              - Mis à jour image par image (index_image / remove_image) lors du tagging, de la
+                modification ou de la suppression d'une carte. Une recherche vérifie seulement
+                que l'index couvre les mêmes identifiants que la fiche ; sinon (cartes ajoutées
+                ou supprimées par ailleurs) sync() compare le contenu indexé (signature des
+                tags et de la description) à celui des cartes et réindexe en mémoire, sans
+                écrire le fichier pendant la recherche.
+              - search() combine tags et mots en ET ou en OU ; facets() compte les tags des
+                images trouvées, par catégorie.
+              - Fichier tag_index/<username>.json (REMEMORY_TAG_INDEX_DIR), écrit avec les
+                autres modifications de la requête (unit_of_work.py) : une requête abandonnée
+                ne l'écrit pas. Les listes inversées sont reconstruites en mémoire à la lecture
+                et gardées tant que le fichier ne change pas.
+"""
+
+import os
+import hashlib
+import threading
+from collections import defaultdict
+import records
+import unit_of_work
+from unit_of_work import atomic_write_json
+from memory_index import words
+
+INDEX_DIR = os.environ.get("REMEMORY_TAG_INDEX_DIR", "tag_index")
+
+
+def normalize_tag(tag: str) -> str:
+    return tag.strip().lower()
+
+
+def image_signature(image: dict) -> str:
+    """Empreinte du contenu indexé d'une carte (description et tags)."""
+    content = "\n".join([image.get("description", "")] + list(image.get("tags") or []))
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def image_document(image: dict) -> dict:
+    """Tags et mots indexés pour une carte image."""
+    tags = sorted({normalize_tag(tag) for tag in image.get("tags") or [] if tag.strip()})
+    # Les valeurs des tags sont aussi cherchables comme mots ("plage" trouve "lieu:plage")
+    text = " ".join([image.get("description", "")] + [tag.split(":", 1)[-1] for tag in tags])
+    return {"sig": image_signature(image), "tags": tags, "terms": sorted(set(words(text)))}
+
+
+class TagIndex:
+    def __init__(self, username: str, directory: str = INDEX_DIR):
+        self.username = username
+        self.path = os.path.join(directory, f"{username}.json")
+        self.docs = {}                    # identifiant de carte -> {"sig", "tags", "terms"}
+        self.tags = defaultdict(set)      # tag -> identifiants
+        self.terms = defaultdict(set)     # mot -> identifiants
+        self._mtime = None
+        self._lock = threading.RLock()
+
+    def _load(self) -> None:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        docs = {}
+        if mtime is not None:
+            try:
+                with open(self.path, "rb") as f:
+                    docs = records.decode(f.read())["docs"]
+            except (OSError, records.DecodeError, KeyError) as e:
+                print(f"[ERROR] Index des tags illisible pour {self.username} : {e}")
+        self.docs, self.tags, self.terms = {}, defaultdict(set), defaultdict(set)
+        for key, doc in docs.items():
+            self._add(key, doc)
+        self._mtime = mtime
+
+    def _save(self) -> None:
+        # Copie : les modifications suivantes ne changent pas la version mise en attente
+        data = {"docs": dict(self.docs)}
+        uow = unit_of_work.current()
+        if uow is not None:
+            uow.stage_document(self.path, data, self._write)
+        else:
+            self._write(data)
+
+    def _write(self, data: dict) -> None:
+        atomic_write_json(self.path, data)
+        with self._lock:
+            self._mtime = os.path.getmtime(self.path)
+
+    def _add(self, key: str, doc: dict) -> None:
+        self.docs[key] = doc
+        for tag in doc["tags"]:
+            self.tags[tag].add(key)
+        for term in doc["terms"]:
+            self.terms[term].add(key)
+
+    def _remove(self, key: str) -> None:
+        doc = self.docs.pop(key, None)
+        if doc is None:
+            return
+        for postings, keys in ((self.tags, doc["tags"]), (self.terms, doc["terms"])):
+            for value in keys:
+                postings[value].discard(key)
+                if not postings[value]:
+                    del postings[value]
+
+    # --- Mises à jour ---
+
+    def index_image(self, image: dict) -> None:
+        """Indexe (ou réindexe) une carte image."""
+        if not image.get("id"):
+            return
+        with self._lock:
+            self._load()
+            doc = image_document(image)
+            if self.docs.get(image["id"]) == doc:
+                return
+            self._remove(image["id"])
+            self._add(image["id"], doc)
+            self._save()
+
+    def remove_image(self, image_id: str) -> None:
+        with self._lock:
+            self._load()
+            if image_id in self.docs:
+                self._remove(image_id)
+                self._save()
+
+    def sync(self, images: list, save: bool = True) -> None:
+        """
+        Met l'index en accord avec les cartes de la fiche (ajouts, modifications, suppressions).
+        Avec save=False, seul l'index en mémoire est corrigé (le fichier le sera à la prochaine
+        mise à jour image par image).
+        """
+        with self._lock:
+            self._load()
+            wanted = {image["id"]: image for image in images if image.get("id")}
+            stale = [key for key, doc in self.docs.items()
+                     if key not in wanted or doc.get("sig") != image_signature(wanted[key])]
+            missing = [key for key in wanted if key not in self.docs or key in stale]
+            if not stale and not missing:
+                return
+            for key in stale:
+                self._remove(key)
+            for key in missing:
+                self._add(key, image_document(wanted[key]))
+            if save:
+                self._save()
+            print(f"[DEBUG] Index des tags de {self.username} mis à jour ({len(missing)} image(s) "
+                  f"réindexée(s), {len(self.docs)} au total).")
+
+    def refresh(self, images: list, ids) -> None:
+        """Vérification rapide avant une recherche : sync() seulement si les identifiants diffèrent."""
+        with self._lock:
+            self._load()
+            if self.docs.keys() != ids:
+                self.sync(images, save=False)
+
+    # --- Recherche ---
+
+    def search(self, tags=(), query: str = "", mode: str = "and") -> set:
+        """
+        Identifiants des images correspondant aux tags et aux mots de `query`, tous requis
+        (mode "and") ou au moins un (mode "or"). Sans critère, toutes les images.
+        """
+        with self._lock:
+            self._load()
+            postings = [self.tags.get(normalize_tag(tag), set()) for tag in tags if tag.strip()]
+            postings += [self.terms.get(term, set()) for term in words(query)]
+            if not postings:
+                return set(self.docs)
+            if mode == "or":
+                return set().union(*postings)
+            # Intersection en partant de la liste la plus courte
+            postings.sort(key=len)
+            result = set(postings[0])
+            for keys in postings[1:]:
+                result &= keys
+                if not result:
+                    break
+            return result
+
+    def facets(self, keys) -> dict:
+        """Nombre d'images par tag parmi `keys`, regroupé par catégorie."""
+        with self._lock:
+            counts = defaultdict(lambda: defaultdict(int))
+            for key in keys:
+                for tag in self.docs.get(key, {}).get("tags", []):
+                    category, _, value = tag.partition(":") if ":" in tag else ("autre", "", tag)
+                    counts[category][value] += 1
+            return {category: dict(sorted(values.items(), key=lambda item: (-item[1], item[0])))
+                    for category, values in sorted(counts.items())}
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_tag_index(username: str) -> TagIndex:
+    """Index partagé par le processus pour `username`."""
+    with _indexes_lock:
+        if username not in _indexes:
+            _indexes[username] = TagIndex(username)
+        return _indexes[username]
+
+
+def search_images(username: str, images: list, tags=(), query: str = "", mode: str = "and",
+                  page: int = 1, per_page: int = 20) -> dict:
+    """
+    Recherche paginée dans les cartes `images` de l'utilisateur (ordre de la fiche conservé).
+    Renvoie {"total", "page", "per_page", "results": [(position, carte)], "facets"}.
+    """
+    index = get_tag_index(username)
+    positions = {image["id"]: position for position, image in enumerate(images) if image.get("id")}
+    index.refresh(images, positions.keys())
+    matches = index.search(tags, query, mode)
+    found = [(position, images[position]) for position in sorted(positions[key] for key in matches if key in positions)]
+    page = max(page, 1)
+    start = (page - 1) * per_page
+    return {
+        "total": len(found),
+        "page": page,
+        "per_page": per_page,
+        "results": found[start:start + per_page],
+        "facets": index.facets(matches)
+    }
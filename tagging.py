@@ -2,6 +2,9 @@
 import re
 import os
 import json
+from storage import get_storage, load_image_cards
+from user_locks import user_transaction
+from tag_index import get_tag_index, image_signature
 
 def generate_tagging_prompt(user_message, image_description=""):
     """Génère un prompt structuré pour le tagging"""
@@ -36,12 +39,6 @@ def generate_tagging_prompt(user_message, image_description=""):
 
     Tags : ["""
 
-def save_user_info(username, user_info):
-    """Saves user data to a JSON file."""
-    user_info_path = f"users/{username}.json"
-    with open(user_info_path, "w", encoding="utf-8") as f:
-        json.dump(user_info, f, ensure_ascii=False, indent=4)
-
 def extract_tags_from_response(llm_response):
     """Extrait les tags de la réponse LLM"""
     match = re.search(r'\[(.*?)\]', llm_response)
@@ -49,11 +46,31 @@ def extract_tags_from_response(llm_response):
         return [tag.strip().lower() for tag in match.group(1).split(',')]
     return []
 
+def save_image_tags(username, image, tags):
+    """
+    Enregistre les tags d'une image sur la fiche relue sous le verrou de l'utilisateur (les tags
+    sont générés sans verrou : la fiche a pu changer entre-temps). Renvoie False si l'image
+    n'existe plus.
+    """
+    with user_transaction(username):
+        user_info = get_storage().load_user(username, ("images",)) or {}
+        for current in user_info.get("images") or []:
+            # Même carte : même identifiant (carte lue avant d'en avoir un : même chemin)
+            same = current.get("id") == image["id"] if image.get("id") else current.get("path") == image.get("path")
+            if same:
+                current["tags"] = tags
+                get_storage().save_user(username, user_info)
+                get_tag_index(username).index_image(current)
+                image["tags"] = tags
+                return True
+    print(f"[ERROR] Image {image.get('path')} introuvable : tags non enregistrés.")
+    return False
+
 def update_image_tags_Last(user_info, username, tags):
     """Met à jour les tags de la dernière image"""
     if "images" in user_info and user_info.get("images"):
-        user_info["images"][-1]["tags"] = tags
-        save_user_info(username, user_info)
+        if not save_image_tags(username, user_info["images"][-1], tags):
+            return None
         return {
             "role": "system",
             "content": f"Mise à jour des tags : {', '.join(tags)}"
@@ -63,8 +80,8 @@ def update_image_tags_Last(user_info, username, tags):
 def update_image_tags(user_info, username, index, tags):
     """Met à jour les tags de l'image spécifiée par son index et sauvegarde les données."""
     if "images" in user_info and user_info.get("images") and index < len(user_info["images"]):
-        user_info["images"][index]["tags"] = tags
-        save_user_info(username, user_info)
+        if not save_image_tags(username, user_info["images"][index], tags):
+            return None
         return {
             "role": "system",
             "content": f"Mise à jour des tags pour l'image {index} : {', '.join(tags)}"
@@ -84,9 +101,153 @@ def handle_image_tagging(user_message, user_info, username, chatbot, index=None)
         if not user_message.strip():
             user_message = "Actualise les tags en fonction de la description."
         tagging_prompt = generate_tagging_prompt(user_message, image_description)
-        tag_response = chatbot.ask(tagging_prompt)
+        # Prompt autonome : une même demande de tags est servie par le cache des réponses
+        tag_response = chatbot.ask_cached(tagging_prompt,
+                                          valid=lambda response: bool(extract_tags_from_response(response)))
         tags = extract_tags_from_response(tag_response)
         if tags:
             return update_image_tags(user_info, username, index, tags)
     return None
 
+
+# --- Re-tagging de toute la photothèque d'un utilisateur ---
+
+TAG_MODEL = 'rolandroland/llama3.1-uncensored:latest'
+CHECKPOINT_DIR = "retag_checkpoints"
+
+def generate_batch_tagging_prompt(descriptions):
+    """Prompt regroupant plusieurs descriptions d'images : une ligne de tags par image numérotée."""
+    images = "\n".join(f'    Image {number} : "{description}"' for number, description in enumerate(descriptions, 1))
+    return f"""Générez des tags pertinents pour chacune des images suivantes, à partir de leur description.
+    Les tags doivent être courts, descriptifs et appartenir à l'une des catégories suivantes :
+    animal, personne, objet, lieu, activité, émotion.
+
+    Format de réponse attendu : une ligne par image, dans l'ordre, et rien d'autre :
+    Image 1 : [catégorie1:valeur1, catégorie2:valeur2, ...]
+    Image 2 : [catégorie1:valeur1, ...]
+
+    Exemple :
+    Image 1 : "Un chat noir et blanc dans un jardin ensoleillé."
+    Image 2 : "La tour Eiffel avec un ciel bleu."
+    Réponse :
+    Image 1 : [animal:chat, lieu:jardin, émotion:joie]
+    Image 2 : [lieu:paris, monument:tour-eiffel, activité:voyage]
+
+    ---
+
+{images}
+    Réponse :"""
+
+def parse_batch_tags(llm_response, count):
+    """Renvoie {numéro d'image: tags} pour les lignes 'Image N : [...]' bien formées (1 <= N <= count)."""
+    tags = {}
+    for number, values in re.findall(r'Image\s*(\d+)\s*:?\s*\[(.*?)\]', llm_response, re.IGNORECASE):
+        number = int(number)
+        if 1 <= number <= count and number not in tags:
+            tags[number] = [tag.strip().lower() for tag in values.split(',') if tag.strip()]
+    return tags
+
+def _checkpoint_path(username):
+    return os.path.join(CHECKPOINT_DIR, f"{username}.json")
+
+def _load_checkpoint(username):
+    try:
+        with open(_checkpoint_path(username), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _tag_batch(batch):
+    """Tags d'un lot de (identifiant de carte, description) ; les images mal analysées sont retentées seules."""
+    from inference import get_gateway, BACKGROUND
+    prompt = generate_batch_tagging_prompt([description for _, description in batch])
+    # Seule une réponse complète est mise en cache : une réponse mal formée serait sinon
+    # rejouée à chaque nouvelle exécution, et les nouvelles tentatives image par image aussi
+    response = get_gateway().chat(TAG_MODEL, [{"role": "user", "content": prompt}],
+                                  priority=BACKGROUND, cache=True,
+                                  cache_if=lambda content: all(parse_batch_tags(content, len(batch)).get(n)
+                                                               for n in range(1, len(batch) + 1)))
+    parsed = parse_batch_tags(response['message']['content'], len(batch))
+    results = {}
+    for number, (image_id, description) in enumerate(batch, 1):
+        if parsed.get(number):
+            results[image_id] = parsed[number]
+        elif len(batch) > 1:
+            results.update(_tag_batch([(image_id, description)]))
+        else:
+            print(f"[ERROR] Aucun tag exploitable pour l'image {image_id}.")
+    return results
+
+def retag_all_images(username, batch_size=5, workers=2, progress=None):
+    """
+    Re-tague toutes les images de l'utilisateur par lots de `batch_size` descriptions, avec au
+    plus `workers` lots en parallèle. Les tags obtenus sont enregistrés après chaque lot dans
+    retag_checkpoints/<username>.json (clé : identifiant de la carte, deux cartes pouvant
+    désigner le même fichier), avec la signature de la carte (image_signature) au moment de la
+    génération : une exécution interrompue reprend là où elle s'était arrêtée, et une carte
+    modifiée entre-temps (tags corrigés à la main) n'est pas écrasée par des tags périmés. La
+    fiche est écrite une seule fois, à la fin. Renvoie le nombre d'images mises à jour.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from unit_of_work import atomic_write_json
+    images = load_image_cards(username)
+    checkpoint = _load_checkpoint(username)
+
+    def current(image):
+        entry = checkpoint.get(image.get("id"))
+        return isinstance(entry, dict) and entry.get("sig") == image_signature(image)
+
+    signatures = {image["id"]: image_signature(image) for image in images}
+    pending = [(image["id"], image.get("description", "")) for image in images if not current(image)]
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    print(f"[DEBUG] Re-tagging de {username} : {len(images)} image(s), {len(checkpoint)} déjà traitée(s), "
+          f"{len(batches)} lot(s).")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_tag_batch, batch) for batch in batches]
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                checkpoint.update({image_id: {"sig": signatures[image_id], "tags": tags}
+                                   for image_id, tags in future.result().items()})
+            except Exception as e:
+                print(f"[ERROR] Erreur lors du tagging d'un lot : {e}")
+                continue
+            atomic_write_json(_checkpoint_path(username), checkpoint)
+            if progress:
+                progress(f"Lot {done}/{len(batches)}", int(90 * done / len(batches)))
+
+    # Écriture unique, sur la fiche relue (elle a pu changer pendant les générations)
+    with user_transaction(username):
+        user_info = get_storage().load_user(username, ("images",)) or {}
+        changed = []
+        for image in user_info.get("images") or []:
+            # Carte modifiée depuis la génération de ses tags : laissée telle quelle
+            if current(image):
+                image["tags"] = checkpoint[image["id"]]["tags"]
+                changed.append(image)
+        updated = len(changed)
+        if updated:
+            get_storage().save_user(username, user_info)
+            for image in changed:
+                get_tag_index(username).index_image(image)
+    # Le point de reprise n'est gardé que si des images restent sans tags
+    complete = all(isinstance(checkpoint.get(image_id), dict) and checkpoint[image_id].get("sig") == sig
+                   for image_id, sig in signatures.items())
+    if complete and os.path.exists(_checkpoint_path(username)):
+        os.remove(_checkpoint_path(username))
+    elif changed:
+        # Cartes mises à jour : nouvelle signature, pour ne pas les re-taguer à la reprise
+        for image in changed:
+            checkpoint[image["id"]]["sig"] = image_signature(image)
+        atomic_write_json(_checkpoint_path(username), checkpoint)
+    print(f"[DEBUG] Re-tagging de {username} terminé : {updated} image(s) mises à jour.")
+    return updated
+
+if __name__ == "__main__":
+    # Usage : python tagging.py retag <username> [taille_des_lots] [lots_en_parallèle]
+    import sys
+    if len(sys.argv) < 3 or sys.argv[1] != "retag":
+        print("Usage : python tagging.py retag <username> [taille_des_lots] [lots_en_parallèle]")
+        sys.exit(1)
+    retag_all_images(sys.argv[2],
+                     batch_size=int(sys.argv[3]) if len(sys.argv) > 3 else 5,
+                     workers=int(sys.argv[4]) if len(sys.argv) > 4 else 2)
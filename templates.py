@@ -267,6 +267,11 @@ chat_template = """
         <a href="{{ url_for('clear_image') }}" class="btn btn-sm btn-secondary">Quitter le mode image</a>
       </div>
       {% endif %}
+      {% if session.image_job %}
+      <div class="alert alert-info" id="imageJob">
+        Analyse de l'image : <span id="imageJobStep">En attente</span> (<span id="imageJobProgress">0</span> %)
+      </div>
+      {% endif %}
     </div>
     <div class="chat-log" id="chatLog">
       {% for msg in chat_history %}
@@ -325,25 +330,79 @@ chat_template = """
       );
       $("#userMessage").val("");
       $("#loadingIndicator").show();
-      // Envoyer la requête via fetch
-      fetch('{{ url_for("chat") }}', {
+      // Bulle de réponse remplie au fur et à mesure que les mots arrivent (Server-Sent Events)
+      const bubble = $('<div class="message-bubble assistant"></div>');
+      let reply = "";
+      let shown = false;
+      function showBubble(){
+        if(!shown){
+          shown = true;
+          $("#loadingIndicator").hide();
+          $("#chatLog").append(
+            $('<div class="message-container d-flex justify-content-start mb-2"></div>')
+              .append('<img src="{{ url_for("static", filename="images/ai.png") }}" alt="IA" class="message-icon">')
+              .append(bubble)
+          );
+        }
+      }
+      function showToken(token){
+        showBubble();
+        reply += token;
+        bubble.text(reply);
+        $("#chatLog").scrollTop($("#chatLog")[0].scrollHeight);
+      }
+      // Erreur (événement "error", réponse HTTP en erreur ou connexion coupée) : affichée dans la
+      // bulle, à la suite du début de réponse éventuel
+      function showError(text){
+        console.error("Erreur :", text);
+        showBubble();
+        bubble.text((reply ? reply + "\n\n" : "") + "Erreur : " + text);
+        $("#chatLog").scrollTop($("#chatLog")[0].scrollHeight);
+      }
+      // Envoyer la requête via fetch et lire le flux d'événements
+      fetch('{{ url_for("chat_stream") }}', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ message: message, tts: $("#tts").is(":checked") })
       })
-      .then(response => response.json())
-      .then(data => {
-        $("#chatLog").append(
-          '<div class="message-container d-flex justify-content-start mb-2">' +
-            '<img src="{{ url_for("static", filename="images/ai.png") }}" alt="IA" class="message-icon">' +
-            '<div class="message-bubble assistant">' + data.reply + '</div>' +
-          '</div>'
-        );
+      .then(async response => {
+        if(!response.ok){
+          const data = await response.json().catch(() => ({}));
+          showError(data.error || ("HTTP " + response.status));
+          return;
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let finished = false;
+        while(true){
+          const { value, done } = await reader.read();
+          if(done) break;
+          buffer += decoder.decode(value, { stream: true });
+          const events = buffer.split("\\n\\n");
+          buffer = events.pop();
+          events.forEach(function(rawEvent){
+            let eventName = "message";
+            let payload = "";
+            rawEvent.split("\\n").forEach(function(line){
+              if(line.startsWith("event: ")) eventName = line.slice(7);
+              else if(line.startsWith("data: ")) payload += line.slice(6);
+            });
+            if(!payload) return;
+            const data = JSON.parse(payload);
+            if(eventName === "message") showToken(data.token);
+            else if(eventName === "error") showError(data.error);
+            else if(eventName === "done") finished = true;
+          });
+        }
+        // Flux terminé sans événement "done" ni "error" : réponse interrompue
+        if(!finished && !bubble.text().startsWith("Erreur") && bubble.text().indexOf("\n\nErreur : ") < 0){
+          showError("la réponse a été interrompue.");
+        }
         $("#loadingIndicator").hide();
       })
       .catch(error => {
-        console.error("Erreur :", error);
-        $("#loadingIndicator").hide();
+        showError("le serveur est injoignable (" + error.message + ").");
       });
     });
     
@@ -419,6 +478,28 @@ chat_template = """
       });
       sendAudioBtn.prop("disabled", true);
     });
+
+    // Suivi de l'analyse d'image en arrière-plan : la page est rechargée à la fin (mode image)
+    {% if session.image_job %}
+    function pollImageJob() {
+      fetch("{{ url_for('image_job', job_id=session.image_job) }}")
+        .then(response => response.json())
+        .then(job => {
+          if (job.status === "done" || job.status === "error" || job.error) {
+            window.location.reload();
+            return;
+          }
+          $("#imageJobStep").text(job.step);
+          $("#imageJobProgress").text(job.progress);
+          setTimeout(pollImageJob, 2000);
+        })
+        .catch(err => {
+          console.error("Erreur lors du suivi de l'analyse :", err);
+          setTimeout(pollImageJob, 5000);
+        });
+    }
+    pollImageJob();
+    {% endif %}
   });
 </script>
 {% endblock %}
@@ -461,7 +542,19 @@ images_template = """
 </style>
 <div class="container">
   <h3 class="text-center mb-4">Images uploadées de {{ username }}</h3>
+  <!-- Recherche par tags (ex. lieu:plage,personne:famille) et mots de la description -->
+  <form method="get" action="{{ url_for('images') }}" class="form-inline justify-content-center mb-4">
+    <input type="text" name="tags" value="{{ tags }}" class="form-control mr-2" placeholder="Tags (lieu:plage,...)">
+    <input type="text" name="q" value="{{ query }}" class="form-control mr-2" placeholder="Mots de la description">
+    <select name="mode" class="form-control mr-2">
+      <option value="and" {% if mode != 'or' %}selected{% endif %}>Tous (ET)</option>
+      <option value="or" {% if mode == 'or' %}selected{% endif %}>Au moins un (OU)</option>
+    </select>
+    <button type="submit" class="btn btn-primary mr-2">Rechercher</button>
+    <a href="{{ url_for('images') }}" class="btn btn-secondary">Toutes</a>
+  </form>
   {% for card in cards %}
+  {% set index = indexes[loop.index0] %}
   <div class="card-horizontal">
     <div class="img-container">
       <!-- L'image cliquable -->
@@ -474,17 +567,17 @@ images_template = """
       <p>
         {% if card.tags and card.tags|length > 0 %}
           {% for tag in card.tags %}
-            <span class="badge badge-secondary tag-badge">{{ tag }}</span>
+            <a href="{{ url_for('images', tags=tag) }}" class="badge badge-secondary tag-badge">{{ tag }}</a>
           {% endfor %}
         {% else %}
           <span class="badge badge-danger">Aucun tag généré</span>
         {% endif %}
       </p>
       <div class="mt-3">
-        <a href="{{ url_for('play_description', index=loop.index0) }}" class="btn btn-primary btn-sm">Lire</a>
-        <a href="{{ url_for('edit_image', index=loop.index0) }}" class="btn btn-info btn-sm">Modifier</a>
-        <a href="{{ url_for('update_tags', index=loop.index0) }}" class="btn btn-warning btn-sm">Rafraîchir tags</a>
-        <a href="{{ url_for('delete_image', index=loop.index0) }}" class="btn btn-danger btn-sm">Supprimer</a>
+        <a href="{{ url_for('play_description', index=index) }}" class="btn btn-primary btn-sm">Lire</a>
+        <a href="{{ url_for('edit_image', index=index) }}" class="btn btn-info btn-sm">Modifier</a>
+        <a href="{{ url_for('update_tags', index=index) }}" class="btn btn-warning btn-sm">Rafraîchir tags</a>
+        <a href="{{ url_for('delete_image', index=index) }}" class="btn btn-danger btn-sm">Supprimer</a>
       </div>
     </div>
   </div>
@@ -492,6 +585,7 @@ images_template = """
   <div class="text-center mt-3">
     <a href="{{ url_for('stop_tts') }}" class="btn btn-warning">Stop TTS</a>
     <a href="{{ url_for('images') }}" class="btn btn-secondary">Rafraîchir</a>
+    <a href="{{ url_for('retag_images') }}" class="btn btn-warning">Re-taguer toutes les images</a>
   </div>
 </div>
 
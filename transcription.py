@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : transcription.py
+Description : Service de transcription audio (Whisper) hors des threads de requête Flask.
+              - Processus de transcription dédiés (transcription_worker.py), lancés comme scripts :
+                ils n'importent pas l'application. Chacun garde son propre modèle Whisper en
+                mémoire ; leur nombre est donc borné par la mémoire : REMEMORY_TRANSCRIBE_MEMORY_MB
+                (par défaut la moitié de la mémoire physique) divisé par la taille d'un modèle
+                (REMEMORY_TRANSCRIBE_MODEL_MB, selon REMEMORY_WHISPER_MODEL), sans dépasser un
+                processus par tranche de REMEMORY_TRANSCRIBE_THREADS cœurs (4 par défaut).
+                REMEMORY_TRANSCRIBE_WORKERS impose le nombre. Un processus est démarré à sa
+                première tâche, ou tous au démarrage avec REMEMORY_WHISPER_WARMUP=1 (chacun
+                précharge alors son modèle une fois).
+              - File bornée : au-delà de REMEMORY_TRANSCRIBE_QUEUE enregistrements en cours
+                (2 par processus par défaut), QueueFull est levée immédiatement.
+              - Détection d'activité vocale par énergie : les silences de début et de fin sont
+                retirés, les silences internes longs sont raccourcis (voir transcription_worker.py).
+              - Les enregistrements longs sont découpés en morceaux d'au plus 30 s (coupés sur le
+                passage le plus calme), transcrits en parallèle par les processus puis recollés
+                dans l'ordre.
+              - Sans parole détectée, rien n'est transcrit : le résultat porte "no_speech": True
+                (texte vide), à traiter par l'appelant plutôt que d'envoyer un prompt vide.
+              - Facteur temps réel (durée de traitement / durée de l'audio) journalisé pour
+                chaque enregistrement et agrégé dans metrics() (/inference_stats), avec l'état
+                de Whisper dans chaque processus : "stopped" (pas démarré), "loading"
+                (chargement en cours), "ready" ou "unloaded" (déchargé après inactivité).
+              Usage : python transcription.py <fichier_audio> [...]
+"""
+
+import os
+import sys
+import time
+import queue
+import threading
+import subprocess
+from multiprocessing.connection import Client
+from concurrent.futures import ThreadPoolExecutor
+from inference import QueueFull
+from model_registry import WHISPER_MODEL, WHISPER_WARMUP
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcription_worker.py")
+THREADS_PER_WORKER = int(os.environ.get("REMEMORY_TRANSCRIBE_THREADS", "4"))
+# Mémoire d'un processus avec son modèle (Mo), par taille de Whisper ; la plus grande si inconnue
+MODEL_MB = {"tiny": 1000, "base": 1000, "small": 2000, "medium": 5000, "turbo": 6000, "large": 10000}
+
+
+def _physical_memory_mb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):  # Windows
+        return None
+
+
+def default_workers() -> int:
+    """Autant de processus que de copies du modèle tenant dans le budget mémoire (au moins 1)."""
+    model_mb = int(os.environ.get("REMEMORY_TRANSCRIBE_MODEL_MB", "0")) or next(
+        (mb for size, mb in MODEL_MB.items() if WHISPER_MODEL.startswith(size)), MODEL_MB["large"])
+    memory_mb = int(os.environ.get("REMEMORY_TRANSCRIBE_MEMORY_MB", "0"))
+    if not memory_mb:
+        physical = _physical_memory_mb()
+        if physical is None:
+            return 1
+        memory_mb = physical // 2
+    by_cpu = (os.cpu_count() or 1) // THREADS_PER_WORKER
+    return max(1, min(by_cpu, memory_mb // model_mb))
+
+
+WORKERS = int(os.environ.get("REMEMORY_TRANSCRIBE_WORKERS", "0")) or default_workers()
+QUEUE_MAX = int(os.environ.get("REMEMORY_TRANSCRIBE_QUEUE", str(2 * WORKERS)))
+
+
+class _Worker:
+    """Un processus transcription_worker.py et sa connexion."""
+
+    def __init__(self):
+        authkey = os.urandom(32)
+        env = dict(os.environ, REMEMORY_TRANSCRIBE_AUTHKEY=authkey.hex(),
+                   REMEMORY_TRANSCRIBE_THREADS=str(THREADS_PER_WORKER))
+        self.process = subprocess.Popen([sys.executable, WORKER_SCRIPT], env=env,
+                                        stdout=subprocess.PIPE, text=True)
+        address = self.process.stdout.readline().strip()
+        self.process.stdout.close()
+        if not address:
+            self.process.wait()
+            raise RuntimeError(f"Processus de transcription arrêté au démarrage (code {self.process.returncode})")
+        host, port = address.rsplit(":", 1)
+        self.conn = Client((host, int(port)), authkey=authkey)
+        self.task = None
+        self.model = {}  # état de Whisper dans le processus, reçu avec chaque réponse
+        print(f"[DEBUG] Processus de transcription démarré (pid {self.process.pid}).")
+
+    def call(self, task: str, *args):
+        self.task = task
+        try:
+            self.conn.send((task, args))
+            status, value, self.model = self.conn.recv()
+        finally:
+            self.task = None
+        if status == "error":
+            raise RuntimeError(value)
+        return value
+
+    def state(self) -> str:
+        if self.model.get("ready"):
+            return "ready"
+        # Modèle absent pendant le préchargement (dès le démarrage) ou une transcription : il se charge
+        if self.task in ("status", "transcribe") or (WHISPER_WARMUP and not self.model):
+            return "loading"
+        return "unloaded"
+
+    def close(self) -> None:
+        # Connexion fermée : le processus s'arrête de lui-même
+        self.conn.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+# --- Service (processus de l'application) ---
+
+class TranscriptionService:
+    def __init__(self, workers: int = WORKERS, queue_max: int = QUEUE_MAX):
+        self.workers = workers
+        self.queue_max = queue_max
+        # Processus libres ; None : pas encore démarré (ou arrêté, relancé à la tâche suivante)
+        self._idle = queue.Queue()
+        for _ in range(workers):
+            self._idle.put(None)
+        self._started = []  # processus démarrés, libres ou occupés
+        self._calls = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcribe-chunk")
+        self._jobs = ThreadPoolExecutor(max_workers=queue_max, thread_name_prefix="transcribe")
+        self._slots = threading.BoundedSemaphore(queue_max)
+        self._lock = threading.Lock()
+        self.stats = {"jobs": 0, "rejected": 0, "errors": 0, "no_speech": 0, "audio_s": 0.0, "speech_s": 0.0,
+                      "elapsed_s": 0.0, "last_rtf": 0.0}
+
+    def submit(self, path: str):
+        """Met l'enregistrement en file (QueueFull si elle est pleine) ; renvoie un Future du résultat."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.stats["rejected"] += 1
+            raise QueueFull(f"File de transcription pleine ({self.queue_max} enregistrements)")
+        try:
+            return self._jobs.submit(self._run, path)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _call(self, task: str, *args):
+        """Exécute une tâche sur un processus libre (démarré si besoin)."""
+        worker = self._idle.get()
+        try:
+            if worker is None:
+                worker = self._start_worker()
+            return worker.call(task, *args)
+        except (EOFError, OSError):
+            # Processus arrêté (mémoire insuffisante, plantage) : relancé à la tâche suivante
+            if worker is not None:
+                self._stop_worker(worker)
+                worker = None
+            raise
+        finally:
+            self._idle.put(worker)
+
+    def _start_worker(self) -> _Worker:
+        worker = _Worker()
+        with self._lock:
+            self._started.append(worker)
+        return worker
+
+    def _stop_worker(self, worker: _Worker) -> None:
+        with self._lock:
+            self._started.remove(worker)
+        worker.close()
+
+    def warmup(self) -> threading.Thread:
+        """
+        Démarre tous les processus en arrière-plan (REMEMORY_WHISPER_WARMUP=1) ; chacun précharge
+        son modèle une fois au démarrage. Les processus restent réservés jusqu'à la fin du
+        préchargement (la tâche "status" y répond une fois le modèle chargé).
+        """
+        def run():
+            workers = [self._idle.get() for _ in range(self.workers)]
+            try:
+                for i, worker in enumerate(workers):
+                    if worker is None:
+                        workers[i] = self._start_worker()
+                for worker in workers:
+                    worker.call("status")
+            except Exception as e:
+                print(f"[ERROR] Démarrage des processus de transcription impossible : {e}")
+            finally:
+                for worker in workers:
+                    self._idle.put(worker)
+        thread = threading.Thread(target=run, name="warmup-transcription", daemon=True)
+        thread.start()
+        return thread
+
+    def transcribe(self, path: str) -> dict:
+        return self.submit(path).result()
+
+    def _run(self, path: str) -> dict:
+        start = time.monotonic()
+        try:
+            duration, speech, chunks = self._call("prepare", path)
+            # Morceaux transcrits en parallèle par les processus, recollés dans l'ordre
+            texts = list(self._calls.map(lambda chunk: self._call("transcribe", chunk), chunks))
+        except Exception:
+            with self._lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            self._slots.release()
+        elapsed = time.monotonic() - start
+        rtf = elapsed / duration if duration else 0.0
+        with self._lock:
+            self.stats["jobs"] += 1
+            self.stats["audio_s"] += duration
+            self.stats["speech_s"] += speech
+            self.stats["elapsed_s"] += elapsed
+            self.stats["last_rtf"] = rtf
+        text = " ".join(t for t in texts if t)
+        if not text:
+            with self._lock:
+                self.stats["no_speech"] += 1
+            print(f"[DEBUG] Aucune parole détectée dans {os.path.basename(path)} ({duration:.1f} s d'audio).")
+        print(f"[DEBUG] Transcription de {os.path.basename(path)} : {duration:.1f} s d'audio, "
+              f"{speech:.1f} s de parole, {len(chunks)} morceau(x), {elapsed:.1f} s (facteur temps réel {rtf:.2f}).")
+        return {"text": text, "no_speech": not text, "audio_s": round(duration, 2),
+                "speech_s": round(speech, 2), "chunks": len(chunks), "elapsed_s": round(elapsed, 2),
+                "rtf": round(rtf, 3)}
+
+    def metrics(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            states = [worker.state() for worker in self._started]
+        stats["workers"] = self.workers
+        stats["queue_max"] = self.queue_max
+        # État de Whisper par processus, pour signaler qu'il est encore en chargement
+        stats["whisper"] = {state: states.count(state) for state in ("ready", "loading", "unloaded")}
+        stats["whisper"]["stopped"] = self.workers - len(states)
+        stats["avg_rtf"] = round(stats["elapsed_s"] / stats["audio_s"], 3) if stats["audio_s"] else 0.0
+        for key in ("audio_s", "speech_s", "elapsed_s", "last_rtf"):
+            stats[key] = round(stats[key], 3)
+        return stats
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_transcriber() -> TranscriptionService:
+    """Service partagé du processus (processus de transcription démarrés à la demande)."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = TranscriptionService()
+        return _service
+
+
+def transcription_metrics() -> dict:
+    """Compteurs du service, sans le créer s'il n'a pas encore servi."""
+    if _service is not None:
+        return _service.metrics()
+    return {"workers": WORKERS, "queue_max": QUEUE_MAX, "jobs": 0,
+            "whisper": {"ready": 0, "loading": 0, "unloaded": 0, "stopped": WORKERS}}
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage : python transcription.py <fichier_audio> [...]")
+        sys.exit(1)
+    service = get_transcriber()
+    for future in [service.submit(path) for path in sys.argv[1:]]:
+        print(future.result())
+    print(service.metrics())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : transcription_worker.py
+Description : Processus de transcription Whisper, lancé par transcription.py.
+              - Point d'entrée minimal : le processus n'importe que numpy, whisper et
+                model_registry.py, jamais l'application Flask (AppHist.py, main.py) ni la
+                passerelle d'inférence. Il est lancé comme un script, et non par multiprocessing
+                en "spawn", qui réimporte le module principal de l'application dans chaque enfant.
+              - Écoute sur un port local (multiprocessing.connection, clé d'authentification
+                transmise par REMEMORY_TRANSCRIBE_AUTHKEY), annonce son adresse sur la sortie
+                standard, puis exécute une tâche à la fois : "prepare" (décodage, retrait des
+                silences, découpage), "transcribe" (un morceau) ou "status". Chaque réponse
+                porte l'état du modèle (chargé ou non, chargements), que l'application expose
+                dans /inference_stats. S'arrête quand l'application ferme la connexion.
+              - Un seul modèle Whisper par processus (model_registry.py), chargé dès le démarrage si
+                REMEMORY_WHISPER_WARMUP=1, sinon à la première transcription.
+              - Traitement du signal : trim_silence() et split_chunks().
+              Usage : lancé par transcription.py (python transcription_worker.py)
+"""
+
+import os
+import sys
+from multiprocessing.connection import Listener
+
+SAMPLE_RATE = 16000  # fréquence de whisper.load_audio
+THREADS_PER_WORKER = int(os.environ.get("REMEMORY_TRANSCRIBE_THREADS", "4"))
+
+# Détection d'activité vocale (trames de 30 ms)
+FRAME_SECONDS = 0.03
+MIN_ENERGY = 0.005        # énergie RMS minimale d'une trame de parole
+ENERGY_RATIO = 3.0        # seuil = ENERGY_RATIO x bruit de fond (10e centile), au moins MIN_ENERGY
+SPEECH_PAD = 0.2          # marge gardée autour de la parole
+MAX_SILENCE = 1.0         # silence interne au-delà duquel il est raccourci...
+KEEP_SILENCE = 0.5        # ... à cette durée
+# Découpage des enregistrements longs (fenêtre de Whisper : 30 s)
+CHUNK_SECONDS = 30.0
+CUT_SEARCH_SECONDS = 5.0  # recherche du passage le plus calme avant la limite
+
+
+# --- Traitement du signal ---
+
+def frame_energy(audio, frame: int):
+    import numpy
+    count = len(audio) // frame
+    frames = audio[:count * frame].reshape(count, frame)
+    return numpy.sqrt(numpy.mean(frames * frames, axis=1))
+
+
+def trim_silence(audio, sample_rate: int = SAMPLE_RATE):
+    """
+    Retire les silences de début et de fin et raccourcit les longs silences internes.
+    Renvoie le signal conservé (vide s'il n'y a aucune parole).
+    """
+    import numpy
+    frame = int(FRAME_SECONDS * sample_rate)
+    energy = frame_energy(audio, frame)
+    if not len(energy):
+        return audio[:0]
+    noise, loud = numpy.percentile(energy, [10, 95])
+    # Plafonné à la moitié du niveau fort : un enregistrement sans pause n'a pas de "bruit de fond"
+    threshold = max(MIN_ENERGY, min(ENERGY_RATIO * float(noise), 0.5 * float(loud)))
+    voiced = energy > threshold
+    if not voiced.any():
+        return audio[:0]
+    # Marge autour de la parole (les attaques et fins de mots sont faibles)
+    pad = int(SPEECH_PAD / FRAME_SECONDS)
+    voiced = numpy.convolve(voiced, numpy.ones(min(2 * pad + 1, len(voiced))), mode="same") > 0
+
+    keep = voiced.copy()
+    max_silence, keep_silence = int(MAX_SILENCE / FRAME_SECONDS), int(KEEP_SILENCE / FRAME_SECONDS)
+    speech = numpy.flatnonzero(voiced)
+    first, last = speech[0], speech[-1]
+    i = first
+    while i <= last:
+        if voiced[i]:
+            i += 1
+            continue
+        end = i
+        while not voiced[end]:
+            end += 1
+        # Silence interne [i, end) : gardé entier s'il est court, sinon raccourci
+        keep[i:end] = True
+        if end - i > max_silence:
+            keep[i + keep_silence // 2:end - keep_silence // 2] = False
+        i = end
+    frames = audio[:len(energy) * frame].reshape(len(energy), frame)
+    return frames[keep].ravel()
+
+
+def split_chunks(audio, sample_rate: int = SAMPLE_RATE) -> list:
+    """Morceaux d'au plus CHUNK_SECONDS, coupés sur la trame la plus calme avant chaque limite."""
+    import numpy
+    frame = int(FRAME_SECONDS * sample_rate)
+    size, search = int(CHUNK_SECONDS * sample_rate), int(CUT_SEARCH_SECONDS * sample_rate)
+    chunks, start = [], 0
+    while len(audio) - start > size:
+        window = audio[start + size - search:start + size]
+        energy = frame_energy(window, frame)
+        cut = start + size - search + int(numpy.argmin(energy)) * frame if len(energy) else start + size
+        chunks.append(audio[start:cut])
+        start = cut
+    if len(audio) - start > 0:
+        chunks.append(audio[start:])
+    return chunks
+
+
+# --- Tâches ---
+
+def prepare_audio(path: str) -> tuple:
+    """Décodage, retrait des silences et découpage : (durée, durée conservée, morceaux)."""
+    import whisper
+    audio = whisper.load_audio(path)
+    speech = trim_silence(audio)
+    return len(audio) / SAMPLE_RATE, len(speech) / SAMPLE_RATE, split_chunks(speech)
+
+
+def transcribe_chunk(chunk) -> str:
+    from model_registry import registry
+    with registry.use("whisper") as model:
+        return model.transcribe(chunk, fp16=False).get("text", "").strip()
+
+
+def model_status() -> dict:
+    from model_registry import registry
+    return registry.status()["whisper"]
+
+
+TASKS = {"prepare": prepare_audio, "transcribe": transcribe_chunk, "status": model_status}
+
+
+def serve() -> None:
+    authkey = bytes.fromhex(os.environ["REMEMORY_TRANSCRIBE_AUTHKEY"])
+    try:
+        import torch
+        torch.set_num_threads(THREADS_PER_WORKER)
+    except ImportError:
+        pass
+    with Listener(("127.0.0.1", 0), authkey=authkey) as listener:
+        host, port = listener.address
+        print(f"{host}:{port}", flush=True)
+        # La sortie standard ne sert qu'à l'annonce : la suite (journaux, ffmpeg) va sur la sortie d'erreur
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        with listener.accept() as conn:
+            from model_registry import registry, WHISPER_WARMUP
+            if WHISPER_WARMUP:
+                try:
+                    with registry.use("whisper"):
+                        pass
+                except Exception as e:
+                    print(f"[ERROR] Préchargement de Whisper impossible : {e}")
+            while True:
+                try:
+                    task, args = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    reply = ("ok", TASKS[task](*args))
+                except Exception as e:
+                    reply = ("error", f"{type(e).__name__}: {e}")
+                conn.send(reply + (model_status(),))
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : unit_of_work.py
+Description : Regroupement des écritures d'une requête (unit of work).
+              - Pendant une requête Flask, les sauvegardes de fiche utilisateur et les ajouts
+                à l'historique sont mis en attente au lieu d'être écrits immédiatement.
+              - À la fin de la requête, chaque fichier est écrit une seule fois.
+              - Les documents JSON sont écrits de façon atomique (fichier temporaire + rename) :
+                un arrêt brutal ne laisse jamais de JSON à moitié écrit, et data_preparer.py
+                ne lit jamais un fichier en cours d'écriture.
+              Hors requête (scripts, data_preparer.py), aucune unité n'est active et les
+              écritures restent immédiates.
+"""
+
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+import records
+
+_local = threading.local()
+
+
+def atomic_write_json(path: str, data) -> None:
+    """
+    Écrit `data` dans `path` via un fichier temporaire du même dossier puis os.replace.
+    Le JSON est produit par le codec de records.py (compact, ou indenté en mode débogage).
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=".json")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(records.encode(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class UnitOfWork:
+    def __init__(self):
+        self.documents = OrderedDict()  # path -> (données, fonction d'écriture)
+        self.appends = OrderedDict()    # username -> (messages, fonction d'écriture)
+
+    def stage_document(self, path: str, data, writer) -> None:
+        """Met en attente l'écriture complète d'un document (la dernière version l'emporte)."""
+        self.documents[path] = (data, writer)
+
+    def staged_document(self, path: str):
+        entry = self.documents.get(path)
+        return entry[0] if entry is not None else None
+
+    def stage_append(self, username: str, messages: list, writer) -> None:
+        """Met en attente des messages à ajouter au journal de l'utilisateur."""
+        pending, _ = self.appends.get(username, ([], writer))
+        pending.extend(messages)
+        self.appends[username] = (pending, writer)
+
+    def staged_messages(self, username: str) -> list:
+        entry = self.appends.get(username)
+        return list(entry[0]) if entry is not None else []
+
+    def flush(self) -> None:
+        documents, self.documents = self.documents, OrderedDict()
+        appends, self.appends = self.appends, OrderedDict()
+        for path, (data, writer) in documents.items():
+            writer(data)
+        for username, (messages, writer) in appends.items():
+            writer(messages)
+        if documents or appends:
+            print(f"[DEBUG] Unit of work : {len(documents)} document(s) et "
+                  f"{len(appends)} historique(s) écrits.")
+
+    def discard(self) -> list:
+        """Abandonne les écritures en attente et renvoie les chemins concernés."""
+        paths = list(self.documents)
+        self.documents.clear()
+        self.appends.clear()
+        return paths
+
+
+def current():
+    """Renvoie l'unité de travail active du thread courant (ou None)."""
+    return getattr(_local, "uow", None)
+
+
+def begin() -> UnitOfWork:
+    _local.uow = UnitOfWork()
+    return _local.uow
+
+
+def end(commit: bool = True) -> list:
+    """
+    Termine l'unité de travail du thread courant. Si commit est False, les écritures sont
+    abandonnées et la liste des documents non écrits est renvoyée (pour invalider les caches).
+    """
+    uow = current()
+    _local.uow = None
+    if uow is None:
+        return []
+    if commit:
+        uow.flush()
+        return []
+    return uow.discard()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : user_cache.py
+Description : Cache en mémoire des fiches utilisateur (users/<username>.json).
+              - Chaque entrée est validée par la date de modification (mtime) et la taille
+                du fichier : une écriture faite par un autre processus (data_preparer.py)
+                est donc détectée et le fichier est relu.
+              - Les sauvegardes passent par le cache (write-through). Pendant une requête,
+                l'écriture sur disque est différée jusqu'à la fin de l'unité de travail
+                (voir unit_of_work.py) et se fait de façon atomique.
+              - Éviction LRU avec un plafond mémoire configurable via la variable
+                d'environnement REMEMORY_USER_CACHE_MB (64 Mo par défaut).
+              - Le cache garde sa propre copie et load() en renvoie une autre : un appelant
+                peut modifier le document sans que les autres threads le voient avant save(),
+                ni que le cache le garde si la requête échoue. Pendant une requête, le
+                document mis en attente par save() est renvoyé tel quel (il lui appartient).
+"""
+
+import os
+import threading
+from collections import OrderedDict
+import unit_of_work
+import records
+
+DEFAULT_MAX_MB = 64
+
+
+class UserRecordCache:
+    def __init__(self, max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # path -> (signature, taille, données)
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _signature(path: str):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _store(self, path: str, signature, data) -> None:
+        # La taille du fichier sert d'estimation de l'empreinte mémoire de l'entrée
+        size = signature[1]
+        self._evict(path)
+        self._entries[path] = (signature, size, data)
+        self._total += size
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._evict(oldest)
+
+    def _evict(self, path: str) -> None:
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._total -= entry[1]
+
+    def load(self, path: str, kind: str = None):
+        """
+        Renvoie le contenu JSON du fichier (ou None s'il n'existe pas). `kind` désigne le
+        schéma de records.py utilisé pour valider et compléter le document.
+        """
+        uow = unit_of_work.current()
+        if uow is not None:
+            staged = uow.staged_document(path)
+            if staged is not None:
+                return staged
+        try:
+            signature = self._signature(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._evict(path)
+            return None
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return records.clone(entry[2])
+            self.misses += 1
+        with open(path, "rb") as f:
+            data = records.decode(f.read(), kind)
+        with self._lock:
+            self._store(path, signature, data)
+        return records.clone(data)
+
+    def save(self, path: str, data) -> None:
+        """
+        Écrit le fichier puis met à jour le cache avec la nouvelle signature.
+        Si une unité de travail est active, l'écriture est seulement mise en attente.
+        """
+        uow = unit_of_work.current()
+        if uow is not None:
+            uow.stage_document(path, data, lambda staged: self._write(path, staged))
+            return
+        self._write(path, data)
+
+    def _write(self, path: str, data) -> None:
+        unit_of_work.atomic_write_json(path, data)
+        signature = self._signature(path)
+        with self._lock:
+            self._store(path, signature, records.clone(data))
+
+    def invalidate(self, path: str = None) -> None:
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self._total = 0
+            else:
+                self._evict(path)
+
+
+user_cache = UserRecordCache(int(float(os.environ.get("REMEMORY_USER_CACHE_MB", DEFAULT_MAX_MB)) * 1024 * 1024))
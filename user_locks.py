@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fichier : user_locks.py
+Description : Verrous consultatifs par utilisateur, partagés entre processus (fcntl.flock).
+              - Un fichier locks/<username>.lock par utilisateur ; mode "r" (partagé) pour
+                les lectures, "w" (exclusif) pour les lectures-modifications-écritures.
+              - Délai maximal d'attente configurable (REMEMORY_LOCK_TIMEOUT, 30 s par défaut) ;
+                au-delà, LockTimeout est levée.
+              - Réentrant dans un même thread : un verrou déjà tenu n'est pas repris. Un verrou
+                "r" n'est jamais converti en "w" sur place (conversion non atomique, deux
+                lecteurs qui la tentent se bloquent mutuellement) : il faut rendre le verrou
+                "r", prendre le verrou "w" et relire les données.
+              - user_transaction() encadre une lecture-modification-écriture : verrou exclusif,
+                puis écriture des modifications en attente de l'unité de travail (voir
+                unit_of_work.py) avant de rendre le verrou. Le verrou n'est donc tenu que le
+                temps de relire, modifier et écrire, jamais pendant un appel au modèle.
+              Permet de faire tourner plusieurs workers (gunicorn) en parallèle de
+              data_preparer.py sans perte de mises à jour. Sous Windows (pas de fcntl), seul un
+              verrou interne au processus est utilisé.
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+import unit_of_work
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOCK_DIR = os.environ.get("REMEMORY_LOCK_DIR", "locks")
+DEFAULT_TIMEOUT = float(os.environ.get("REMEMORY_LOCK_TIMEOUT", "30"))
+POLL_INTERVAL = 0.05
+
+
+class LockTimeout(TimeoutError):
+    """Le verrou de l'utilisateur n'a pas pu être obtenu dans le délai imparti."""
+
+
+_held = threading.local()        # username -> [fichier, mode, profondeur] pour le thread courant
+_process_locks = {}              # repli sans fcntl : un verrou par utilisateur
+_process_locks_guard = threading.Lock()
+
+
+def _held_locks() -> dict:
+    if not hasattr(_held, "locks"):
+        _held.locks = {}
+    return _held.locks
+
+
+def _flock(f, mode: str, username: str, timeout: float) -> None:
+    operation = (fcntl.LOCK_SH if mode == "r" else fcntl.LOCK_EX) | fcntl.LOCK_NB
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(f.fileno(), operation)
+            return
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                raise LockTimeout(f"Verrou '{mode}' de {username} non obtenu après {timeout} s")
+            time.sleep(POLL_INTERVAL)
+
+
+def _acquire(username: str, mode: str, timeout: float):
+    if fcntl is None:
+        with _process_locks_guard:
+            lock = _process_locks.setdefault(username, threading.Lock())
+        if not lock.acquire(timeout=timeout):
+            raise LockTimeout(f"Verrou de {username} non obtenu après {timeout} s")
+        return lock
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    f = open(os.path.join(LOCK_DIR, f"{username}.lock"), "a+")
+    try:
+        _flock(f, mode, username, timeout)
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+
+def _release(handle) -> None:
+    if fcntl is None:
+        handle.release()
+        return
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+    finally:
+        handle.close()
+
+
+@contextmanager
+def user_lock(username: str, mode: str = "w", timeout: float = None):
+    """Tient le verrou de l'utilisateur pendant le bloc `with`."""
+    if mode not in ("r", "w"):
+        raise ValueError(f"Mode de verrou inconnu : {mode}")
+    timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+    locks = _held_locks()
+    entry = locks.get(username)
+    if entry is not None:
+        if entry[1] == "r" and mode == "w":
+            raise RuntimeError(f"Verrou 'w' de {username} demandé sous un verrou 'r' : "
+                               "rendre le verrou 'r' avant de prendre le verrou 'w'.")
+        entry[2] += 1
+        try:
+            yield
+        finally:
+            entry[2] -= 1
+        return
+    handle = _acquire(username, mode, timeout)
+    locks[username] = [handle, mode, 1]
+    try:
+        yield
+    finally:
+        del locks[username]
+        _release(handle)
+
+
+@contextmanager
+def user_transaction(username: str, timeout: float = None):
+    """
+    Lecture-modification-écriture de la fiche de `username` : le bloc relit les données sous
+    le verrou exclusif, et les écritures mises en attente sont faites avant de le rendre.
+    """
+    outermost = username not in _held_locks()
+    with user_lock(username, "w", timeout):
+        yield
+        uow = unit_of_work.current()
+        if outermost and uow is not None:
+            uow.flush()
+
+
+def acquire_user_lock(username: str, mode: str = "w", timeout: float = None):
+    """
+    Variante sans bloc `with` (verrou tenu jusqu'à un appel ultérieur, hors d'un bloc unique).
+    Renvoie un objet à passer à release_user_lock.
+    """
+    context = user_lock(username, mode, timeout)
+    context.__enter__()
+    return context
+
+
+def release_user_lock(context) -> None:
+    context.__exit__(None, None, None)